@@ -30,6 +30,7 @@ import logging.handlers
 import netaddr
 import netaddr.core
 import os
+import socket
 import sys
 from types import StringTypes
 
@@ -98,12 +99,11 @@ def validate_ip_addr(addr, version):
     Validates that an IP address is valid. Returns true if valid, false if
     not. Version can be "4", "6", None for "IPv4", "IPv6", or "either"
     respectively.
+
+    Accepts the same strings as netaddr.IPAddress() but handles the common
+    case without using netaddr.  Results for strings are cached.
     """
-    try:
-        ip = netaddr.IPAddress(addr, version=version)
-        return True
-    except (netaddr.core.AddrFormatError, ValueError, TypeError):
-        return False
+    return _validate_cached(_ip_addr_cache, _validate_ip_addr, addr, version)
 
 
 def validate_cidr(cidr, version):
@@ -111,14 +111,77 @@ def validate_cidr(cidr, version):
     Validates that a CIDR is valid. Returns true if valid, false if
     not. Version can be "4", "6", None for "IPv4", "IPv6", or "either"
     respectively.
+
+    Accepts the same strings as netaddr.IPNetwork() but handles the common
+    case without using netaddr.  Results for strings are cached.
     """
+    return _validate_cached(_cidr_cache, _validate_cidr, cidr, version)
+
+
+def _validate_cached(cache, validate_fn, value, version):
+    if not isinstance(value, StringTypes):
+        # Leave netaddr to decide what to do with other types.
+        return validate_fn(value, version)
+    key = (value, version)
+    result = cache.get(key)
+    if result is None:
+        result = validate_fn(value, version)
+        cache[key] = result
+    return result
+
+
+def _validate_ip_addr(addr, version):
+    if (isinstance(addr, StringTypes) and
+            _strict_ip_version(addr, version) is not None):
+        return True
+    # Not a plain dotted-quad or IPv6 address.  netaddr accepts some other
+    # formats (such as "10.1") so defer to it.
+    try:
+        netaddr.IPAddress(addr, version=version)
+        return True
+    except (netaddr.core.AddrFormatError, ValueError, TypeError):
+        return False
+
+
+def _validate_cidr(cidr, version):
+    if isinstance(cidr, StringTypes):
+        addr, slash, prefix = cidr.partition("/")
+        ip_version = _strict_ip_version(addr, version)
+        if ip_version is not None:
+            if not slash:
+                return True
+            prefix_len = _PREFIX_LEN_BY_STR.get(prefix)
+            if (prefix_len is not None and
+                    prefix_len <= _MAX_PREFIX_LEN[ip_version]):
+                return True
+    # Not a simple CIDR, defer to netaddr, which accepts some other formats
+    # (such as netmasks).
     try:
-        ip = netaddr.IPNetwork(cidr, version=version)
+        netaddr.IPNetwork(cidr, version=version)
         return True
     except (netaddr.core.AddrFormatError, ValueError, TypeError):
         return False
 
 
+def _strict_ip_version(addr, version):
+    """
+    Strictly parses an IP address string using socket.inet_pton().
+
+    :returns: the IP version of the address or None if the address isn't in
+        the standard format for the given version.
+    """
+    for version in ((version,) if version else (4, 6)):
+        family = _FAMILY_BY_VERSION.get(version)
+        if family is None:
+            return None
+        try:
+            socket.inet_pton(family, addr)
+            return version
+        except (socket.error, ValueError, TypeError, UnicodeError):
+            continue
+    return None
+
+
 def mkdir_p(path):
     """http://stackoverflow.com/a/600612/190597 (tzot)"""
     try:
@@ -131,6 +194,64 @@ def mkdir_p(path):
                 pass
             else: raise
 
+
+# Marker for a cache miss, since None may be a cached value.
+_NOT_CACHED = object()
+
+
+class BoundedCache(object):
+    """
+    Simple cache that holds between max_size and 2 * max_size entries.
+
+    Entries are stored in two generations.  When the current generation
+    fills up, it replaces the previous generation, which is discarded.
+    Hits in the previous generation are promoted to the current one so
+    that frequently-used entries survive.  Unlike an LRU cache, this
+    requires no bookkeeping on a hit in the current generation.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._current = {}
+        self._previous = {}
+
+    def get(self, key, default=None):
+        value = self._current.get(key, _NOT_CACHED)
+        if value is not _NOT_CACHED:
+            return value
+        value = self._previous.pop(key, _NOT_CACHED)
+        if value is _NOT_CACHED:
+            return default
+        self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if (len(self._current) >= self.max_size and
+                key not in self._current):
+            self._previous = self._current
+            self._current = {}
+        self._current[key] = value
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def clear(self):
+        self._current = {}
+        self._previous = {}
+
+
+_FAMILY_BY_VERSION = {4: socket.AF_INET, 6: socket.AF_INET6}
+_MAX_PREFIX_LEN = {4: 32, 6: 128}
+# Only canonical decimal prefix lengths take the fast path.
+_PREFIX_LEN_BY_STR = dict((str(n), n) for n in xrange(129))
+
+# Caches of validate_ip_addr() and validate_cidr() results, keyed on the
+# string and IP version.  Addresses tend to be validated repeatedly, for
+# example, when the same network is referenced by many rules.
+IP_PARSE_CACHE_SIZE = 10000
+_ip_addr_cache = BoundedCache(IP_PARSE_CACHE_SIZE)
+_cidr_cache = BoundedCache(IP_PARSE_CACHE_SIZE)
+
+
 class GreenletFilter(logging.Filter):
     def filter(self, record):
         record.tid = greenlet_id()
@@ -261,13 +382,30 @@ def validate_endpoint(config, endpoint):
     elif endpoint["state"] not in ("active", "inactive"):
         issues.append("Expected 'state' to be one of active/inactive.")
 
-    for field in ["name", "mac", "profile_id"]:
+    for field in ["name", "mac"]:
         if field not in endpoint:
             issues.append("Missing '%s' field." % field)
         elif not isinstance(endpoint[field], StringTypes):
             issues.append("Expected '%s' to be a string; got %r." %
                           (field, endpoint[field]))
 
+    # An endpoint has either a single profile ID or an ordered list of them.
+    if "profile_ids" in endpoint:
+        profile_ids = endpoint["profile_ids"]
+        if not isinstance(profile_ids, list):
+            issues.append("Expected 'profile_ids' to be a list; got %r." %
+                          (profile_ids,))
+        elif not all(isinstance(p, StringTypes) for p in profile_ids):
+            issues.append("Expected 'profile_ids' to contain strings; "
+                          "got %r." % (profile_ids,))
+        elif len(set(profile_ids)) != len(profile_ids):
+            issues.append("Duplicate profile ID in %r." % (profile_ids,))
+    elif "profile_id" not in endpoint:
+        issues.append("Missing 'profile_id' field.")
+    elif not isinstance(endpoint["profile_id"], StringTypes):
+        issues.append("Expected 'profile_id' to be a string; got %r." %
+                      (endpoint["profile_id"],))
+
     if "name" in endpoint:
         if not endpoint["name"].startswith(config.IFACE_PREFIX):
             issues.append("Interface %r does not start with %r." %
@@ -297,6 +435,21 @@ def validate_endpoint(config, endpoint):
     if issues:
         raise ValidationFailed(" ".join(issues))
 
+
+def endpoint_profile_ids(endpoint):
+    """
+    Returns the ordered list of IDs of the profiles that apply to the given
+    endpoint dict, whether it has a single "profile_id" or a list of
+    "profile_ids".
+    """
+    if not endpoint:
+        return []
+    if "profile_ids" in endpoint:
+        return endpoint["profile_ids"]
+    profile_id = endpoint.get("profile_id")
+    return [profile_id] if profile_id else []
+
+
 def validate_rules(rules):
     """
     Ensures that the supplied rules are valid. Once this routine has returned
@@ -106,4 +106,74 @@ def get_profile_id_for_profile_dir(key):
 class EndpointId(namedtuple("EndpointId", ["host", "orchestrator",
                                            "workload", "endpoint"])):
     def __str__(self):
-        return self.__class__.__name__ + ("<%s/%s/%s/%s>" % self)
\ No newline at end of file
+        return self.__class__.__name__ + ("<%s/%s/%s/%s>" % self)
+
+
+# Types of key returned by parse_key().
+KEY_TYPE_READY = "ready"
+# Global config; the ID is the config parameter name or None for the config
+# directory itself.
+KEY_TYPE_CONFIG = "config"
+# Per-host config (including the directory); the ID is the hostname.
+KEY_TYPE_HOST_CONFIG = "host_config"
+# A profile's directory; the ID is the profile ID.
+KEY_TYPE_PROFILE = "profile"
+# A profile's rules or tags; the ID is the profile ID.
+KEY_TYPE_RULES = "rules"
+KEY_TYPE_TAGS = "tags"
+# An endpoint; the ID is an EndpointId.
+KEY_TYPE_ENDPOINT = "endpoint"
+# Any other key in the profile or host directories (including the
+# directories themselves); the ID is None.
+KEY_TYPE_PROFILE_OTHER = "profile_other"
+KEY_TYPE_HOST_OTHER = "host_other"
+# Any other key; the ID is None.
+KEY_TYPE_OTHER = "other"
+
+_VERSION_PREFIX = VERSION_DIR + "/"
+
+
+def parse_key(key):
+    """
+    Classifies an etcd key in a single pass over its path, replacing a
+    series of regex matches against the whole key.
+
+    :param str key: etcd key.
+    :returns: tuple of (key type, ID) where the key type is one of the
+        KEY_TYPE_XXX constants and the meaning of the ID depends on the
+        type.
+    """
+    if not key.startswith(_VERSION_PREFIX):
+        return KEY_TYPE_OTHER, None
+    parts = key[len(_VERSION_PREFIX):].rstrip("/").split("/")
+    num_parts = len(parts)
+    top_dir = parts[0]
+    if top_dir == "host":
+        # host/<hostname>/workload/<orch>/<workload>/endpoint/<endpoint>
+        if (num_parts == 7 and parts[2] == "workload" and
+                parts[5] == "endpoint" and all(parts)):
+            return KEY_TYPE_ENDPOINT, EndpointId(parts[1], parts[3],
+                                                 parts[4], parts[6])
+        # host/<hostname>/config[/<name>]
+        if num_parts in (3, 4) and parts[2] == "config" and parts[1]:
+            return KEY_TYPE_HOST_CONFIG, parts[1]
+        return KEY_TYPE_HOST_OTHER, None
+    if top_dir == "policy":
+        if num_parts == 1 or parts[1] != "profile":
+            return KEY_TYPE_OTHER, None
+        # policy/profile/<profile_id>[/rules|/tags]
+        profile_id = parts[2] if num_parts > 2 else None
+        if profile_id:
+            if num_parts == 3:
+                return KEY_TYPE_PROFILE, profile_id
+            if num_parts == 4:
+                if parts[3] == "rules":
+                    return KEY_TYPE_RULES, profile_id
+                if parts[3] == "tags":
+                    return KEY_TYPE_TAGS, profile_id
+        return KEY_TYPE_PROFILE_OTHER, None
+    if top_dir == "config" and num_parts <= 2:
+        return KEY_TYPE_CONFIG, parts[1] if num_parts == 2 else None
+    if top_dir == "Ready" and num_parts == 1:
+        return KEY_TYPE_READY, None
+    return KEY_TYPE_OTHER, None
@@ -72,6 +72,21 @@ the beginning.  To make use of that function, an Actor must:
   ensuring, of course, that it did not leave any resources
   partially-modified.
 
+Multiplexed actors
+~~~~~~~~~~~~~~~~~~
+
+An Actor may be started with start_on(host) instead of start().  It then
+keeps its own queue and batching but has no greenlet of its own: when a
+message is queued for it, it asks the host Actor to process its queue
+from the host's greenlet, in the host's batch loop.  That saves a
+greenlet per Actor, which adds up for the many small Actors that a
+manager Actor creates.  Callers see the same message API but
+
+* calls from the host to its guests, or between guests of the same host,
+  that pass async=False bypass the queue as for calls to self
+* a guest that blocks, for example waiting for another Actor, blocks its
+  host and the host's other guests.
+
 Thread safety
 ~~~~~~~~~~~~~
 
@@ -136,6 +151,11 @@ class Actor(object):
         self._current_msg = None
         self.started = False
 
+        # Actor whose greenlet we run on, if we were started with start_on().
+        self._host = None
+        # True if we've asked our host to process our queue.
+        self._scheduled_on_host = False
+
         # Message being processed; purely for logging.
         self.msg_uuid = None
 
@@ -156,6 +176,51 @@ class Actor(object):
         self.greenlet.start()
         return self
 
+    def start_on(self, host):
+        """
+        Alternative to start(), runs this actor on the given actor's
+        greenlet rather than creating one of its own.
+        """
+        assert not self.started, "Already running"
+        _log.info("Starting %s on %s", self, host.name)
+        self.started = True
+        self._host = host
+        self.greenlet = host.greenlet
+        if not self._event_queue.empty():
+            self._schedule_on_host()
+        return self
+
+    def _schedule_on_host(self):
+        """
+        Asks our host to process our queue, if we haven't already.
+        """
+        if not self._scheduled_on_host:
+            self._scheduled_on_host = True
+            host = self._host
+            # Equivalent to an @actor_message call; we drop the result so,
+            # as for any other message, an exception kills the process.
+            partial = functools.partial(host._run_guest, self)
+            result = TrackedAsyncResult("_run_guest")
+            msg = Message(partial, [result], self.name, host.name,
+                          needs_own_batch=False)
+            result.set_msg(msg)
+            host._event_queue.put(msg, block=False)
+
+    def _run_guest(self, guest):
+        """
+        Processes the messages that are queued for an actor that was started
+        on our greenlet with start_on().  Called from our loop.
+        """
+        guest._scheduled_on_host = False
+        if guest._event_queue.empty():
+            return
+        name, msg_uuid = actor_storage.name, actor_storage.msg_uuid
+        actor_storage.name = guest.name
+        try:
+            guest._step()
+        finally:
+            actor_storage.name, actor_storage.msg_uuid = name, msg_uuid
+
     def _loop(self):
         """
         Main greenlet loop, repeatedly runs _step().  Doesn't return normally.
@@ -513,6 +578,8 @@ def actor_message(needs_own_batch=False):
             _log.debug("Message %s sent by %s to %s, queue length %d",
                        msg, caller, self.name, self._event_queue.qsize())
             self._event_queue.put(msg, block=False)
+            if self._host is not None:
+                self._schedule_on_host()
             if async:
                 return result
             else:
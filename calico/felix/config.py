@@ -22,8 +22,11 @@ Configuration management for Felix.
 
 On instantiation, this module automatically parses the configuration file and
 builds a singleton configuration object. That object may (once) be changed by
-etcd configuration being reported back to it.
+etcd configuration being reported back to it.  After that, parameters that are
+marked as reloadable may be updated if the etcd configuration changes; changes
+to any other parameter require a restart.
 """
+import copy
 import os
 
 import ConfigParser
@@ -46,6 +49,11 @@ LOGLEVELS = {"none":      None,
              "crit":      logging.CRITICAL,
              "critical":  logging.CRITICAL}
 
+# Values of ChildActorModel: whether the actors that the managers create for
+# each endpoint, profile and ipset get their own greenlets or share their
+# manager's greenlet.
+CHILD_ACTOR_MODELS = ["greenlet", "multiplexed"]
+
 # Sources of a configuration parameter. The order is highest-priority first.
 DEFAULT = "Default"
 ENV = "Environment variable"
@@ -53,6 +61,12 @@ FILE = "Configuration file"
 GLOBAL_ETCD = "Global etcd configuration"
 LOCAL_ETCD = "Host specific etcd configuration"
 DEFAULT_SOURCES = [ ENV, FILE, GLOBAL_ETCD, LOCAL_ETCD ]
+ETCD_SOURCES = [ GLOBAL_ETCD, LOCAL_ETCD ]
+
+# Log severity parameters.  Setting a severity to "none" removes the log
+# handler so changes to or from "none" need a restart.
+LOG_SEVERITY_PARAMS = ["LogSeverityFile", "LogSeveritySys",
+                       "LogSeverityScreen"]
 
 
 class ConfigException(Exception):
@@ -70,6 +84,19 @@ class ConfigException(Exception):
                self.parameter.active_source)
 
 
+class RestartRequired(Exception):
+    """
+    Raised if the etcd configuration changes in a way that we can't apply
+    without restarting.
+    """
+    def __init__(self, names):
+        super(RestartRequired, self).__init__(
+            "Parameters %s changed and cannot be reloaded" %
+            ", ".join(sorted(names))
+        )
+        self.names = names
+
+
 class ConfigParameter(object):
     """
     A configuration parameter. This contains the following information.
@@ -79,20 +106,31 @@ class ConfigParameter(object):
     - Where the value was read from
     """
     def __init__(self, name, description, default,
-                 sources=DEFAULT_SOURCES, value_is_int=False):
+                 sources=DEFAULT_SOURCES, value_is_int=False,
+                 reloadable=False):
         """
         Create a configuration parameter.
         :param str description: Description for logging
         :param list sources: List of valid sources to try
         :param str default: Default value
         :param bool value_is_int: Integer value?
+        :param bool reloadable: Can the value be changed without a restart?
         """
         self.description = description
         self.name = name
         self.sources = sources
+        self.default = default
         self.value = default
         self.active_source = None
         self.value_is_int = value_is_int
+        self.reloadable = reloadable
+
+    def reset(self):
+        """
+        Reverts the parameter to its default, so that it can be set again.
+        """
+        self.value = self.default
+        self.active_source = None
 
     def set(self, value, source):
         """
@@ -154,8 +192,9 @@ class Config(object):
         self.add_parameter("FelixHostname", "Felix compute host hostname",
                            socket.gethostname(), sources=[ENV, FILE])
 
-        self.add_parameter("StartupCleanupDelay", "Delay before cleanup starts",
-                           30, value_is_int=True)
+        self.add_parameter("StartupCleanupDelay",
+                           "Maximum delay before cleanup starts",
+                           30, value_is_int=True, reloadable=True)
         self.add_parameter("MetadataAddr", "Metadata IP address or hostname",
                            "127.0.0.1")
         self.add_parameter("MetadataPort", "Metadata Port",
@@ -164,11 +203,30 @@ class Config(object):
         self.add_parameter("LogFilePath",
                            "Path to log file", "/var/log/calico/felix.log")
         self.add_parameter("LogSeverityFile",
-                           "Log severity for logging to file", "INFO")
+                           "Log severity for logging to file", "INFO",
+                           reloadable=True)
         self.add_parameter("LogSeveritySys",
-                           "Log severity for logging to syslog", "ERROR")
+                           "Log severity for logging to syslog", "ERROR",
+                           reloadable=True)
         self.add_parameter("LogSeverityScreen",
-                           "Log severity for logging to screen", "ERROR")
+                           "Log severity for logging to screen", "ERROR",
+                           reloadable=True)
+        self.add_parameter("SnapshotCacheFile",
+                           "Path to cache of data model",
+                           "/var/lib/calico/felix-snapshot.cache",
+                           sources=[ENV, FILE])
+        self.add_parameter("SnapshotCacheInterval",
+                           "Minimum interval between writes to cache",
+                           60, value_is_int=True, reloadable=True)
+        self.add_parameter("ResyncWindow",
+                           "Window over which hosts spread etcd resyncs",
+                           30, value_is_int=True, reloadable=True)
+        self.add_parameter("ChildActorModel",
+                           "How per-object actors are scheduled",
+                           "greenlet")
+        self.add_parameter("UnusedGracePeriod",
+                           "Time to keep unused profiles and ipsets",
+                           30, value_is_int=True)
 
         # Read the environment variables, then the configuration file.
         self._read_env_vars()
@@ -187,11 +245,11 @@ class Config(object):
         Config has been completely read. Called twice - once after reading from
         environment and config file (so we should be able to access etcd), and
         once after reading from etcd (so we have all the config ready to go).
+        Called again if the etcd config is reloaded.
 
         Responsible for :
         - storing the parameters in the relevant fields in the structure
         - validating the configuration is valid (for this stage in the process)
-        - updating logging parameters (if this is the final call)
         :param final: Have we completed (rather than just read env and config file)
         """
         self.ETCD_ADDR = self.parameters["EtcdAddr"].value
@@ -204,23 +262,27 @@ class Config(object):
         self.LOGLEVFILE = self.parameters["LogSeverityFile"].value
         self.LOGLEVSYS = self.parameters["LogSeveritySys"].value
         self.LOGLEVSCR = self.parameters["LogSeverityScreen"].value
+        self.SNAPSHOT_CACHE_FILE = self.parameters["SnapshotCacheFile"].value
+        self.SNAPSHOT_CACHE_INTERVAL = \
+            self.parameters["SnapshotCacheInterval"].value
+        self.RESYNC_WINDOW = self.parameters["ResyncWindow"].value
+        self.CHILD_ACTOR_MODEL = self.parameters["ChildActorModel"].value
+        self.UNUSED_GRACE_PERIOD = self.parameters["UnusedGracePeriod"].value
 
         self._validate_cfg(final=final)
 
-        if final:
-            # Update logging.
-            common.complete_logging(self.LOGFILE,
-                                    self.LOGLEVFILE,
-                                    self.LOGLEVSYS,
-                                    self.LOGLEVSCR)
+    def _update_logging(self):
+        common.complete_logging(self.LOGFILE,
+                                self.LOGLEVFILE,
+                                self.LOGLEVSYS,
+                                self.LOGLEVSCR)
 
-            # Log configuration - the whole lot of it.
-            for name, parameter in self.parameters.iteritems():
-                log.info("Parameter %s (%s) has value %r read from %s",
-                         name,
-                         parameter.description,
-                         parameter.value,
-                         parameter.active_source)
+    def _log_parameter(self, parameter):
+        log.info("Parameter %s (%s) has value %r read from %s",
+                 parameter.name,
+                 parameter.description,
+                 parameter.value,
+                 parameter.active_source)
 
     def _read_env_vars(self):
         """
@@ -268,6 +330,67 @@ class Config(object):
         :raises ConfigException
         """
         log.debug("Configuration reported from etcd")
+        self._read_etcd_dicts(host_dict, global_dict)
+        self._finish_update(final=True)
+        self._update_logging()
+
+        # Log configuration - the whole lot of it.
+        for name, parameter in self.parameters.iteritems():
+            self._log_parameter(parameter)
+
+    def update_etcd_config(self, host_dict, global_dict):
+        """
+        Re-applies configuration parameters read from etcd after the etcd
+        configuration changed at runtime.  The new values are only applied
+        if they are valid and all the parameters that changed are
+        reloadable.  The caller is responsible for telling the components
+        that use the changed parameters.
+
+        :param host_dict: Dictionary of etcd parameters
+        :param global_dict: Dictionary of global parameters
+        :returns: set of names of the parameters that changed.
+        :raises ConfigException: if the new configuration is invalid; the
+            old configuration is kept.
+        :raises RestartRequired: if a parameter that can't be reloaded
+            changed; the old configuration is kept.
+        """
+        log.info("Reloading configuration from etcd")
+        # Build and validate the new config on a copy, starting from the
+        # values that didn't come from etcd.
+        new_config = copy.copy(self)
+        new_config.parameters = copy.deepcopy(self.parameters)
+        for parameter in new_config.parameters.itervalues():
+            if parameter.active_source in ETCD_SOURCES:
+                parameter.reset()
+        new_config._read_etcd_dicts(host_dict, global_dict)
+        new_config._finish_update(final=True)
+
+        changed = set()
+        restart_needed = set()
+        for name, parameter in new_config.parameters.iteritems():
+            old_value = self.parameters[name].value
+            if parameter.value == old_value:
+                continue
+            changed.add(name)
+            if not parameter.reloadable:
+                restart_needed.add(name)
+            elif (name in LOG_SEVERITY_PARAMS and
+                    "none" in (str(old_value).lower(),
+                               str(parameter.value).lower())):
+                restart_needed.add(name)
+        if restart_needed:
+            raise RestartRequired(restart_needed)
+
+        if changed:
+            self.parameters = new_config.parameters
+            self._finish_update(final=True)
+            if changed.intersection(LOG_SEVERITY_PARAMS):
+                self._update_logging()
+            for name in changed:
+                self._log_parameter(self.parameters[name])
+        return changed
+
+    def _read_etcd_dicts(self, host_dict, global_dict):
         for source, cfg_dict in ((LOCAL_ETCD, host_dict),
                                  (GLOBAL_ETCD, global_dict)):
             for name, parameter in self.parameters.iteritems():
@@ -276,8 +399,6 @@ class Config(object):
 
             self._warn_unused_cfg(cfg_dict, source)
 
-        self._finish_update(final=True)
-
     def _validate_cfg(self, final=True):
         """
         Firewall that the config is not invalid. Called twice, once when
@@ -321,6 +442,23 @@ class Config(object):
         if self.LOGFILE.lower() == "none":
             self.LOGFILE = None
 
+        # Similarly, the snapshot cache may be disabled.
+        if self.SNAPSHOT_CACHE_FILE.lower() == "none":
+            self.SNAPSHOT_CACHE_FILE = None
+
+        if self.RESYNC_WINDOW < 0:
+            raise ConfigException("Resync window must be non-negative",
+                                  self.parameters["ResyncWindow"])
+
+        if self.UNUSED_GRACE_PERIOD < 0:
+            raise ConfigException("Grace period must be non-negative",
+                                  self.parameters["UnusedGracePeriod"])
+
+        self.CHILD_ACTOR_MODEL = self.CHILD_ACTOR_MODEL.lower()
+        if self.CHILD_ACTOR_MODEL not in CHILD_ACTOR_MODELS:
+            raise ConfigException("Invalid child actor model",
+                                  self.parameters["ChildActorModel"])
+
         if self.METADATA_IP.lower() == "none":
             # Metadata is not required.
             self.METADATA_IP = None
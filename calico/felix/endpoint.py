@@ -28,9 +28,10 @@ from calico.felix.futils import IPV4
 from calico.felix.refcount import ReferenceManager, RefCountedActor
 from calico.felix.dispatch import DispatchChains
 from calico.felix.profilerules import RulesManager
+from calico.common import endpoint_profile_ids
 from calico.felix.frules import (
     profile_to_chain_name, commented_drop_fragment, interface_to_suffix,
-    chain_names
+    chain_names, ACCEPT_MARK, MULTI_PROFILE_MARK, PROFILE_MARK_MASK
 )
 
 _log = logging.getLogger(__name__)
@@ -40,8 +41,10 @@ class EndpointManager(ReferenceManager):
     def __init__(self, config, ip_type,
                  iptables_updater,
                  dispatch_chains,
-                 rules_manager):
-        super(EndpointManager, self).__init__(qualifier=ip_type)
+                 rules_manager,
+                 multiplex_objects=False):
+        super(EndpointManager, self).__init__(
+            qualifier=ip_type, multiplex_objects=multiplex_objects)
 
         # Configuration and version to use
         self.config = config
@@ -102,6 +105,19 @@ class EndpointManager(ReferenceManager):
             self.on_endpoint_update(endpoint_id, None)
             self._maybe_yield()
 
+    @actor_message()
+    def apply_updates(self, endpoints_by_id):
+        """
+        Applies a batch of updates.  Unlike apply_snapshot(), endpoints that
+        are missing from the batch are left alone.
+
+        :param dict endpoints_by_id: Map from EndpointId to new endpoint
+            dict or None if the endpoint was deleted.
+        """
+        for endpoint_id, endpoint in endpoints_by_id.iteritems():
+            self.on_endpoint_update(endpoint_id, endpoint)
+            self._maybe_yield()
+
     @actor_message()
     def on_endpoint_update(self, endpoint_id, endpoint):
         """
@@ -195,6 +211,9 @@ class LocalEndpoint(RefCountedActor):
         self._failed = False
         # And whether we've received an update since last time we programmed.
         self._dirty = False
+        # Whether we've told the manager that we've started, which we do
+        # once we've processed our first update.
+        self.notified_ready = False
 
     @actor_message()
     def on_endpoint_update(self, endpoint):
@@ -211,17 +230,16 @@ class LocalEndpoint(RefCountedActor):
                                                self._iface_name)
         was_ready = self._ready
 
-        old_profile_id = self.endpoint and self.endpoint["profile_id"]
-        new_profile_id = endpoint and endpoint["profile_id"]
-        if old_profile_id != new_profile_id:
-            if old_profile_id:
-                # Clean up the old profile.
-                _log.info("Profile changed, decreffing old profile %s",
-                          old_profile_id)
-                self.rules_mgr.decref(old_profile_id, async=True)
-            if new_profile_id is not None:
-                _log.info("Acquiring new profile %s", new_profile_id)
-                self.rules_mgr.get_and_incref(new_profile_id, async=True)
+        old_profile_ids = set(endpoint_profile_ids(self.endpoint))
+        new_profile_ids = set(endpoint_profile_ids(endpoint))
+        for profile_id in old_profile_ids - new_profile_ids:
+            # Clean up the old profile.
+            _log.info("Profile changed, decreffing old profile %s",
+                      profile_id)
+            self.rules_mgr.decref(profile_id, async=True)
+        for profile_id in new_profile_ids - old_profile_ids:
+            _log.info("Acquiring new profile %s", profile_id)
+            self.rules_mgr.get_and_incref(profile_id, async=True)
 
         if endpoint != self.endpoint:
             self._dirty = True
@@ -238,6 +256,10 @@ class LocalEndpoint(RefCountedActor):
             self._deconfigure_interface()
 
         self._maybe_update(was_ready)
+        if not self.notified_ready:
+            # Our programming, if any, is now in the dataplane.
+            self._notify_ready()
+            self.notified_ready = True
         _log.debug("%s finished processing update", self)
 
     @actor_message()
@@ -267,7 +289,7 @@ class LocalEndpoint(RefCountedActor):
             missing_deps.append("endpoint")
         elif self.endpoint.get("state", "active") != "active":
             missing_deps.append("endpoint active")
-        elif not self.endpoint.get("profile_id"):
+        elif not endpoint_profile_ids(self.endpoint):
             missing_deps.append("profile")
         return missing_deps
 
@@ -319,7 +341,7 @@ class LocalEndpoint(RefCountedActor):
             self.ip_version,
             self.endpoint.get("ipv%s_nets" % self.ip_version, []),
             self.endpoint["mac"],
-            self.endpoint["profile_id"]
+            endpoint_profile_ids(self.endpoint)
         )
         try:
             self.iptables_updater.rewrite_chains(updates, deps, async=False)
@@ -391,8 +413,21 @@ class LocalEndpoint(RefCountedActor):
 
 
 def _get_endpoint_rules(endpoint_id, suffix, ip_version, local_ips, mac,
-                        profile_id):
+                        profile_ids):
+    """
+    Returns the chain updates and dependencies for an endpoint's chains.
+
+    If the endpoint has a single profile, packets "--goto" its profile
+    chain.  Otherwise, they go through each of the endpoint's profile chains
+    in order, until one of them sets the accept mark, and are dropped if
+    none does.
+    """
     to_chain_name, from_chain_name = chain_names(suffix)
+    multi_profile = len(profile_ids) > 1
+    set_mark = ("--jump MARK --set-mark %s/%s" %
+                (MULTI_PROFILE_MARK, PROFILE_MARK_MASK))
+    return_if_marked = ("--match mark --mark %s/%s --jump RETURN" %
+                        (ACCEPT_MARK, ACCEPT_MARK))
 
     to_chain = ["--flush %s" % to_chain_name]
     if ip_version == 6:
@@ -416,15 +451,25 @@ def _get_endpoint_rules(endpoint_id, suffix, ip_version, local_ips, mac,
     to_chain.append("--append %s --match conntrack "
                     "--ctstate RELATED,ESTABLISHED --jump RETURN" %
                     to_chain_name)
-    assert profile_id, "Profile ID should be set, not %s" % profile_id
-    profile_in_chain = profile_to_chain_name("inbound", profile_id)
-    to_chain.append("--append %s --goto %s" %
-                    (to_chain_name, profile_in_chain))
-    # This drop rule is not hittable, but it gives us a place to stash the
-    # comment with our ID.
+    assert profile_ids, "Profile IDs should be set, not %s" % profile_ids
+    profile_in_chains = [profile_to_chain_name("inbound", profile_id)
+                         for profile_id in profile_ids]
+    to_deps = set(profile_in_chains)
+    if multi_profile:
+        to_chain.append("--append %s %s" % (to_chain_name, set_mark))
+        for profile_in_chain in profile_in_chains:
+            to_chain.append("--append %s --jump %s" %
+                            (to_chain_name, profile_in_chain))
+            to_chain.append("--append %s %s" % (to_chain_name,
+                                                return_if_marked))
+    else:
+        to_chain.append("--append %s --goto %s" %
+                        (to_chain_name, profile_in_chains[0]))
+    # This drop rule is only hittable if none of several profiles allowed
+    # the packet, but it also gives us a place to stash the comment with our
+    # ID.
     to_chain.append(commented_drop_fragment(to_chain_name,
                                             "Endpoint %s:" % endpoint_id))
-    to_deps = set([profile_in_chain])
 
     # Now the chain that manages packets from the interface...
     from_chain = ["--flush %s" % from_chain_name]
@@ -449,20 +494,34 @@ def _get_endpoint_rules(endpoint_id, suffix, ip_version, local_ips, mac,
                           "--jump RETURN" % from_chain_name)
 
     # Anti-spoofing rules.  Only allow traffic from known (IP, MAC) pairs to
-    # get to the profile chain, drop other traffic.
-    profile_out_chain = profile_to_chain_name("outbound", profile_id)
-    from_deps = set([profile_out_chain])
+    # get to the profile chains, drop other traffic.
+    if multi_profile:
+        from_chain.append("--append %s %s" % (from_chain_name, set_mark))
+    profile_out_chains = [profile_to_chain_name("outbound", profile_id)
+                          for profile_id in profile_ids]
+    from_deps = set(profile_out_chains)
     for ip in local_ips:
         if "/" in ip:
             cidr = ip
         else:
             cidr = "%s/32" % ip if ip_version == 4 else "%s/128" % ip
-        # Note use of --goto rather than --jump; this means that when the
-        # profile chain returns, it will return the chain that called us, not
-        # this chain.
-        from_chain.append("--append %s --src %s --match mac --mac-source %s "
-                          "--goto %s" % (from_chain_name, cidr,
-                                         mac.upper(), profile_out_chain))
+        if multi_profile:
+            for profile_out_chain in profile_out_chains:
+                from_chain.append("--append %s --src %s --match mac "
+                                  "--mac-source %s --jump %s" %
+                                  (from_chain_name, cidr, mac.upper(),
+                                   profile_out_chain))
+                from_chain.append("--append %s %s" % (from_chain_name,
+                                                      return_if_marked))
+        else:
+            # Note use of --goto rather than --jump; this means that when
+            # the profile chain returns, it will return the chain that
+            # called us, not this chain.
+            from_chain.append("--append %s --src %s --match mac "
+                              "--mac-source %s --goto %s" %
+                              (from_chain_name, cidr, mac.upper(),
+                               profile_out_chains[0]))
+    # Spoofed traffic, or traffic that none of the profiles allowed.
     drop_frag = commented_drop_fragment(from_chain_name,
                                         "Anti-spoof DROP (endpoint %s):" %
                                         endpoint_id)
@@ -55,31 +55,49 @@ def _main_greenlet(config):
         etcd_watcher = EtcdWatcher(config)
         etcd_watcher.start()
         # Ask the EtcdWatcher to fill in the global config object before we
-        # proceed.  We don't yet support config updates.
+        # proceed.  The EtcdWatcher applies later changes to the reloadable
+        # parameters and kills us if any other parameter changes.
         etcd_watcher.load_config(async=False)
 
         _log.info("Main greenlet: Configuration loaded, starting remaining "
                   "actors...")
+        # Whether the managers run their per-object actors on their own
+        # greenlets rather than giving each one a greenlet.
+        multiplex = (config.CHILD_ACTOR_MODEL == "multiplexed")
+        # Profiles and ipsets are often referenced again shortly after their
+        # last reference goes away, for example when a VM is rebooted, so
+        # they're kept for a while.  Endpoints aren't: an unreferenced
+        # endpoint has been deleted.
+        grace = config.UNUSED_GRACE_PERIOD
+
         v4_filter_updater = IptablesUpdater("filter", ip_version=4)
         v4_nat_updater = IptablesUpdater("nat", ip_version=4)
-        v4_ipset_mgr = IpsetManager(IPV4)
-        v4_rules_manager = RulesManager(4, v4_filter_updater, v4_ipset_mgr)
+        v4_ipset_mgr = IpsetManager(IPV4, multiplex_objects=multiplex,
+                                    grace_period=grace)
+        v4_rules_manager = RulesManager(4, v4_filter_updater, v4_ipset_mgr,
+                                        multiplex_objects=multiplex,
+                                        grace_period=grace)
         v4_dispatch_chains = DispatchChains(config, 4, v4_filter_updater)
         v4_ep_manager = EndpointManager(config,
                                         IPV4,
                                         v4_filter_updater,
                                         v4_dispatch_chains,
-                                        v4_rules_manager)
+                                        v4_rules_manager,
+                                        multiplex_objects=multiplex)
 
         v6_filter_updater = IptablesUpdater("filter", ip_version=6)
-        v6_ipset_mgr = IpsetManager(IPV6)
-        v6_rules_manager = RulesManager(6, v6_filter_updater, v6_ipset_mgr)
+        v6_ipset_mgr = IpsetManager(IPV6, multiplex_objects=multiplex,
+                                    grace_period=grace)
+        v6_rules_manager = RulesManager(6, v6_filter_updater, v6_ipset_mgr,
+                                        multiplex_objects=multiplex,
+                                        grace_period=grace)
         v6_dispatch_chains = DispatchChains(config, 6, v6_filter_updater)
         v6_ep_manager = EndpointManager(config,
                                         IPV6,
                                         v6_filter_updater,
                                         v6_dispatch_chains,
-                                        v6_rules_manager)
+                                        v6_rules_manager,
+                                        multiplex_objects=multiplex)
 
         update_splitter = UpdateSplitter(config,
                                          [v4_ipset_mgr, v6_ipset_mgr],
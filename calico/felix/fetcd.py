@@ -18,25 +18,55 @@ felix.fetcd
 
 Etcd polling functions.
 """
+from collections import namedtuple
+import functools
+import random
+import socket
 from socket import timeout as SocketTimeout
 from etcd import (EtcdException, EtcdClusterIdChanged, EtcdKeyNotFound,
                   EtcdEventIndexCleared)
+try:
+    from etcd import EtcdConnectionFailed, EtcdWatchTimedOut
+except ImportError:
+    # Older versions of python-etcd let the underlying urllib3 exceptions
+    # escape instead.
+    class EtcdConnectionFailed(EtcdException):
+        pass
+
+    class EtcdWatchTimedOut(EtcdConnectionFailed):
+        pass
 import etcd
 import httplib
 import json
 import logging
+import time
+import zlib
 import gevent
+import gevent.event
+import ijson
+try:
+    # Prefer the C-accelerated backend, if available.
+    import ijson.backends.yajl2_cffi as ijson_backend
+except ImportError:
+    ijson_backend = ijson
 from urllib3 import Timeout
+import urllib3.connection
 import urllib3.exceptions
 from urllib3.exceptions import ReadTimeoutError, ConnectTimeoutError
 
 from calico import common
-from calico.common import ValidationFailed, KNOWN_RULE_KEYS
+from calico.common import ValidationFailed, KNOWN_RULE_KEYS, BoundedCache
 from calico.datamodel_v1 import (VERSION_DIR, READY_KEY, CONFIG_DIR,
-                                 RULES_KEY_RE, TAGS_KEY_RE, ENDPOINT_KEY_RE,
-                                 dir_for_per_host_config,
-                                 get_profile_id_for_profile_dir, dir_for_host,
-                                 PROFILE_DIR, HOST_DIR, EndpointId)
+                                 PROFILE_DIR, HOST_DIR,
+                                 dir_for_per_host_config, dir_for_host,
+                                 key_for_profile_rules, key_for_profile_tags,
+                                 parse_key, KEY_TYPE_READY, KEY_TYPE_CONFIG,
+                                 KEY_TYPE_HOST_CONFIG, KEY_TYPE_PROFILE,
+                                 KEY_TYPE_RULES, KEY_TYPE_TAGS,
+                                 KEY_TYPE_ENDPOINT, KEY_TYPE_PROFILE_OTHER,
+                                 KEY_TYPE_HOST_OTHER)
+from calico.felix import snapcache
+from calico.felix.config import ConfigException, RestartRequired
 from calico.felix.actor import Actor, actor_message
 
 _log = logging.getLogger(__name__)
@@ -44,81 +74,229 @@ _log = logging.getLogger(__name__)
 
 RETRY_DELAY = 5
 
-# If we see an unhandled event (e.g. a directory deletion) for keys in any of
-# these prefixes, we'll abort our polling and resync.
-PREFIXES_TO_RESYNC_ON_CHANGE = [
-    READY_KEY,
-    PROFILE_DIR,
-    HOST_DIR,
-]
+# Bounds on the delay before we retry after failing to talk to etcd.  The
+# delay doubles on each consecutive failure and is jittered so that many
+# hosts don't retry in lock-step after an etcd outage.
+RECONNECT_DELAY_MIN = 1
+RECONNECT_DELAY_MAX = 60
+
+# Minimum interval between the starts of our full resyncs with etcd, which
+# caps the rate at which a flapping error can make us re-read the whole
+# data model.
+MIN_RESYNC_INTERVAL = 10
+
+# Number of consecutive unexpected etcd errors for which we retry our poll
+# from the same index before giving up and doing a full resync.
+MAX_POLL_RETRIES = 3
+
+# TCP keepalive settings for our connections to etcd.  Lets us spot a dead
+# connection (for example, if the etcd server's host has gone away) during
+# a long poll without waiting for the poll's read timeout.
+KEEPALIVE_IDLE_SECS = 30
+KEEPALIVE_INTERVAL_SECS = 10
+KEEPALIVE_COUNT = 3
+
+# Number of keys that we parse from the etcd snapshot before passing them on
+# to the update splitter.  Larger chunks are more efficient to process but
+# delay the start of programming and increase our peak occupancy.
+SNAPSHOT_CHUNK_SIZE = 1000
+
+# Maximum number of batches of updates from the poll loop that may be queued
+# or in progress at the update splitter.  While that many batches are
+# outstanding, further updates are accumulated (and coalesced) into the
+# next batch.
+MAX_BATCHES_IN_FLIGHT = 4
+
+# Number of distinct values of each type (endpoint, rules, tags) for which
+# we keep the parsed and validated result.  Each cache holds up to twice
+# this many entries.
+PARSE_CACHE_SIZE = 10000
+
+# If we see an unhandled event (e.g. a directory deletion) for keys of any of
+# these types, we'll abort our polling and resync.
+KEY_TYPES_TO_RESYNC_ON_CHANGE = frozenset([
+    KEY_TYPE_READY,
+    KEY_TYPE_PROFILE,
+    KEY_TYPE_PROFILE_OTHER,
+    KEY_TYPE_HOST_CONFIG,
+    KEY_TYPE_HOST_OTHER,
+])
+
+# Types of key that we pass on to the update splitter.
+DATA_KEY_TYPES = frozenset([
+    KEY_TYPE_RULES,
+    KEY_TYPE_TAGS,
+    KEY_TYPE_ENDPOINT,
+])
+
+
+# Minimal stand-in for an etcd.EtcdResult, as produced by our streaming
+# snapshot parser.  Supports the attributes used by the parse_xxx()
+# functions.
+EtcdNode = namedtuple("EtcdNode", ["action", "key", "value", "modifiedIndex"])
 
 
 class EtcdWatcher(Actor):
     def __init__(self, config):
         super(EtcdWatcher, self).__init__()
         self.config = config
+        # Client used for one-shot reads, such as loading the snapshot.
         self.client = None
+        # SubtreePollers, each with its own client for long polls.  Created
+        # once the config has been loaded.
+        self.pollers = []
+        # Backoff for retries after failing to talk to etcd.
+        self.backoff = Backoff(RECONNECT_DELAY_MIN, RECONNECT_DELAY_MAX)
+        # Created once the config has been loaded.
+        self.resync_scheduler = None
         self.my_config_dir = dir_for_per_host_config(self.config.HOSTNAME)
+        # Map from key (for rules, tags and endpoints) to the modifiedIndex
+        # of the value that we last passed to the update splitter.  Used to
+        # spot keys that were deleted while we were out of sync with etcd
+        # and to avoid re-sending unchanged keys when we resync.  A value of
+        # None means that we don't know whether the key is up-to-date.
+        self.mod_idx_by_key = {}
+        # ID of the etcd cluster that the modifiedIndexes came from.
+        self.known_cluster_id = None
+        # Map from key to value for the same keys as mod_idx_by_key.  Only
+        # populated if the snapshot cache is enabled, since it roughly
+        # doubles the memory that we use for the data model.
+        self.value_by_key = {}
+        # Snapshot loaded from the on-disk cache, if any.  Discarded once it
+        # has been applied.
+        self.cached_snapshot = None
+        # Tuple of host and global config dicts that we loaded, or None if
+        # they may be out-of-date.  Saved in the snapshot cache.
+        self.config_dicts = None
+        self.last_cache_save_time = 0
+        # Greenlet that is saving the snapshot cache, if any.
+        self._cache_saver = None
+        # Caches of parsed and validated values, keyed on the raw JSON from
+        # etcd, so that we don't re-parse values that we've seen before,
+        # for example, when we resync or when many profiles share the same
+        # rules.
+        self.endpoint_cache = BoundedCache(PARSE_CACHE_SIZE)
+        self.rules_cache = BoundedCache(PARSE_CACHE_SIZE)
+        self.tags_cache = BoundedCache(PARSE_CACHE_SIZE)
+        # Updates from the poll loop that we haven't yet passed to the
+        # update splitter.
+        self._pending_batch = UpdateBatch()
+        # Number of batches that we've passed to the update splitter that it
+        # hasn't finished processing.
+        self._batches_in_flight = 0
+        # Set when there are no batches in flight.
+        self._updates_applied = gevent.event.Event()
+        self._updates_applied.set()
 
     @actor_message()
     def load_config(self):
         _log.info("Waiting for etcd to be ready and for config to be present.")
+        if self.config.SNAPSHOT_CACHE_FILE:
+            self.cached_snapshot = snapcache.load(
+                self.config.SNAPSHOT_CACHE_FILE
+            )
+        cached_config = self.cached_snapshot and self.cached_snapshot.config
         configured = False
         while not configured:
             self._reconnect()
-            self.wait_for_ready()
-            try:
-                global_cfg = self.client.read(CONFIG_DIR)
-                global_dict = _build_config_dict(global_cfg)
-
-                try:
-                    host_cfg = self.client.read(self.my_config_dir)
-                    host_dict = _build_config_dict(host_cfg)
-                except EtcdKeyNotFound:
-                    # It is not an error for there to be no per-host config;
-                    # default to empty.
-                    _log.info("No configuration overrides for this node")
-                    host_dict = {}
-            except (EtcdKeyNotFound, EtcdException) as e:
-                # Note: we don't log the stack trace because it's too spammy
-                # and adds little.
-                _log.error("Failed to read config. etcd may be down or the"
-                           "data model may not be ready: %r. Will retry.", e)
-                gevent.sleep(RETRY_DELAY)
-                continue
+            if cached_config:
+                # We can fall back on the cached config so only give etcd
+                # one chance.
+                config_dicts = None
+                if self._check_ready():
+                    config_dicts = self._read_config_dicts()
+                if config_dicts is None:
+                    _log.warning("Failed to load config from etcd, using "
+                                 "cached copy.")
+                    config_dicts = cached_config
+            else:
+                self.wait_for_ready()
+                config_dicts = self._read_config_dicts()
+                if config_dicts is None:
+                    _sleep_before_retry()
+                    continue
 
-            self.config.report_etcd_config(host_dict, global_dict)
+            host_dict, global_dict = config_dicts
+            # Take a copy for the snapshot cache; report_etcd_config()
+            # consumes the dicts.
+            self.config_dicts = (dict(host_dict), dict(global_dict))
+            self.config.report_etcd_config(dict(host_dict),
+                                           dict(global_dict))
             configured = True
 
+    def _read_config_dicts(self):
+        """
+        Reads the global and per-host config from etcd.
+
+        :returns: tuple of host and global config dicts or None on failure.
+        """
+        try:
+            global_cfg = self.client.read(CONFIG_DIR)
+            global_dict = _build_config_dict(global_cfg)
+
+            try:
+                host_cfg = self.client.read(self.my_config_dir)
+                host_dict = _build_config_dict(host_cfg)
+            except EtcdKeyNotFound:
+                # It is not an error for there to be no per-host config;
+                # default to empty.
+                _log.info("No configuration overrides for this node")
+                host_dict = {}
+        except (EtcdKeyNotFound, EtcdException) as e:
+            # Note: we don't log the stack trace because it's too spammy
+            # and adds little.
+            _log.error("Failed to read config. etcd may be down or the"
+                       "data model may not be ready: %r. Will retry.", e)
+            return None
+        return host_dict, global_dict
+
     @actor_message()
     def wait_for_ready(self):
         _log.info("Waiting for etcd to be ready...")
-        ready = False
-        while not ready:
-            try:
-                db_ready = self.client.read(READY_KEY,
-                                            timeout=10).value
-            except EtcdKeyNotFound:
-                _log.warn("Ready flag not present in etcd; felix will pause "
-                          "updates until the orchestrator sets the flag.")
-                db_ready = "false"
-            except EtcdException as e:
-                # Note: we don't log the
-                _log.error("Failed to retrieve ready flag from etcd (%r). "
-                           "Felix will not receive updates until the "
-                           "connection to etcd is restored.", e)
-                db_ready = "false"
-
-            if db_ready == "true":
-                _log.info("etcd is ready.")
-                ready = True
-            else:
-                _log.info("etcd not ready.  Will retry.")
-                gevent.sleep(RETRY_DELAY)
-                continue
+        while not self._check_ready():
+            _log.info("etcd not ready.  Will retry.")
+            _sleep_before_retry()
+
+    def _check_ready(self):
+        """
+        Checks the ready flag in etcd.
+
+        :returns: True if etcd is reachable and the flag is set.
+        """
+        try:
+            db_ready = self.client.read(READY_KEY,
+                                        timeout=10).value
+        except EtcdKeyNotFound:
+            _log.warn("Ready flag not present in etcd; felix will pause "
+                      "updates until the orchestrator sets the flag.")
+            db_ready = "false"
+        except EtcdException as e:
+            # Note: we don't log the
+            _log.error("Failed to retrieve ready flag from etcd (%r). "
+                       "Felix will not receive updates until the "
+                       "connection to etcd is restored.", e)
+            db_ready = "false"
+
+        if db_ready == "true":
+            _log.info("etcd is ready.")
+            return True
+        return False
 
     def _reconnect(self, copy_cluster_id=True):
+        """
+        Replaces our etcd clients, and hence their connection pools.  Only
+        needed at start of day and if etcd is persistently unreachable;
+        the clients' connections are otherwise reused.
+        """
         _log.info("(Re)connecting to etcd...")
+        if self.client and copy_cluster_id:
+            old_cluster_id = self.client.expected_cluster_id
+            _log.info("Old etcd cluster ID was %s.", old_cluster_id)
+        else:
+            old_cluster_id = None
+        self.client = self._new_client(old_cluster_id)
+
+    def _new_client(self, expected_cluster_id):
         etcd_addr = self.config.ETCD_ADDR
         if ":" in etcd_addr:
             host, port = etcd_addr.split(":")
@@ -126,13 +304,37 @@ class EtcdWatcher(Actor):
         else:
             host = etcd_addr
             port = 4001
-        if self.client and copy_cluster_id:
-            old_cluster_id = self.client.expected_cluster_id
-            _log.info("Old etcd cluster ID was %s.", old_cluster_id)
-        else:
-            old_cluster_id = None
-        self.client = etcd.Client(host=host, port=port,
-                                  expected_cluster_id=old_cluster_id)
+        return new_etcd_client(host, port, expected_cluster_id)
+
+    def _create_pollers(self):
+        """
+        Creates a poller for each subtree of the data model that we watch.
+        Each has its own client so that a poll never holds up a read, or
+        another subtree's poll.
+
+        etcd can't exclude a subtree from a recursive watch so the remote
+        hosts poller sees, and ignores, the events for our own host too.
+        """
+        local_host_dir = dir_for_host(self.config.HOSTNAME)
+        self.pollers = [
+            SubtreePoller("ready", READY_KEY, recursive=False),
+            SubtreePoller("config", CONFIG_DIR),
+            SubtreePoller("profiles", PROFILE_DIR),
+            SubtreePoller("local host", local_host_dir),
+            SubtreePoller("remote hosts", HOST_DIR,
+                          exclude_prefix=local_host_dir),
+        ]
+        for poller in self.pollers:
+            poller.client = self._new_client(None)
+
+    def _set_cluster_id(self, cluster_id):
+        """
+        Sets the etcd cluster ID that our clients expect to see.  None
+        allows any cluster.
+        """
+        self.client.expected_cluster_id = cluster_id
+        for poller in self.pollers:
+            poller.client.expected_cluster_id = cluster_id
 
     @actor_message()
     def watch_etcd(self, update_splitter):
@@ -142,195 +344,778 @@ class EtcdWatcher(Actor):
 
         :returns: Does not return.
         """
+        self.resync_scheduler = ResyncScheduler(self.config.HOSTNAME,
+                                                self.config.RESYNC_WINDOW,
+                                                MIN_RESYNC_INTERVAL)
+        self._create_pollers()
+        cached_index = self._apply_cached_snapshot(update_splitter)
+        retrying_snapshot = False
         while True:
-            _log.info("Reconnecting and loading snapshot from etcd...")
-            self._reconnect(copy_cluster_id=False)
-            self.wait_for_ready()
-
-            # Load initial dump from etcd.  First just get all the endpoints
-            # and profiles by id.  The response contains a generation ID
-            # allowing us to then start polling for updates without missing
-            # any.
-            initial_dump = self.client.read(VERSION_DIR, recursive=True)
-            _log.info("Loaded snapshot from etcd cluster %s, parsing it...",
-                      self.client.expected_cluster_id)
-            rules_by_id = {}
-            tags_by_id = {}
-            endpoints_by_id = {}
-            still_ready = False
-            for child in initial_dump.children:
-                profile_id, rules = parse_if_rules(child)
-                if profile_id:
-                    rules_by_id[profile_id] = rules
-                    continue
-                profile_id, tags = parse_if_tags(child)
-                if profile_id:
-                    tags_by_id[profile_id] = tags
-                    continue
-                endpoint_id, endpoint = parse_if_endpoint(self.config, child)
-                if endpoint_id and endpoint:
-                    endpoints_by_id[endpoint_id] = endpoint
+            if cached_index is not None:
+                # Try to pick up where the cache left off.  If the cache is
+                # too old, etcd will tell us that the index has been cleared
+                # and we'll fall back to a resync.
+                _log.info("Resuming polling from cached etcd index %s.",
+                          cached_index)
+                self._set_cluster_id(self.known_cluster_id)
+                snapshot_index = cached_index
+                cached_index = None
+            else:
+                # Make sure the snapshot isn't overtaken by older updates
+                # from the poll loop.
+                self._wait_for_updates_applied()
+                # Avoid a thundering herd if many hosts need to resync at
+                # once, for example, after an etcd restart.
+                self.resync_scheduler.wait(retrying_snapshot)
+                _log.info("Loading snapshot from etcd...")
+                # The cluster ID may legitimately change across a resync;
+                # the snapshot read records the new one.
+                self._set_cluster_id(None)
+                self.wait_for_ready()
+
+                snapshot_index = self._load_snapshot(update_splitter)
+                if snapshot_index is None:
+                    self.backoff.sleep()
+                    retrying_snapshot = True
                     continue
+                retrying_snapshot = False
+                self.backoff.reset()
+                # We may have missed changes to the config while we were
+                # out of sync, or loaded it from the cache at start of day.
+                self._reload_config(snapshot_index)
+            _log.info("Starting polling for updates from etcd.  Initial etcd "
+                      "index: %s.", snapshot_index)
+            self._poll_until_resync_needed(update_splitter,
+                                           snapshot_index + 1)
 
-                # Double-check the flag hasn't changed since we read it before.
-                if child.key == READY_KEY:
-                    if child.value == "true":
-                        still_ready = True
-                    else:
-                        _log.warning("Aborting resync because ready flag was"
-                                     "unset since we read it.")
-                        continue
+    def _poll_until_resync_needed(self, update_splitter, start_index):
+        """
+        Polls each subtree of the data model in its own greenlet, starting
+        at the given etcd index, until one of them finds that we need to
+        resync.
+        """
+        resync_needed = gevent.event.Event()
+        greenlets = []
+        try:
+            for poller in self.pollers:
+                poller.start_polling(start_index,
+                                     self.client.expected_cluster_id)
+                greenlet = gevent.spawn(self._poll_subtree, poller,
+                                        update_splitter, resync_needed)
+                greenlet.link_exception(self._on_poller_failed)
+                greenlets.append(greenlet)
+            resync_needed.wait()
+        finally:
+            gevent.killall(greenlets)
 
-            if not still_ready:
-                _log.warn("Aborting resync; ready flag no longer present.")
+    def _on_poller_failed(self, greenlet):
+        """
+        Called from the gevent hub if one of our poll greenlets dies.
+        Makes sure that the failure kills the watcher, as it would have
+        done if it had been raised by the actor's own greenlet.
+        """
+        _log.error("Poll greenlet %s failed: %r", greenlet,
+                   greenlet.exception)
+        self.greenlet.kill(greenlet.exception, block=False)
+
+    def _poll_subtree(self, poller, update_splitter, resync_needed):
+        """
+        Long-polls a single subtree of the data model, passing updates on
+        to the update splitter, until the subtree tells us that we need to
+        resync.  Sets the resync_needed event before returning.
+        """
+        while True:
+            # We've processed all the events before the lowest next index
+            # of any of our pollers.
+            self._maybe_save_cache(
+                min(p.next_index for p in self.pollers) - 1
+            )
+            response = None
+            # If the poll times out, there were no events in the subtree up
+            # to (at least) the etcd index before the poll, so we can skip
+            # past it.  Otherwise, a quiet subtree would fall behind the
+            # cluster's event history and hit EtcdEventIndexCleared.
+            start_index = self._read_etcd_index(poller)
+            try:
+                _log.debug("About to wait for %s update %s", poller.name,
+                           poller.next_index)
+                response = poller.client.read(
+                    poller.prefix,
+                    wait=True,
+                    waitIndex=poller.next_index,
+                    recursive=poller.recursive,
+                    timeout=Timeout(connect=10, read=90),
+                    check_cluster_uuid=True
+                )
+                _log.debug("etcd response: %r", response)
+            except (ReadTimeoutError, SocketTimeout,
+                    EtcdWatchTimedOut) as e:
+                # This is expected when we're doing a poll and nothing
+                # happened. socket timeout doesn't seem to be caught by
+                # urllib3 1.7.1.
+                _log.debug("Read from etcd timed out (%r), retrying.", e)
+                # The timed-out connection can't be reused.  Make sure
+                # urllib3 doesn't recycle it (we were seeing this with
+                # urllib3 1.7.1) but keep the client.
+                poller.client.http.clear()
+                if start_index is not None:
+                    poller.next_index = max(poller.next_index,
+                                            start_index + 1)
+            except (ConnectTimeoutError,
+                    urllib3.exceptions.HTTPError,
+                    httplib.HTTPException,
+                    EtcdConnectionFailed):
+                _log.warning("Low-level HTTP error, will retry.",
+                             exc_info=True)
+                poller.client.http.clear()
+                poller.backoff.sleep()
+            except (EtcdClusterIdChanged, EtcdEventIndexCleared) as e:
+                _log.warning("Out of sync with etcd (%r).  Reconnecting "
+                             "for full sync.", e)
+                break
+            except EtcdException as e:
+                # Sadly, python-etcd doesn't have a dedicated exception
+                # for the "no more machines in cluster" error. Parse the
+                # message:
+                msg = (e.message or "unknown").lower()
+                if "no more machines" in msg:
+                    # This error comes from python-etcd when it can't
+                    # connect to any servers.  When we retry, it should
+                    # reconnect.
+                    # TODO: We should probably limit retries here and die
+                    # That'd recover from errors caused by resource
+                    # exhaustion/leaks.
+                    _log.error("Connection to etcd failed, will retry.")
+                else:
+                    # Prefer to resume our poll from the same index,
+                    # which is much cheaper than a resync for us and
+                    # etcd.  If the error persists, assume it is fatal
+                    # to our poll and do a full resync.
+                    poller.poll_failures += 1
+                    if poller.poll_failures > MAX_POLL_RETRIES:
+                        _log.exception("Unknown etcd error %r; doing "
+                                       "resync.", e.message)
+                        break
+                    _log.exception("Unknown etcd error %r; retrying "
+                                   "poll.", e.message)
+                poller.backoff.sleep()
+                poller.client = self._new_client(
+                    poller.client.expected_cluster_id
+                )
+            except:
+                _log.exception("Unexpected exception during etcd poll")
+                raise
+
+            if not response:
+                _log.debug("Failed to get a response from etcd.")
                 continue
+            poller.backoff.reset()
+            poller.poll_failures = 0
 
-            # Actually apply the snapshot. This does not return anything, but
-            # just sends the relevant messages to the relevant threads to make
-            # all the processing occur.
-            _log.info("Snapshot parsed, passing to update splitter")
-            update_splitter.apply_snapshot(rules_by_id,
-                                           tags_by_id,
-                                           endpoints_by_id,
-                                           async=False)
-
-            # These read only objects are no longer required, so tidy them up.
-            del rules_by_id
-            del tags_by_id
-            del endpoints_by_id
-
-            # On first call, the etcd_index seems to be the high-water mark
-            # for the data returned whereas the modified index just tells us
-            # when the key was modified.
-            _log.info("Starting polling for updates from etcd.  Initial etcd "
-                      "index: %s.", initial_dump.etcd_index)
-            next_etcd_index = initial_dump.etcd_index + 1
-            del initial_dump
-            continue_polling = True
-            while continue_polling:
-                response = None
-                try:
-                    _log.debug("About to wait for etcd update %s",
-                               next_etcd_index)
-                    response = self.client.read(VERSION_DIR,
-                                                wait=True,
-                                                waitIndex=next_etcd_index,
-                                                recursive=True,
-                                                timeout=Timeout(connect=10,
-                                                                read=90),
-                                                check_cluster_uuid=True)
-                    _log.debug("etcd response: %r", response)
-                except (ReadTimeoutError, SocketTimeout) as e:
-                    # This is expected when we're doing a poll and nothing
-                    # happened. socket timeout doesn't seem to be caught by
-                    # urllib3 1.7.1.  Simply reconnect.
-                    _log.debug("Read from etcd timed out (%r), retrying.", e)
-                    # Force a reconnect to ensure urllib3 doesn't recycle the
-                    # connection.  (We were seeing this with urllib3 1.7.1.)
-                    self._reconnect()
-                except (ConnectTimeoutError,
-                        urllib3.exceptions.HTTPError,
-                        httplib.HTTPException):
-                    _log.warning("Low-level HTTP error, reconnecting to "
-                                 "etcd.", exc_info=True)
-                    self._reconnect()
-                except (EtcdClusterIdChanged, EtcdEventIndexCleared) as e:
-                    _log.warning("Out of sync with etcd (%r).  Reconnecting "
-                                 "for full sync.", e)
-                    continue_polling = False
-                except EtcdException as e:
-                    # Sadly, python-etcd doesn't have a dedicated exception
-                    # for the "no more machines in cluster" error. Parse the
-                    # message:
-                    msg = (e.message or "unknown").lower()
-                    if "no more machines" in msg:
-                        # This error comes from python-etcd when it can't
-                        # connect to any servers.  When we retry, it should
-                        # reconnect.
-                        # TODO: We should probably limit retries here and die
-                        # That'd recover from errors caused by resource
-                        # exhaustion/leaks.
-                        _log.error("Connection to etcd failed, will retry.")
-                    else:
-                        # Assume any other errors are fatal to our poll and
-                        # do a full resync.
-                        _log.exception("Unknown etcd error %r; doing resync.",
-                                       e.message)
-                        continue_polling = False
-                    # TODO: should we do a backoff here?
-                    gevent.sleep(1)
-                    self._reconnect()
-                except:
-                    _log.exception("Unexpected exception during etcd poll")
-                    raise
-
-                if not response:
-                    _log.debug("Failed to get a response from etcd.")
-                    continue
+            # Since we're polling on a subtree, we can't just increment
+            # the index, we have to look at the modifiedIndex to spot if
+            # we've skipped a lot of updates.
+            poller.next_index = max(poller.next_index,
+                                    response.modifiedIndex) + 1
+
+            if not self._handle_poll_response(poller, response,
+                                              update_splitter):
+                break
+        resync_needed.set()
+
+    def _read_etcd_index(self, poller):
+        """
+        Reads the current etcd index using the poller's client.
 
-                # Since we're polling on a subtree, we can't just increment
-                # the index, we have to look at the modifiedIndex to spot if
-                # we've skipped a lot of updates.
-                next_etcd_index = max(next_etcd_index,
-                                      response.modifiedIndex) + 1
-
-                if response.action == "delete":
-                    # Handle expected directory deletions by faking events for
-                    # child nodes.
-                    profile_id = get_profile_id_for_profile_dir(response.key)
-                    if profile_id:
-                        _log.info("Delete for whole profile %s", profile_id)
-                        update_splitter.on_rules_update(profile_id, None,
-                                                        async=False)
-                        update_splitter.on_tags_update(profile_id, None,
-                                                       async=False)
-                        continue
-                    # TODO: Do we need to handle workload deletions?
-
-                profile_id, rules = parse_if_rules(response)
-                if profile_id:
-                    _log.info("Scheduling profile update %s", profile_id)
-                    update_splitter.on_rules_update(profile_id, rules,
-                                                    async=False)
+        :returns: The etcd index or None if it couldn't be read.
+        """
+        try:
+            return poller.client.read(READY_KEY, timeout=10).etcd_index
+        except (EtcdException,
+                urllib3.exceptions.HTTPError,
+                httplib.HTTPException,
+                SocketTimeout) as e:
+            _log.info("Failed to read current etcd index: %r", e)
+            return None
+
+    def _handle_poll_response(self, poller, response, update_splitter):
+        """
+        Processes an event from one of our poll greenlets.
+
+        :returns: False if we need to resync, True otherwise.
+        """
+        if not poller.covers_key(response.key):
+            # etcd notifies watchers of a subtree if one of its parent
+            # directories is deleted.
+            _log.warning("Event %s for parent of %s; triggering resync.",
+                         response, poller.prefix)
+            return False
+        if poller.excludes_key(response.key):
+            _log.debug("Ignoring event for %s in %s poller", response.key,
+                       poller.name)
+            return True
+
+        key_type, key_id = parse_key(response.key)
+        if key_type in DATA_KEY_TYPES:
+            _log.info("Scheduling %s update %s", key_type, key_id)
+            self._add_to_batch(key_type, key_id, response,
+                               self._pending_batch)
+            self._record_key(response)
+            self._send_pending_updates(update_splitter)
+            return True
+        if key_type == KEY_TYPE_PROFILE and response.action == "delete":
+            # Handle expected directory deletions by faking events for
+            # child nodes.
+            _log.info("Delete for whole profile %s", key_id)
+            self._forget_key(key_for_profile_rules(key_id))
+            self._forget_key(key_for_profile_tags(key_id))
+            self._pending_batch.rules_by_prof_id[key_id] = None
+            self._pending_batch.tags_by_prof_id[key_id] = None
+            self._send_pending_updates(update_splitter)
+            return True
+        if key_type == KEY_TYPE_READY:
+            if response.value != "true":
+                _log.warning("DB became unready, triggering a resync")
+                return False
+            return True
+
+        _log.debug("Response action: %s, key: %s",
+                   response.action, response.key)
+        resync = False
+        if (response.action not in ("set", "create") and
+                key_type in KEY_TYPES_TO_RESYNC_ON_CHANGE):
+            # Catch deletions of whole directories or other operations
+            # that we're not expecting.
+            _log.warning("Unexpected event: %s; triggering resync.",
+                         response)
+            resync = True
+        if (key_type == KEY_TYPE_CONFIG or
+                (key_type == KEY_TYPE_HOST_CONFIG and
+                 key_id == self.config.HOSTNAME)):
+            _log.info("Config changed: %s", response)
+            self._reload_config(min(p.next_index for p in self.pollers) - 1)
+        return not resync
+
+    def _reload_config(self, etcd_index):
+        """
+        Re-reads the config from etcd and applies any changes to reloadable
+        parameters.  If a parameter that can't be reloaded changed, saves
+        the snapshot cache, so that the restart is cheap, and raises
+        RestartRequired, which kills Felix.
+
+        :param etcd_index: The etcd index that our state is up-to-date with.
+        """
+        config_dicts = self._read_config_dicts()
+        if config_dicts is None:
+            # We'll try again after our next resync.
+            self.config_dicts = None
+            return
+        host_dict, global_dict = config_dicts
+        try:
+            changed = self.config.update_etcd_config(dict(host_dict),
+                                                     dict(global_dict))
+        except ConfigException as e:
+            _log.error("Ignoring invalid config from etcd: %s", e)
+            return
+        except RestartRequired as e:
+            _log.warning("%s; restarting to apply the new config.", e)
+            self.config_dicts = config_dicts
+            self._maybe_save_cache(etcd_index, force=True)
+            raise
+        self.config_dicts = config_dicts
+        # No need to send the changes to other actors: the UpdateSplitter
+        # reads StartupCleanupDelay from the shared config when it uses it
+        # and the remaining reloadable parameters are only used by this
+        # watcher.  (We couldn't send ourselves a message anyway; we're
+        # inside watch_etcd(), which never returns.)
+        if "ResyncWindow" in changed:
+            self.resync_scheduler.set_window(self.config.RESYNC_WINDOW)
+
+    def _send_pending_updates(self, update_splitter):
+        """
+        Passes the updates accumulated by the poll loop to the update
+        splitter without waiting for them to be processed, unless there
+        are already MAX_BATCHES_IN_FLIGHT batches outstanding.  In that
+        case, the updates are sent when a batch completes.
+        """
+        if (not len(self._pending_batch) or
+                self._batches_in_flight >= MAX_BATCHES_IN_FLIGHT):
+            return
+        batch = self._pending_batch
+        self._pending_batch = UpdateBatch()
+        self._batches_in_flight += 1
+        self._updates_applied.clear()
+        result = update_splitter.apply_updates(batch.rules_by_prof_id,
+                                               batch.tags_by_prof_id,
+                                               batch.endpoints_by_id,
+                                               async=True)
+        result.rawlink(functools.partial(self._on_updates_applied,
+                                         update_splitter))
+
+    def _on_updates_applied(self, update_splitter, result):
+        """
+        Called from the gevent hub when the update splitter finishes
+        processing a batch sent by _send_pending_updates().
+        """
+        self._batches_in_flight -= 1
+        try:
+            result.get(block=False)
+        except Exception as e:
+            # Previously, this exception would have been raised by a
+            # blocking call in the poll loop; make sure it still kills us.
+            _log.exception("Update splitter failed to apply updates.")
+            self.greenlet.kill(e, block=False)
+            return
+        self._send_pending_updates(update_splitter)
+        if self._batches_in_flight == 0:
+            self._updates_applied.set()
+
+    def _wait_for_updates_applied(self):
+        """
+        Blocks until the update splitter has processed all the updates
+        from the poll loop.
+        """
+        self._updates_applied.wait()
+
+    def _load_snapshot(self, update_splitter):
+        """
+        Streams a snapshot of the whole data model from etcd, passing it to
+        the update splitter in chunks as it is parsed.  Keys that haven't
+        been modified since we last passed them on are skipped so that a
+        resync costs O(changes).  Once the snapshot has been fully read,
+        sends deletions for any keys that we previously reported but which
+        are no longer present.
+
+        :returns: The etcd index of the snapshot or None if the snapshot
+            could not be loaded.
+        """
+        try:
+            response = self._start_snapshot_read()
+        except (EtcdException,
+                urllib3.exceptions.HTTPError,
+                httplib.HTTPException,
+                SocketTimeout) as e:
+            _log.error("Failed to start reading snapshot from etcd: %r. "
+                       "Will retry.", e)
+            return None
+
+        # The etcd index header is the high-water mark for the data returned
+        # whereas the modified index of each node just tells us when that key
+        # was modified.
+        snapshot_index = int(response.getheader("x-etcd-index"))
+        cluster_id = self.client.expected_cluster_id
+        _log.info("Loading snapshot from etcd cluster %s at index %s, "
+                  "parsing it as it arrives...", cluster_id, snapshot_index)
+        if cluster_id != self.known_cluster_id:
+            # The modifiedIndexes that we know about are meaningless in a
+            # different cluster.  Keep the keys so that we still spot
+            # deletions but force all the values to be re-sent.
+            if self.mod_idx_by_key:
+                _log.warning("etcd cluster ID changed from %s, will re-send "
+                             "all keys.", self.known_cluster_id)
+                self.mod_idx_by_key = dict.fromkeys(self.mod_idx_by_key)
+            self.known_cluster_id = cluster_id
+        batch = UpdateBatch()
+        # Nodes in the batch that we haven't yet sent.  We only record
+        # their modifiedIndexes once the batch has been sent, otherwise a
+        # failed read would cause them to be skipped on the retry.
+        batch_nodes = []
+        seen_keys = set()
+        num_unchanged = 0
+        ready = False
+        try:
+            for node in iter_snapshot_nodes(response):
+                key_type, key_id = parse_key(node.key)
+                if key_type == KEY_TYPE_READY:
+                    # Double-check the flag hasn't changed since we read it
+                    # before.
+                    if node.value != "true":
+                        _log.warning("Aborting resync because ready flag was "
+                                     "unset since we read it.")
+                        response.close()
+                        return None
+                    ready = True
                     continue
-                profile_id, tags = parse_if_tags(response)
-                if profile_id:
-                    _log.info("Scheduling tags update %s", profile_id)
-                    update_splitter.on_tags_update(profile_id, tags,
-                                                   async=False)
+                if key_type not in DATA_KEY_TYPES:
                     continue
-                endpoint_id, endpoint = parse_if_endpoint(self.config,
-                                                          response)
-                if endpoint_id:
-                    _log.info("Scheduling endpoint update %s", endpoint_id)
-                    update_splitter.on_endpoint_update(endpoint_id, endpoint,
-                                                       async=False)
+                seen_keys.add(node.key)
+                if (node.modifiedIndex is not None and
+                        self.mod_idx_by_key.get(node.key) ==
+                        node.modifiedIndex):
+                    # We've already passed on this version of the key.
+                    num_unchanged += 1
                     continue
+                self._add_to_batch(key_type, key_id, node, batch)
+                batch_nodes.append(node)
+                # Hold onto the updates until we've seen the ready flag.
+                if ready and len(batch) >= SNAPSHOT_CHUNK_SIZE:
+                    batch.send(update_splitter)
+                    self._record_keys(batch_nodes)
+                    batch = UpdateBatch()
+                    batch_nodes = []
+            # Read anything trailing the JSON document so that the connection
+            # can be reused.
+            response.read()
+            response.release_conn()
+        except (EtcdException,
+                ijson.JSONError,
+                urllib3.exceptions.HTTPError,
+                httplib.HTTPException,
+                SocketTimeout) as e:
+            _log.error("Failed to read snapshot from etcd: %r. Will retry.",
+                       e)
+            response.close()
+            return None
 
-                if response.key == READY_KEY:
-                    if response.value != "true":
-                        _log.warning("DB became unready, triggering a resync")
-                        continue_polling = False
-                    continue
+        if not ready:
+            _log.warn("Aborting resync; ready flag no longer present.")
+            return None
+
+        # Any keys that we knew about but which weren't in the snapshot must
+        # have been deleted while we were out of sync.
+        deleted_keys = set(self.mod_idx_by_key) - seen_keys
+        _log.info("Snapshot contained %s keys, %s unchanged since our last "
+                  "snapshot, %s keys were deleted.",
+                  len(seen_keys), num_unchanged, len(deleted_keys))
+        for key in deleted_keys:
+            key_type, key_id = parse_key(key)
+            node = EtcdNode("delete", key, None, None)
+            self._add_to_batch(key_type, key_id, node, batch)
+            batch_nodes.append(node)
+        batch.send(update_splitter)
+        self._record_keys(batch_nodes)
+        update_splitter.on_datamodel_in_sync(async=False)
+        return snapshot_index
+
+    def _start_snapshot_read(self):
+        """
+        Issues a recursive GET for the whole data model.  Unlike
+        self.client.read(), doesn't wait for the body of the response;
+        it can then be parsed incrementally.
+
+        :returns: urllib3 HTTPResponse, with the body still to be read.
+        """
+        response = self.client.http.request(
+            "GET",
+            self.client.base_uri + self.client.key_endpoint + VERSION_DIR,
+            fields={"recursive": "true", "sorted": "true"},
+            timeout=Timeout(connect=10, read=90),
+            preload_content=False
+        )
+        if response.status != 200:
+            body = response.data
+            if response.status == httplib.NOT_FOUND:
+                raise EtcdKeyNotFound("%s not found" % VERSION_DIR)
+            raise EtcdException("Snapshot read failed with status %s: %s" %
+                                (response.status, body))
+        # We reconnect before each snapshot so this records the cluster ID
+        # for the polls that follow.
+        cluster_id = response.getheader("x-etcd-cluster-id")
+        expected_id = self.client.expected_cluster_id
+        if expected_id and cluster_id != expected_id:
+            response.close()
+            raise EtcdClusterIdChanged("Cluster ID changed from %s to %s" %
+                                       (expected_id, cluster_id))
+        self.client.expected_cluster_id = cluster_id
+        return response
+
+    def _add_to_batch(self, key_type, key_id, etcd_node, batch):
+        """
+        Parses the given node and, if it is a rules, tags or endpoint key,
+        adds the parsed value to the batch.
+
+        :param key_type: Type of the node's key, as returned by parse_key().
+        :param key_id: ID from the node's key, as returned by parse_key().
+        :returns: True if the node was added to the batch.
+        """
+        if key_type == KEY_TYPE_RULES:
+            batch.rules_by_prof_id[key_id] = parse_rules(key_id, etcd_node,
+                                                         self.rules_cache)
+        elif key_type == KEY_TYPE_TAGS:
+            batch.tags_by_prof_id[key_id] = parse_tags(key_id, etcd_node,
+                                                       self.tags_cache)
+        elif key_type == KEY_TYPE_ENDPOINT:
+            batch.endpoints_by_id[key_id] = parse_endpoint(
+                self.config, key_id, etcd_node, self.endpoint_cache
+            )
+        else:
+            return False
+        return True
+
+    def _record_key(self, etcd_node):
+        if etcd_node.action == "delete":
+            self._forget_key(etcd_node.key)
+        else:
+            self.mod_idx_by_key[etcd_node.key] = etcd_node.modifiedIndex
+            if self.config.SNAPSHOT_CACHE_FILE:
+                self.value_by_key[etcd_node.key] = etcd_node.value
+
+    def _record_keys(self, etcd_nodes):
+        for etcd_node in etcd_nodes:
+            self._record_key(etcd_node)
+
+    def _forget_key(self, key):
+        self.mod_idx_by_key.pop(key, None)
+        self.value_by_key.pop(key, None)
+
+    def _apply_cached_snapshot(self, update_splitter):
+        """
+        Applies the snapshot that load_config() loaded from the on-disk
+        cache, if any, so that we can program the dataplane without waiting
+        for etcd.
+
+        :returns: The etcd index of the cached snapshot or None if there was
+            no usable cache.
+        """
+        snapshot = self.cached_snapshot
+        self.cached_snapshot = None
+        if snapshot is None:
+            return None
+        _log.info("Applying cached snapshot from etcd cluster %s, index %s",
+                  snapshot.cluster_id, snapshot.etcd_index)
+        batch = UpdateBatch()
+        for key, mod_idx, value in snapshot.nodes:
+            node = EtcdNode("get", key, value, mod_idx)
+            key_type, key_id = parse_key(key)
+            if self._add_to_batch(key_type, key_id, node, batch):
+                self._record_key(node)
+        self.known_cluster_id = snapshot.cluster_id
+        self.last_cache_save_time = time.time()
+        # The managers treat snapshot values of None as errors so filter
+        # out anything that failed validation.
+        update_splitter.apply_snapshot(
+            batch.rules_by_prof_id,
+            dict((k, v) for (k, v) in batch.tags_by_prof_id.iteritems()
+                 if v is not None),
+            dict((k, v) for (k, v) in batch.endpoints_by_id.iteritems()
+                 if v is not None),
+            async=False
+        )
+        return snapshot.etcd_index
+
+    def _maybe_save_cache(self, etcd_index, force=False):
+        """
+        Saves our current state to the snapshot cache if it is enabled and
+        we haven't saved it recently.
+
+        :param etcd_index: The etcd index that our state is up-to-date with.
+        :param force: Save even if we saved recently.
+        """
+        if not self.config.SNAPSHOT_CACHE_FILE:
+            return
+        now = time.time()
+        if (not force and now - self.last_cache_save_time <
+                self.config.SNAPSHOT_CACHE_INTERVAL):
+            return
+        if self._cache_saver is not None and not self._cache_saver.ready():
+            if not force:
+                _log.debug("Still saving previous snapshot cache.")
+                return
+            self._cache_saver.join()
+        self.last_cache_save_time = now
+        nodes = [(k, self.mod_idx_by_key[k], v)
+                 for (k, v) in self.value_by_key.iteritems()]
+        snapshot = snapcache.CachedSnapshot(self.known_cluster_id,
+                                            etcd_index,
+                                            self.config_dicts,
+                                            nodes)
+        # Save in the background so that we don't hold up the poll loop.
+        # If forced, we're about to restart so wait for the save.
+        self._cache_saver = gevent.spawn(self._save_cache, snapshot)
+        if force:
+            self._cache_saver.join()
+
+    def _save_cache(self, snapshot):
+        try:
+            snapcache.save(self.config.SNAPSHOT_CACHE_FILE, snapshot)
+        except (IOError, OSError):
+            _log.exception("Failed to save snapshot cache.")
+
+
+def new_etcd_client(host, port, expected_cluster_id):
+    """
+    Creates an etcd client whose connections use TCP keepalives, if
+    supported by our version of urllib3.
+    """
+    client = etcd.Client(host=host, port=port,
+                         expected_cluster_id=expected_cluster_id)
+    if hasattr(urllib3.connection.HTTPConnection, "default_socket_options"):
+        # The pool manager creates its connection pools lazily so this
+        # applies to all the client's connections.
+        client.http.connection_pool_kw["socket_options"] = \
+            _keepalive_socket_options()
+    return client
+
+
+def _keepalive_socket_options():
+    options = list(urllib3.connection.HTTPConnection.default_socket_options)
+    options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    # The fine-grained settings are Linux-specific.
+    for name, value in [("TCP_KEEPIDLE", KEEPALIVE_IDLE_SECS),
+                        ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL_SECS),
+                        ("TCP_KEEPCNT", KEEPALIVE_COUNT)]:
+        if hasattr(socket, name):
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    return options
+
+
+def _sleep_before_retry():
+    """
+    Sleeps for around RETRY_DELAY, with jitter so that many hosts don't
+    retry in lock-step.
+    """
+    gevent.sleep(random.uniform(0.5, 1.5) * RETRY_DELAY)
+
+
+class ResyncScheduler(object):
+    """
+    Decides when we may start a full resync with etcd.
+
+    Each host delays its resyncs by a fixed offset within the configured
+    window, derived from its hostname.  If etcd restarts, causing every
+    host to resync at once, their snapshot reads are spread over the
+    window.  In addition, resyncs are never started more often than once
+    per min_interval.
+    """
+    def __init__(self, hostname, window, min_interval):
+        self.fraction = (zlib.crc32(hostname) & 0xffffffff) / float(2 ** 32)
+        self.offset = self.fraction * window
+        self.min_interval = min_interval
+        self.last_start_time = None
+
+    def set_window(self, window):
+        self.offset = self.fraction * window
+
+    def wait(self, retrying):
+        """
+        Blocks until it's our turn to start a resync.  The initial snapshot
+        isn't delayed.
+
+        :param retrying: True if the previous attempt at this resync
+            failed, in which case we've already waited for our offset.
+        """
+        now = time.time()
+        if self.last_start_time is None:
+            delay = 0
+        else:
+            delay = 0 if retrying else self.offset
+            delay = max(delay,
+                        self.last_start_time + self.min_interval - now)
+        if delay > 0:
+            _log.info("Delaying resync by %.1fs.", delay)
+            gevent.sleep(delay)
+        self.last_start_time = time.time()
+
+
+class SubtreePoller(object):
+    """
+    State of the long poll on one subtree of the data model.  Each subtree
+    tracks its own etcd index so that a noisy subtree (such as the remote
+    hosts' endpoints) doesn't delay the processing of events in another.
+    """
+    def __init__(self, name, prefix, recursive=True, exclude_prefix=None):
+        self.name = name
+        self.prefix = prefix
+        self.recursive = recursive
+        self.exclude_prefix = exclude_prefix
+        self.client = None
+        self.backoff = Backoff(RECONNECT_DELAY_MIN, RECONNECT_DELAY_MAX)
+        # Index of the next event that we're waiting for.
+        self.next_index = None
+        # Number of consecutive unexpected etcd errors.
+        self.poll_failures = 0
+
+    def start_polling(self, start_index, cluster_id):
+        self.next_index = start_index
+        self.poll_failures = 0
+        self.client.expected_cluster_id = cluster_id
+
+    def covers_key(self, key):
+        """
+        :returns: True if the key is in our subtree, False if it's a
+            parent directory.
+        """
+        return _key_in_dir(key, self.prefix)
+
+    def excludes_key(self, key):
+        return (self.exclude_prefix is not None and
+                _key_in_dir(key, self.exclude_prefix))
+
+
+def _key_in_dir(key, dir_key):
+    return key == dir_key or key.startswith(dir_key + "/")
+
+
+class Backoff(object):
+    """
+    Jittered exponential backoff.  Each call to sleep() sleeps for a random
+    time between half and all of the current delay and then doubles the
+    delay, up to the maximum.
+    """
+    def __init__(self, min_delay, max_delay):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = min_delay
+
+    def sleep(self):
+        delay = random.uniform(self.delay / 2.0, self.delay)
+        _log.info("Backing off for %.1fs before retrying.", delay)
+        self.delay = min(self.delay * 2, self.max_delay)
+        gevent.sleep(delay)
+
+    def reset(self):
+        self.delay = self.min_delay
+
+
+class UpdateBatch(object):
+    """
+    Accumulates updates to pass to the UpdateSplitter in a single message.
+    A value of None records a deletion.
+    """
+    def __init__(self):
+        self.rules_by_prof_id = {}
+        self.tags_by_prof_id = {}
+        self.endpoints_by_id = {}
+
+    def __len__(self):
+        return (len(self.rules_by_prof_id) + len(self.tags_by_prof_id) +
+                len(self.endpoints_by_id))
+
+    def send(self, update_splitter):
+        """
+        Sends the batch to the update splitter, blocking until it has been
+        processed.  No-op if the batch is empty.
+        """
+        if len(self):
+            update_splitter.apply_updates(self.rules_by_prof_id,
+                                          self.tags_by_prof_id,
+                                          self.endpoints_by_id,
+                                          async=False)
+
+
+def iter_snapshot_nodes(response):
+    """
+    Incrementally parses the JSON response to a recursive etcd GET.  Yields
+    an EtcdNode for each leaf (i.e. non-directory) node as soon as it has
+    been read.
+
+    :param response: File-like object containing the response.
+    """
+    stack = []
+    field = None
+    for _, event, value in ijson_backend.parse(response):
+        if event == "map_key":
+            field = value
+        elif event == "start_map":
+            stack.append({})
+        elif event == "end_map":
+            node = stack.pop()
+            if "key" in node and not node.get("dir"):
+                yield EtcdNode("get", node["key"], node.get("value"),
+                               node.get("modifiedIndex"))
+        elif stack and event in ("string", "number", "boolean"):
+            stack[-1][field] = value
 
-                _log.debug("Response action: %s, key: %s",
-                           response.action, response.key)
-                if (response.action not in ("set", "create") and
-                        any((response.key.startswith(pfx) for pfx in
-                             PREFIXES_TO_RESYNC_ON_CHANGE))):
-                    # Catch deletions of whole directories or other operations
-                    # that we're not expecting.
-                    _log.warning("Unexpected event: %s; triggering resync.",
-                                 response)
-                    continue_polling = False
-                if response.key.startswith(CONFIG_DIR):
-                    _log.warning("Global config changed but we don't "
-                                 "yet support dynamic config: %s",
-                                 response)
-                if response.key.startswith(self.my_config_dir):
-                    _log.warning("Config for this felix changed but we don't "
-                                 "yet support dynamic config: %s",
-                                 response)
 
 def _build_config_dict(cfg_node):
     """
@@ -345,77 +1130,100 @@ def _build_config_dict(cfg_node):
     return config_dict
 
 
+# Marker for a miss in the parse caches; None is a valid cached value.
+_NOT_CACHED = object()
+
+
 # Intern JSON keys as we load them to reduce occupancy.
 def intern_dict(d):
     return dict((intern(str(k)), v) for k, v in d.iteritems())
 json_decoder = json.JSONDecoder(object_hook=intern_dict)
 
 
-def parse_if_endpoint(config, etcd_node):
-    m = ENDPOINT_KEY_RE.match(etcd_node.key)
-    if m:
-        # Got an endpoint.
-        host = m.group("hostname")
-        orch = m.group("orchestrator")
-        workload_id = m.group("workload_id")
-        endpoint_id = m.group("endpoint_id")
-        if etcd_node.action == "delete":
-            _log.debug("Found deleted endpoint %s", endpoint_id)
-            endpoint = None
-        else:
-            endpoint = json_decoder.decode(etcd_node.value)
-            try:
-                common.validate_endpoint(config, endpoint)
-            except ValidationFailed as e:
-                _log.warning("Validation failed for endpoint %s, treating as "
-                             "missing: %s", endpoint_id, e.message)
-                endpoint = None
-            else:
-                _log.debug("Validated endpoint : %s", endpoint)
-        return EndpointId(host, orch, workload_id, endpoint_id), endpoint
-    return None, None
+def parse_endpoint(config, endpoint_id, etcd_node, cache):
+    """
+    :param EndpointId endpoint_id: ID of the endpoint, as returned by
+        parse_key().
+    :param BoundedCache cache: Cache of previously-parsed endpoints, keyed
+        on the raw JSON.
+    :returns: the validated endpoint dict or None if the endpoint was
+        deleted or is invalid.  The dict may be shared and must not be
+        modified.
+    """
+    if etcd_node.action == "delete":
+        _log.debug("Found deleted endpoint %s", endpoint_id)
+        return None
+    endpoint = cache.get(etcd_node.value, _NOT_CACHED)
+    if endpoint is not _NOT_CACHED:
+        _log.debug("Found cached endpoint %s: %s", endpoint_id, endpoint)
+        return endpoint
+    endpoint = json_decoder.decode(etcd_node.value)
+    try:
+        common.validate_endpoint(config, endpoint)
+    except ValidationFailed as e:
+        _log.warning("Validation failed for endpoint %s, treating as "
+                     "missing: %s", endpoint_id, e.message)
+        endpoint = None
+    else:
+        _log.debug("Validated endpoint : %s", endpoint)
+    cache[etcd_node.value] = endpoint
+    return endpoint
 
 
-def parse_if_rules(etcd_node):
-    m = RULES_KEY_RE.match(etcd_node.key)
-    if m:
-        # Got some rules.
-        profile_id = m.group("profile_id")
-        if etcd_node.action == "delete":
+def parse_rules(profile_id, etcd_node, cache):
+    """
+    :param BoundedCache cache: Cache of previously-parsed rules, keyed on
+        the raw JSON.  Profiles with identical rules share the cached
+        rule lists.
+    :returns: the validated rules dict or None if the rules were deleted or
+        are invalid.  The rule lists may be shared and must not be
+        modified.
+    """
+    if etcd_node.action == "delete":
+        _log.debug("Found deleted rules for profile %s", profile_id)
+        return None
+    rules = cache.get(etcd_node.value, _NOT_CACHED)
+    if rules is _NOT_CACHED:
+        rules = json_decoder.decode(etcd_node.value)
+        try:
+            common.validate_rules(rules)
+        except ValidationFailed:
+            _log.exception("Validation failed for profile %s rules: %s",
+                           profile_id, rules)
             rules = None
-        else:
-            rules = json_decoder.decode(etcd_node.value)
-            rules["id"] = profile_id
-            try:
-                common.validate_rules(rules)
-            except ValidationFailed:
-                _log.exception("Validation failed for profile %s rules: %s",
-                               profile_id, rules)
-                return profile_id, None
+        cache[etcd_node.value] = rules
+    if rules is None:
+        return None
+    # The cached copy is shared between profiles so add the ID to a
+    # shallow copy.
+    rules = dict(rules, id=profile_id)
 
-        _log.debug("Found rules for profile %s : %s", profile_id, rules)
+    _log.debug("Found rules for profile %s : %s", profile_id, rules)
 
-        return profile_id, rules
-    return None, None
+    return rules
 
 
-def parse_if_tags(etcd_node):
-    m = TAGS_KEY_RE.match(etcd_node.key)
-    if m:
-        # Got some tags.
-        profile_id = m.group("profile_id")
-        if etcd_node.action == "delete":
+def parse_tags(profile_id, etcd_node, cache):
+    """
+    :param BoundedCache cache: Cache of previously-parsed tags, keyed on
+        the raw JSON.
+    :returns: the validated list of tags or None if the tags were deleted or
+        are invalid.  The list may be shared and must not be modified.
+    """
+    if etcd_node.action == "delete":
+        _log.debug("Found deleted tags for profile %s", profile_id)
+        return None
+    tags = cache.get(etcd_node.value, _NOT_CACHED)
+    if tags is _NOT_CACHED:
+        tags = json_decoder.decode(etcd_node.value)
+        try:
+            common.validate_tags(tags)
+        except ValidationFailed:
+            _log.exception("Validation failed for profile %s tags : %s",
+                           profile_id, tags)
             tags = None
-        else:
-            tags = json_decoder.decode(etcd_node.value)
-            try:
-                common.validate_tags(tags)
-            except ValidationFailed:
-                _log.exception("Validation failed for profile %s tags : %s",
-                               profile_id, tags)
-                return profile_id, None
+        cache[etcd_node.value] = tags
 
-        _log.debug("Found tags for profile %s : %s", profile_id, tags)
+    _log.debug("Found tags for profile %s : %s", profile_id, tags)
 
-        return profile_id, tags
-    return None, None
+    return tags
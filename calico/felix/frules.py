@@ -41,6 +41,17 @@ CHAIN_FROM_ENDPOINT = FELIX_PREFIX + "FROM-ENDPOINT"
 CHAIN_TO_PREFIX = FELIX_PREFIX + "to-"
 CHAIN_FROM_PREFIX = FELIX_PREFIX + "from-"
 CHAIN_PROFILE_PREFIX = FELIX_PREFIX + "p-"
+CHAIN_PROFILE_ACCEPT = FELIX_PREFIX + "PROFILE-ACCEPT"
+
+# Packet mark bits used by endpoints with several profiles.  Their endpoint
+# chains set MULTI_PROFILE_MARK and call each profile chain in turn.  A
+# profile chain that allows the packet sets ACCEPT_MARK (and clears
+# MULTI_PROFILE_MARK); one that doesn't returns, rather than dropping the
+# packet, only if MULTI_PROFILE_MARK is set.  Single-profile endpoint chains
+# "--goto" their profile chain, which then behaves as it always has.
+ACCEPT_MARK = "0x1000000"
+MULTI_PROFILE_MARK = "0x2000000"
+PROFILE_MARK_MASK = "0x3000000"
 
 
 def profile_to_chain_name(inbound_or_outbound, profile_id):
@@ -91,8 +102,19 @@ def install_global_rules(config, v4_filter_updater, v6_filter_updater,
 
     # Now the filter table. This needs to have calico-filter-FORWARD and
     # calico-filter-INPUT chains, which we must create before adding any
-    # rules that send to them.
+    # rules that send to them.  The profile chains "--goto" the
+    # felix-PROFILE-ACCEPT chain to mark packets that they allow.
     for iptables_updater in [v4_filter_updater, v6_filter_updater]:
+        iptables_updater.rewrite_chains(
+            {
+                CHAIN_PROFILE_ACCEPT: [
+                    "--append %s --jump MARK --set-mark %s/%s" %
+                        (CHAIN_PROFILE_ACCEPT, ACCEPT_MARK,
+                         PROFILE_MARK_MASK),
+                ],
+            },
+            {},
+            async=False)
         iptables_updater.rewrite_chains(
             {
                 CHAIN_FORWARD: [
@@ -127,7 +149,14 @@ def install_global_rules(config, v4_filter_updater, v6_filter_updater,
 
 def rules_to_chain_rewrite_lines(chain_name, rules, ip_version, tag_to_ipset,
                                  on_allow="ACCEPT", on_deny="DROP",
-                                 comment_tag=None):
+                                 comment_tag=None, return_mark=None):
+    """
+    Convert a list of rules to the iptables fragments for the given chain.
+
+    :param str return_mark: If set, packets that match none of the rules
+           return from the chain if they carry this mark, instead of hitting
+           the default DROP rule.
+    """
     fragments = []
     for r in rules:
         rule_version = r.get('ip_version')
@@ -137,6 +166,10 @@ def rules_to_chain_rewrite_lines(chain_name, rules, ip_version, tag_to_ipset,
                                                         tag_to_ipset,
                                                         on_allow=on_allow,
                                                         on_deny=on_deny))
+    if return_mark:
+        fragments.append("--append %s --match mark --mark %s/%s "
+                         "--jump RETURN" %
+                         (chain_name, return_mark, return_mark))
     tag_part = " (%s)" % comment_tag if comment_tag else ""
     fragments.append(commented_drop_fragment(
         chain_name,
@@ -164,7 +197,7 @@ def rule_to_iptables_fragments(chain_name, rule, ip_version, tag_to_ipset,
            --append)
     :param dict[str,str|list|int] rule: Rule dict.
     :param str on_allow: iptables action to use when the rule allows traffic.
-           For example: "ACCEPT" or "RETURN".
+           For example: "ACCEPT" or "RETURN", or "--goto <chain>".
     :param str on_deny: iptables action to use when the rule denies traffic.
            For example: "DROP".
     :return list[str]: iptables --append fragments.
@@ -241,7 +274,7 @@ def _rule_to_iptables_fragment(chain_name, rule, ip_version, tag_to_ipset,
            --append)
     :param dict[str,str|list|int] rule: Rule dict.
     :param str on_allow: iptables action to use when the rule allows traffic.
-           For example: "ACCEPT" or "RETURN".
+           For example: "ACCEPT" or "RETURN", or "--goto <chain>".
     :param str on_deny: iptables action to use when the rule denies traffic.
            For example: "DROP".
     :returns list[str]: list of iptables --append fragments.
@@ -316,8 +349,12 @@ def _rule_to_iptables_fragment(chain_name, rule, ip_version, tag_to_ipset,
             append("--match icmp6", "--icmpv6-type", icmp_filter)
 
     # Add the action
-    append("--jump", on_allow if rule.get("action", "allow") == "allow"
-                              else on_deny)
+    action = (on_allow if rule.get("action", "allow") == "allow"
+              else on_deny)
+    if action.startswith("--goto "):
+        append(action)
+    else:
+        append("--jump", action)
 
     return " ".join(str(x) for x in update_fragments)
 
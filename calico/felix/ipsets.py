@@ -23,6 +23,7 @@ from collections import defaultdict
 
 import logging
 
+from calico.common import endpoint_profile_ids
 from calico.felix import futils
 from calico.felix.futils import IPV4, IPV6, FailedSystemCall
 from calico.felix.actor import actor_message
@@ -36,13 +37,17 @@ IPSET_TMP_PREFIX = { IPV4: FELIX_PFX+"tmp-v4-", IPV6: FELIX_PFX+"tmp-v6-" }
 
 
 class IpsetManager(ReferenceManager):
-    def __init__(self, ip_type):
+    def __init__(self, ip_type, multiplex_objects=False, grace_period=0):
         """
         Manages all the ipsets for tags for either IPv4 or IPv6.
 
         :param ip_type: IP type (IPV4 or IPV6)
+        :param multiplex_objects: Run the ActiveIpsets on our greenlet.
+        :param grace_period: Seconds for which we keep unreferenced ipsets.
         """
-        super(IpsetManager, self).__init__(qualifier=ip_type)
+        super(IpsetManager, self).__init__(
+            qualifier=ip_type, multiplex_objects=multiplex_objects,
+            grace_period=grace_period)
 
         self.ip_type = ip_type
 
@@ -133,6 +138,26 @@ class IpsetManager(ReferenceManager):
         _log.info("Tags snapshot applied: %s tags, %s endpoints",
                   len(tags_by_prof_id), len(endpoints_by_id))
 
+    @actor_message()
+    def apply_updates(self, tags_by_prof_id, endpoints_by_id):
+        """
+        Applies a batch of updates.  Unlike apply_snapshot(), items that are
+        missing from the batch are left alone.
+
+        :param dict tags_by_prof_id: Map from profile ID to new list of
+            tags or None if the tags were deleted.
+        :param dict endpoints_by_id: Map from EndpointId to new endpoint
+            dict or None if the endpoint was deleted.
+        """
+        _log.info("Applying batch of updates: %s tags, %s endpoints",
+                  len(tags_by_prof_id), len(endpoints_by_id))
+        for profile_id, tags in tags_by_prof_id.iteritems():
+            self.on_tags_update(profile_id, tags)
+            self._maybe_yield()
+        for endpoint_id, endpoint in endpoints_by_id.iteritems():
+            self.on_endpoint_update(endpoint_id, endpoint)
+            self._maybe_yield()
+
     @actor_message()
     def cleanup(self):
         """
@@ -193,7 +218,11 @@ class IpsetManager(ReferenceManager):
         for endpoint_id in endpoint_ids:
             endpoint = self.endpoints_by_ep_id.get(endpoint_id, {})
             ip_addrs = self._extract_ips(endpoint)
-            for tag_id in removed_tags:
+            # The endpoint keeps any tags that its other profiles provide.
+            other_prof_ids = set(endpoint_profile_ids(endpoint))
+            other_prof_ids.discard(profile_id)
+            other_tags = self._tags_for_profiles(other_prof_ids)
+            for tag_id in removed_tags - other_tags:
                 for ip in ip_addrs:
                     self._remove_mapping(tag_id, endpoint_id, ip)
             for tag_id in added_tags:
@@ -206,6 +235,15 @@ class IpsetManager(ReferenceManager):
         else:
             self.tags_by_prof_id[profile_id] = tags
 
+    def _tags_for_profiles(self, prof_ids):
+        """
+        :returns: the set of tags provided by any of the given profiles.
+        """
+        tags = set()
+        for prof_id in prof_ids:
+            tags.update(self.tags_by_prof_id.get(prof_id, []))
+        return tags
+
     def _extract_ips(self, endpoint):
         if endpoint is None:
             return set()
@@ -224,7 +262,7 @@ class IpsetManager(ReferenceManager):
         """
 
         # Endpoint updates are the most complex to handle because they may
-        # change the profile ID (and hence the set of tags) as well as the
+        # change the profile IDs (and hence the set of tags) as well as the
         # ip addresses attached to the interface.  In addition, the endpoint
         # may or may not have existed before.
         #
@@ -234,27 +272,26 @@ class IpsetManager(ReferenceManager):
         # when we calculate removed_tags, we'll get the empty set and the
         # removal loop will be skipped.
         old_endpoint = self.endpoints_by_ep_id.get(endpoint_id, {})
-        old_prof_id = old_endpoint.get("profile_id")
-        if old_prof_id:
-            old_tags = set(self.tags_by_prof_id.get(old_prof_id, []))
-        else:
-            old_tags = set()
+        old_prof_ids = set(endpoint_profile_ids(old_endpoint))
+        old_tags = self._tags_for_profiles(old_prof_ids)
 
         if endpoint is None:
             _log.debug("Deletion, setting new_tags to empty.")
-            new_prof_id = None
+            new_prof_ids = set()
             new_tags = set()
         else:
             _log.debug("Add/update, setting new_tags to indexed value.")
-            new_prof_id = endpoint.get("profile_id")
-            new_tags = set(self.tags_by_prof_id.get(new_prof_id, []))
-
-        if new_prof_id != old_prof_id:
-            # Profile ID changed, or an add/delete.  the _xxx_profile_index
-            # methods ignore profile_id == None so we'll do the right thing.
-            _log.debug("Profile ID changed from %s to %s")
-            self._remove_profile_index(old_prof_id, endpoint_id)
-            self._add_profile_index(new_prof_id, endpoint_id)
+            new_prof_ids = set(endpoint_profile_ids(endpoint))
+            new_tags = self._tags_for_profiles(new_prof_ids)
+
+        if new_prof_ids != old_prof_ids:
+            # Profile IDs changed, or an add/delete.
+            _log.debug("Profile IDs changed from %s to %s",
+                       old_prof_ids, new_prof_ids)
+            for prof_id in old_prof_ids - new_prof_ids:
+                self._remove_profile_index(prof_id, endpoint_id)
+            for prof_id in new_prof_ids - old_prof_ids:
+                self._add_profile_index(prof_id, endpoint_id)
 
         # Since we've defaulted new/old_tags to set() if needed, we can
         # use set operations to calculate the tag changes.
@@ -285,6 +322,11 @@ class IpsetManager(ReferenceManager):
             for ip in new_ips:
                 self._add_mapping(tag, endpoint_id, ip)
 
+        if endpoint is None:
+            self.endpoints_by_ep_id.pop(endpoint_id, None)
+        else:
+            self.endpoints_by_ep_id[endpoint_id] = endpoint
+
         _log.info("Endpoint update complete")
 
     def _add_mapping(self, tag_id, endpoint_id, ip_address):
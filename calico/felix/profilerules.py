@@ -22,7 +22,8 @@ ProfileRules actor, handles local profile chains.
 import logging
 from calico.felix.actor import actor_message
 from calico.felix.frules import (profile_to_chain_name,
-                                 rules_to_chain_rewrite_lines)
+                                 rules_to_chain_rewrite_lines,
+                                 CHAIN_PROFILE_ACCEPT, MULTI_PROFILE_MARK)
 from calico.felix.refcount import ReferenceManager, RefCountedActor, RefHelper
 
 _log = logging.getLogger(__name__)
@@ -37,8 +38,11 @@ class RulesManager(ReferenceManager):
     This class ensures that rules chains are properly quiesced
     before their Actors are deleted.
     """
-    def __init__(self, ip_version, iptables_updater, ipset_manager):
-        super(RulesManager, self).__init__(qualifier="v%d" % ip_version)
+    def __init__(self, ip_version, iptables_updater, ipset_manager,
+                 multiplex_objects=False, grace_period=0):
+        super(RulesManager, self).__init__(
+            qualifier="v%d" % ip_version, multiplex_objects=multiplex_objects,
+            grace_period=grace_period)
         self.ip_version = ip_version
         self.iptables_updater = iptables_updater
         self.ipset_manager = ipset_manager
@@ -68,8 +72,29 @@ class RulesManager(ReferenceManager):
         for dead_profile_id in missing_ids:
             self.on_rules_update(dead_profile_id, None)
 
+    @actor_message()
+    def apply_updates(self, rules_by_profile_id):
+        """
+        Applies a batch of updates.  Unlike apply_snapshot(), profiles that
+        are missing from the batch are left alone.
+
+        :param dict rules_by_profile_id: Map from profile ID to new rules
+            dict or None if the rules were deleted.
+        """
+        _log.info("Rules manager applying batch of %s updates",
+                  len(rules_by_profile_id))
+        for profile_id, profile in rules_by_profile_id.iteritems():
+            self.on_rules_update(profile_id, profile)  # Skips queue
+            self._maybe_yield()
+
     @actor_message()
     def on_rules_update(self, profile_id, profile):
+        if (profile_id in self.rules_by_profile_id and
+                self.rules_by_profile_id[profile_id] == profile):
+            # For example, a snapshot that follows an update that we've
+            # already seen.  Avoid reprogramming the chains.
+            _log.debug("Rules for profile %s unchanged.", profile_id)
+            return
         if profile_id is not None:
             _log.info("Rules for profile %s updated.", profile_id)
             self.rules_by_profile_id[profile_id] = profile
@@ -86,6 +111,11 @@ class RulesManager(ReferenceManager):
 class ProfileRules(RefCountedActor):
     """
     Actor that owns the per-profile rules chains.
+
+    The chains mark the packets that their rules allow and return.  Packets
+    that match none of the rules are dropped, unless they come from the
+    chain of an endpoint with several profiles, in which case they return
+    unmarked so that the endpoint chain can try its next profile.
     """
     def __init__(self, profile_id, ip_version, iptables_updater, ipset_mgr):
         super(ProfileRules, self).__init__(qualifier=profile_id)
@@ -147,6 +177,12 @@ class ProfileRules(RefCountedActor):
             _log.info("Ready to program rules for %s", self.id)
             self._update_chains()
 
+    def _finish_msg_batch(self, batch, results):
+        # Send the increfs/decrefs for the batch's tag changes in bulk.
+        if self.ipset_refs is not None:
+            self.ipset_refs.flush()
+        super(ProfileRules, self)._finish_msg_batch(batch, results)
+
     @actor_message()
     def on_unreferenced(self):
         """
@@ -189,11 +225,14 @@ class ProfileRules(RefCountedActor):
                 new_rules,
                 self.ip_version,
                 tag_to_ip_set_name,
-                on_allow="RETURN",
-                comment_tag=self.id)
+                on_allow="--goto %s" % CHAIN_PROFILE_ACCEPT,
+                comment_tag=self.id,
+                return_mark=MULTI_PROFILE_MARK)
         _log.debug("Queueing programming for rules %s: %s", self.id,
                    updates)
-        self._iptables_updater.rewrite_chains(updates, {}, async=False)
+        deps = dict((chain_name, set([CHAIN_PROFILE_ACCEPT]))
+                    for chain_name in updates)
+        self._iptables_updater.rewrite_chains(updates, deps, async=False)
         # TODO Isolate exceptions from programming the chains to this profile.
         # Radical thought - could we just say that the profile should be OK,
         # and therefore we don't care? In other words, do we need to handle the
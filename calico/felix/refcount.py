@@ -3,11 +3,19 @@ import collections
 import functools
 
 import logging
+import time
 import weakref
+
+import gevent
+
 from calico.felix.actor import Actor, actor_message
 
 _log = logging.getLogger(__name__)
 
+# Maximum number of unreferenced objects that a ReferenceManager keeps warm
+# during their grace period.
+MAX_WARM_OBJECTS = 1000
+
 # States that a reference-counted actor can be in.
 
 # Initial state, created but not yet started.  May stay in this state if
@@ -35,13 +43,38 @@ class ReferenceManager(Actor):
 
     Users who obtain a reference through get_and_incref() must stop
     using the reference before calling decref().
+
+    If multiplex_objects is set, the Actors are started on this Actor's
+    greenlet (see Actor.start_on()) instead of getting greenlets of their
+    own.
+
+    If grace_period is set, LIVE Actors whose reference count drops to zero
+    are kept "warm" for that many seconds before they are told to clean
+    up, so that a new reference can revive them without rebuilding their
+    dataplane state.  Warm Actors keep receiving updates.  At most
+    max_warm_objects are kept warm; the least recently unreferenced are
+    cleaned up first.
     """
 
-    def __init__(self, qualifier=None):
+    def __init__(self, qualifier=None, multiplex_objects=False,
+                 grace_period=0):
         super(ReferenceManager, self).__init__(qualifier=qualifier)
+        self.multiplex_objects = multiplex_objects
+        self.grace_period = grace_period
+        self.max_warm_objects = MAX_WARM_OBJECTS
+        # Map from ID to expiry time of the unreferenced objects that we're
+        # keeping warm.
+        self._warm_objects = {}
+        # Queue of (expiry time, ID) of the warm objects, oldest first.  It
+        # may also hold stale entries for objects that have been revived.
+        self._warm_queue = collections.deque()
+        self._expiry_scheduled = False
         self.objects_by_id = {}
         self.stopping_objects_by_id = collections.defaultdict(set)
         self.pending_ref_callbacks = collections.defaultdict(set)
+        # List of (set of object IDs, callback) pairs for callers of
+        # notify_when_programmed() that are waiting for objects to start.
+        self._programming_waiters = []
 
     @actor_message()
     def get_and_incref(self, object_id, callback=None):
@@ -53,6 +86,37 @@ class ReferenceManager(Actor):
         _log.debug("Request for object %s", object_id)
         assert object_id is not None
 
+        if callback:
+            self.pending_ref_callbacks[object_id].add(callback)
+        self._incref(object_id)
+
+    @actor_message()
+    def get_and_incref_many(self, object_ids, callback):
+        """
+        Acquire references to several ref-counted Actors at once.  Saves a
+        message per object compared to get_and_incref().
+
+        :param object_ids: iterable of the IDs of the Actors to retrieve.
+        :param callback: callback, receives a dict mapping object ID to
+            object once all the objects are available.
+        """
+        object_ids = set(object_ids)
+        _log.debug("Request for %s objects", len(object_ids))
+        if not object_ids:
+            callback({})
+            return
+        multi_callback = _MultiRefCallback(object_ids, callback)
+        for object_id in object_ids:
+            self.get_and_incref(object_id, callback=multi_callback)
+
+    def _incref(self, object_id):
+        """
+        Increments the reference count of the given object, creating and
+        starting it if needed.
+        """
+        if self._warm_objects.pop(object_id, None) is not None:
+            _log.info("%s reviving unreferenced object %s", self.name,
+                      object_id)
         if object_id not in self.objects_by_id:
             _log.info("%s object with id %s didn't exist, creating it.",
                       self.name, object_id)
@@ -66,8 +130,6 @@ class ReferenceManager(Actor):
                       "state %s; increffing it.", self.name, object_id,
                       obj.ref_count, obj.ref_mgmt_state)
 
-        if callback:
-            self.pending_ref_callbacks[object_id].add(callback)
         obj.ref_count += 1
         _log.debug("Reference count for %s object %s is %d",
                    self.name, object_id, obj.ref_count)
@@ -101,6 +163,46 @@ class ReferenceManager(Actor):
         _log.info("Object %s startup completed", object_id)
         obj.ref_mgmt_state = LIVE
         self._maybe_notify_referrers(object_id)
+        self._on_object_programmed(object_id)
+
+    @actor_message()
+    def notify_when_programmed(self, callback):
+        """
+        Calls the callback, from this actor's greenlet, once all the objects
+        that are currently referenced have completed their startup, i.e.
+        have programmed the dataplane.  Objects that are referenced after
+        this call aren't waited for.
+
+        :param callback: callback, takes no arguments.
+        """
+        waiting_ids = set(obj_id for (obj_id, obj) in
+                          self.objects_by_id.iteritems()
+                          if obj.ref_mgmt_state != LIVE)
+        _log.info("%s waiting for %s objects to be programmed", self.name,
+                  len(waiting_ids))
+        self._programming_waiters.append((waiting_ids, callback))
+        self._on_object_programmed(None)
+
+    def _on_object_programmed(self, object_id):
+        """
+        Notes that the given object no longer needs to be waited for and
+        calls back any callers of notify_when_programmed() that have
+        nothing left to wait for.
+
+        :param object_id: ID of the object, which is now LIVE or no longer
+            referenced, or None to just check for waiters that are done.
+        """
+        if not self._programming_waiters:
+            return
+        still_waiting = []
+        for waiting_ids, callback in self._programming_waiters:
+            waiting_ids.discard(object_id)
+            if waiting_ids:
+                still_waiting.append((waiting_ids, callback))
+            else:
+                _log.info("%s objects programmed, calling back", self.name)
+                callback()
+        self._programming_waiters = still_waiting
 
     @actor_message()
     def decref(self, object_id):
@@ -116,15 +218,96 @@ class ReferenceManager(Actor):
                    self.name, object_id, obj.ref_count)
         if obj.ref_count == 0:
             _log.debug("No more references to object with id %s", object_id)
-            if obj.ref_mgmt_state == CREATED:
-                _log.debug("%s was never started, discarding", obj)
+            if self.grace_period > 0 and obj.ref_mgmt_state == LIVE:
+                _log.debug("Keeping %s warm for %ss", obj, self.grace_period)
+                expiry = time.time() + self.grace_period
+                self._warm_objects[object_id] = expiry
+                self._warm_queue.append((expiry, object_id))
+                self._trim_warm_objects()
             else:
-                _log.debug("%s is running, cleaning it up", obj)
-                obj.ref_mgmt_state = STOPPING
-                obj.on_unreferenced(async=True)
-                self.stopping_objects_by_id[object_id].add(obj)
-            self.objects_by_id.pop(object_id)
-            self.pending_ref_callbacks.pop(object_id, None)
+                self._discard_object(object_id)
+
+    def _discard_object(self, object_id):
+        """
+        Removes an object that has no references, telling it to clean up
+        if it was started.
+        """
+        obj = self.objects_by_id.pop(object_id)
+        if obj.ref_mgmt_state == CREATED:
+            _log.debug("%s was never started, discarding", obj)
+        else:
+            _log.debug("%s is running, cleaning it up", obj)
+            obj.ref_mgmt_state = STOPPING
+            obj.on_unreferenced(async=True)
+            self.stopping_objects_by_id[object_id].add(obj)
+        self.pending_ref_callbacks.pop(object_id, None)
+        self._on_object_programmed(object_id)
+
+    def _trim_warm_objects(self):
+        """
+        Discards warm objects beyond our limit, oldest first, and makes
+        sure that the rest will be discarded when they expire.
+        """
+        while len(self._warm_objects) > self.max_warm_objects:
+            _, object_id = self._pop_oldest_warm_object()
+            _log.info("Too many unreferenced objects, discarding %s",
+                      object_id)
+            self._discard_object(object_id)
+        oldest = self._oldest_warm_object()
+        if oldest is not None and not self._expiry_scheduled:
+            delay = max(oldest[0] - time.time(), 0)
+            gevent.spawn_later(delay, self.expire_warm_objects, async=True)
+            self._expiry_scheduled = True
+
+    @actor_message()
+    def expire_warm_objects(self):
+        """
+        Discards the warm objects whose grace period has expired.
+        """
+        self._expiry_scheduled = False
+        now = time.time()
+        while True:
+            oldest = self._oldest_warm_object()
+            if oldest is None or oldest[0] > now:
+                break
+            _, object_id = self._pop_oldest_warm_object()
+            _log.info("Grace period of %s expired, discarding it",
+                      object_id)
+            self._discard_object(object_id)
+        self._trim_warm_objects()
+
+    def _oldest_warm_object(self):
+        """
+        :returns: (expiry time, ID) of the oldest warm object or None if
+            there are none.
+        """
+        while self._warm_queue:
+            expiry, object_id = self._warm_queue[0]
+            if self._warm_objects.get(object_id) == expiry:
+                return expiry, object_id
+            # The object was revived since it was queued.
+            self._warm_queue.popleft()
+        return None
+
+    def _pop_oldest_warm_object(self):
+        """
+        Stops keeping the oldest warm object warm.
+
+        :returns: (expiry time, ID) of the object.
+        """
+        expiry, object_id = self._oldest_warm_object()
+        self._warm_queue.popleft()
+        del self._warm_objects[object_id]
+        return expiry, object_id
+
+    @actor_message()
+    def decref_many(self, object_ids):
+        """
+        Return several references at once; equivalent to calling decref()
+        for each ID.
+        """
+        for object_id in object_ids:
+            self.decref(object_id)
 
     @actor_message()
     def on_object_cleanup_complete(self, object_id, obj):
@@ -151,7 +334,10 @@ class ReferenceManager(Actor):
                 obj_id not in self.stopping_objects_by_id):
             _log.info("%s Starting object %s", self.name, obj_id)
             obj.ref_mgmt_state = STARTING
-            obj.start()
+            if self.multiplex_objects:
+                obj.start_on(self)
+            else:
+                obj.start()
             self._on_object_started(obj_id, obj)
         elif obj_id in self.stopping_objects_by_id:
             _log.info("Cannot start object %s because we're waiting for an "
@@ -200,6 +386,24 @@ class ReferenceManager(Actor):
                     (STARTING, LIVE))
 
 
+class _MultiRefCallback(object):
+    """
+    Callback for each of the objects requested by a call to
+    get_and_incref_many(), calls back the requester once it has been
+    called for all of them.
+    """
+    def __init__(self, object_ids, callback):
+        self.waiting_ids = set(object_ids)
+        self.objects_by_id = {}
+        self.callback = callback
+
+    def __call__(self, object_id, obj):
+        self.waiting_ids.discard(object_id)
+        self.objects_by_id[object_id] = obj
+        if not self.waiting_ids:
+            self.callback(self.objects_by_id)
+
+
 class RefHelper(object):
     """
     Helper class for a clients of a ReferenceManager that need to
@@ -208,6 +412,9 @@ class RefHelper(object):
 
     Note: this helper piggy-backs on the actor's message queue
     in order to receive callbacks from the ReferenceManager.
+
+    The increfs and decrefs are queued up and sent in bulk by flush(),
+    which the actor should call at the end of each batch of messages.
     """
 
     def __init__(self, actor, ref_mgr, ready_callback):
@@ -238,6 +445,10 @@ class RefHelper(object):
         """
         Mapping from object ID to object that we've acquired.
         """
+        self._ids_to_incref = set()
+        """IDs that we need to request on the next flush()."""
+        self._ids_to_decref = set()
+        """IDs that we need to return on the next flush()."""
 
     def acquire_ref(self, obj_id):
         """
@@ -249,10 +460,9 @@ class RefHelper(object):
             self.required_refs.add(obj_id)
             if obj_id not in self.pending_increfs:
                 # We're not already asking for the ref, request it.
-                _log.debug("Increffing object %s", obj_id)
-                cb = functools.partial(self.on_ref_acquired, async=True)
+                _log.debug("Queueing incref of object %s", obj_id)
                 self.pending_increfs.add(obj_id)
-                self._ref_mgr.get_and_incref(obj_id, callback=cb, async=True)
+                self._ids_to_incref.add(obj_id)
 
     def discard_ref(self, obj_id):
         """
@@ -265,33 +475,58 @@ class RefHelper(object):
             # away (if we've acquired it).
             self.required_refs.remove(obj_id)
             self.acquired_refs.pop(obj_id, None)
-            if obj_id not in self.pending_increfs:
+            if obj_id in self._ids_to_incref:
+                # We haven't asked for it yet, no need to.
+                self._ids_to_incref.remove(obj_id)
+                self.pending_increfs.remove(obj_id)
+            elif obj_id not in self.pending_increfs:
                 # Only decref after we've actually acquired the ref.  This
                 # avoids a lot of complexity in managing multiple outstanding
                 # callbacks.
-                _log.debug("Decreffing object %s", obj_id)
-                self._ref_mgr.decref(obj_id, async=True)
+                _log.debug("Queueing decref of object %s", obj_id)
+                self._ids_to_decref.add(obj_id)
 
     def discard_all(self):
         """
-        Discards all references.
+        Discards all references and flushes the decrefs.
         """
         for obj_id in list(self.required_refs):
             self.discard_ref(obj_id)
+        self.flush()
+
+    def flush(self):
+        """
+        Sends the increfs and decrefs that were queued up by acquire_ref()
+        and discard_ref() to the ReferenceManager.
+        """
+        # Increfs go first so that discarding and then re-acquiring a
+        # reference doesn't drop the object's ref count to zero.
+        if self._ids_to_incref:
+            _log.debug("Increffing %s objects", len(self._ids_to_incref))
+            cb = functools.partial(self.on_refs_acquired, async=True)
+            self._ref_mgr.get_and_incref_many(self._ids_to_incref,
+                                              callback=cb, async=True)
+            self._ids_to_incref = set()
+        if self._ids_to_decref:
+            _log.debug("Decreffing %s objects", len(self._ids_to_decref))
+            self._ref_mgr.decref_many(self._ids_to_decref, async=True)
+            self._ids_to_decref = set()
 
     @actor_message()
-    def on_ref_acquired(self, obj_id, obj):
+    def on_refs_acquired(self, objs_by_id):
         was_ready = self.ready
-        self.pending_increfs.discard(obj_id)
-        if obj_id in self.required_refs:
-            # Still required, record it.
-            _log.debug("Reference %s acquired; still required", obj_id)
-            self.acquired_refs[obj_id] = obj
-        else:
-            # Deleted while we were waiting.
-            _log.debug("Object %s was discarded while waiting for its ref",
-                       obj_id)
-            self._ref_mgr.decref(obj_id, async=True)
+        for obj_id, obj in objs_by_id.iteritems():
+            self.pending_increfs.discard(obj_id)
+            if obj_id in self.required_refs:
+                # Still required, record it.
+                _log.debug("Reference %s acquired; still required", obj_id)
+                self.acquired_refs[obj_id] = obj
+            else:
+                # Deleted while we were waiting.
+                _log.debug("Object %s was discarded while waiting for its "
+                           "ref", obj_id)
+                self._ids_to_decref.add(obj_id)
+        self.flush()
         now_ready = self.ready
         if not was_ready and now_ready:
             _log.debug("Acquired all references, calling ready callback")
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.snapcache
+~~~~~~~~~~~~~~~
+
+On-disk cache of the data model that we've loaded from etcd.  Allows Felix
+to program the dataplane at start of day without waiting for a full read
+of the data model from etcd (or during an etcd outage).
+
+The cache is stored in the marshal format, which is compact and very fast
+to load.  Since the marshal format is only stable within a Python version,
+loading an incompatible file simply fails and we fall back to etcd.
+"""
+import logging
+import marshal
+import os
+from collections import namedtuple
+
+import gevent
+
+from calico import common
+
+_log = logging.getLogger(__name__)
+
+# Bump if the contents of the file change incompatibly.
+FORMAT_VERSION = 1
+
+# Contents of the cache.
+#
+# - cluster_id: ID of the etcd cluster that the data came from.
+# - etcd_index: etcd index that the data is up-to-date with.
+# - config: (host_config_dict, global_config_dict) as read from etcd or None
+#   if we don't have a trustworthy copy of the config.
+# - nodes: list of (key, modifiedIndex, value) tuples for the rules, tags and
+#   endpoint keys.
+CachedSnapshot = namedtuple("CachedSnapshot",
+                            ["cluster_id", "etcd_index", "config", "nodes"])
+
+
+def load(path):
+    """
+    Loads the cache from the given file.
+
+    :returns: a CachedSnapshot or None if there is no usable cache.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = marshal.load(f)
+    except IOError as e:
+        _log.info("Unable to open snapshot cache %s: %r", path, e)
+        return None
+    except (EOFError, ValueError, TypeError) as e:
+        _log.warning("Snapshot cache %s is corrupt, ignoring it: %r",
+                     path, e)
+        return None
+    if not isinstance(data, dict) or data.get("version") != FORMAT_VERSION:
+        _log.warning("Snapshot cache %s has unknown format, ignoring it.",
+                     path)
+        return None
+    try:
+        snapshot = CachedSnapshot(data["cluster_id"], data["etcd_index"],
+                                  data["config"], data["nodes"])
+    except KeyError as e:
+        _log.warning("Snapshot cache %s is missing field %s, ignoring it.",
+                     path, e)
+        return None
+    _log.info("Loaded snapshot cache %s: %s keys at etcd index %s.",
+              path, len(snapshot.nodes), snapshot.etcd_index)
+    return snapshot
+
+
+def save(path, snapshot):
+    """
+    Atomically replaces the cache file with the given snapshot.
+
+    Blocks the calling greenlet but not the gevent hub: the snapshot is
+    serialized in memory (which is fast) and then written and fsync'd in
+    gevent's thread pool.
+
+    :param CachedSnapshot snapshot: The snapshot to save.
+    """
+    data = marshal.dumps({
+        "version": FORMAT_VERSION,
+        "cluster_id": snapshot.cluster_id,
+        "etcd_index": snapshot.etcd_index,
+        "config": snapshot.config,
+        "nodes": snapshot.nodes,
+    })
+    gevent.get_hub().threadpool.apply(_write_file, (path, data))
+    _log.info("Saved snapshot cache %s: %s keys at etcd index %s.",
+              path, len(snapshot.nodes), snapshot.etcd_index)
+
+
+def _write_file(path, data):
+    """
+    Atomically replaces the file at path with the given data.  Runs in a
+    thread pool thread so mustn't touch any gevent objects.
+    """
+    common.mkdir_p(os.path.dirname(path))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
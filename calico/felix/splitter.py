@@ -18,14 +18,29 @@ felix.splitter
 ~~~~~~~~~~~~~
 
 Simple object that just splits notifications out for IPv4 and IPv6.
+
+Each family's managers only get the part of an update that affects them:
+rules are filtered by their ip_version, the ipset managers only hear
+about endpoints that have (or had) addresses in their family and the
+endpoint managers only hear about this host's endpoints.
 """
-import functools
 import logging
 import gevent
+import gevent.event
+from calico.common import endpoint_profile_ids
 from calico.felix.actor import Actor, actor_message
+from calico.felix.profilerules import extract_tags_from_profile
 
 _log = logging.getLogger(__name__)
 
+# Maximum time that we wait for this host's endpoints to be programmed
+# before applying the rest of a snapshot.
+MAX_LOCAL_SNAPSHOT_WAIT = 30
+
+# IP versions of the managers in each of the lists that we're given.
+IP_VERSIONS = [4, 6]
+NETS_KEY_BY_IP_VERSION = {4: "ipv4_nets", 6: "ipv6_nets"}
+
 
 class UpdateSplitter(Actor):
     def __init__(self, config, ipsets_mgrs, rules_managers, endpoint_managers,
@@ -37,6 +52,9 @@ class UpdateSplitter(Actor):
         self.rules_mgrs = rules_managers
         self.endpoint_mgrs = endpoint_managers
         self._cleanup_scheduled = False
+        # IDs of the endpoints that we've told each family's ipset manager
+        # about, i.e. the ones that have addresses in that family.
+        self._ipset_ep_ids = dict((v, set()) for v in IP_VERSIONS)
 
     @actor_message()
     def apply_snapshot(self, rules_by_prof_id, tags_by_prof_id,
@@ -44,44 +62,162 @@ class UpdateSplitter(Actor):
         """
         Replaces the whole cache state with the input.  Applies deltas vs the
         current active state.
+
+        Programs this host's endpoints and the profiles and ipsets that they
+        need first, then applies the rest of the snapshot, which is mainly
+        of interest to the ipset managers.
         """
-        # Step 1: fire in data update events to the profile and tag managers
-        # so they can build their indexes before we activate anything.
-        _log.info("Applying snapshot. STAGE 1a: rules.")
-        for rules_mgr in self.rules_mgrs:
-            rules_mgr.apply_snapshot(rules_by_prof_id, async=True)
-        _log.info("Applying snapshot. STAGE 1b: tags.")
-        for ipset_mgr in self.ipsets_mgrs:
-            ipset_mgr.apply_snapshot(tags_by_prof_id, endpoints_by_id,
-                                     async=True)
+        local = local_subset(self.config.HOSTNAME, rules_by_prof_id,
+                             tags_by_prof_id, endpoints_by_id)
+        local_rules, local_tags, local_eps, ipset_eps = local
+
+        # Step 1: fire in the data that the local endpoints need to the
+        # profile and tag managers so they can build their indexes before
+        # we activate anything.
+        _log.info("Applying snapshot. STAGE 1a: %s local rules.",
+                  len(local_rules))
+        for rules_mgr, ip_version in zip(self.rules_mgrs, IP_VERSIONS):
+            rules_mgr.apply_updates(rules_for_ip_version(local_rules,
+                                                         ip_version),
+                                    async=True)
+        _log.info("Applying snapshot. STAGE 1b: %s tags, %s endpoints for "
+                  "local ipsets.", len(local_tags), len(ipset_eps))
+        for ipset_mgr, ip_version in zip(self.ipsets_mgrs, IP_VERSIONS):
+            ipset_mgr.apply_updates(local_tags,
+                                    self._ipset_view(ipset_eps, ip_version),
+                                    async=True)
 
         # Step 2: fire in update events into the endpoint manager, which will
-        # recursively trigger activation of profiles and tags.
-        _log.info("Applying snapshot. STAGE 2: endpoints->endpoint mgr.")
+        # recursively trigger activation of profiles and tags.  The endpoint
+        # manager only cares about local endpoints so this is a complete
+        # snapshot as far as it's concerned.
+        _log.info("Applying snapshot. STAGE 2: %s local endpoints->endpoint "
+                  "mgr.", len(local_eps))
         for ep_mgr in self.endpoint_mgrs:
-            ep_mgr.apply_snapshot(endpoints_by_id, async=True)
+            ep_mgr.apply_snapshot(local_eps, async=True)
+
+        # Step 3: once the local endpoints are programmed, apply the rest.
+        # We wait because the increfs that activate the profiles and ipsets
+        # would otherwise be queued behind the full snapshot.
+        if not self._wait_for_programming(MAX_LOCAL_SNAPSHOT_WAIT):
+            _log.warning("Local endpoints not programmed after %ss, "
+                         "applying rest of snapshot anyway.",
+                         MAX_LOCAL_SNAPSHOT_WAIT)
+        _log.info("Applying snapshot. STAGE 3: all rules and tags.")
+        for rules_mgr, ip_version in zip(self.rules_mgrs, IP_VERSIONS):
+            rules_mgr.apply_snapshot(rules_for_ip_version(rules_by_prof_id,
+                                                          ip_version),
+                                     async=True)
+        for ipset_mgr, ip_version in zip(self.ipsets_mgrs, IP_VERSIONS):
+            # The snapshot replaces everything that the manager knows.
+            self._ipset_ep_ids[ip_version].clear()
+            ipset_mgr.apply_snapshot(tags_by_prof_id,
+                                     self._ipset_view(endpoints_by_id,
+                                                      ip_version),
+                                     async=True)
 
         _log.info("Applying snapshot. DONE. %s rules, %s tags, "
                   "%s endpoints", len(rules_by_prof_id), len(tags_by_prof_id),
                   len(endpoints_by_id))
 
-        # Since we don't wait for all the above processing to finish, set a
-        # timer to clean up orphaned ipsets and tables later.  If the snapshot
-        # takes longer than this timer to apply then we might do the cleanup
-        # before the snapshot is finished.  That would cause dropped packets
-        # until applying the snapshot finishes.
+        self._schedule_cleanup()
+
+    @actor_message()
+    def apply_updates(self, rules_by_prof_id, tags_by_prof_id,
+                      endpoints_by_id):
+        """
+        Applies a batch of updates, such as a chunk of a snapshot that is
+        being streamed from etcd.  Items that are not mentioned in the batch
+        are left alone; a value of None indicates a deletion.
+
+        Waits for the managers to process the batch before returning so
+        that a fast producer can't fill up their queues.
+        """
+        _log.info("Applying batch of updates: %s rules, %s tags, "
+                  "%s endpoints", len(rules_by_prof_id), len(tags_by_prof_id),
+                  len(endpoints_by_id))
+        results = []
+        if rules_by_prof_id:
+            for rules_mgr, ip_version in zip(self.rules_mgrs, IP_VERSIONS):
+                rules = rules_for_ip_version(rules_by_prof_id, ip_version)
+                results.append(rules_mgr.apply_updates(rules, async=True))
+        for ipset_mgr, ip_version in zip(self.ipsets_mgrs, IP_VERSIONS):
+            ipset_eps = self._ipset_view(endpoints_by_id, ip_version)
+            if tags_by_prof_id or ipset_eps:
+                results.append(ipset_mgr.apply_updates(tags_by_prof_id,
+                                                       ipset_eps,
+                                                       async=True))
+        local_eps = dict((ep_id, ep) for (ep_id, ep)
+                         in endpoints_by_id.iteritems()
+                         if ep_id.host == self.config.HOSTNAME)
+        if local_eps:
+            for ep_mgr in self.endpoint_mgrs:
+                results.append(ep_mgr.apply_updates(local_eps, async=True))
+        for result in results:
+            result.get()
+
+    @actor_message()
+    def on_datamodel_in_sync(self):
+        """
+        Called once a complete snapshot has been passed to us via
+        apply_updates(), including the deletions of any items that were
+        removed while we were out of sync.
+        """
+        _log.info("Data model now in sync with etcd.")
+        self._schedule_cleanup()
+
+    def _schedule_cleanup(self):
+        # Cleaning up orphaned ipsets and chains before the snapshot has
+        # been programmed would remove chains and ipsets that are still in
+        # use, causing dropped packets, so wait for the managers to finish.
         if not self._cleanup_scheduled:
             _log.info("No cleanup scheduled, scheduling one.")
-            gevent.spawn_later(self.config.STARTUP_CLEANUP_DELAY,
-                               functools.partial(self.trigger_cleanup,
-                                                 async=True))
+            gevent.spawn(self._cleanup_when_programmed)
             self._cleanup_scheduled = True
 
+    def _cleanup_when_programmed(self):
+        """
+        Runs in its own greenlet.  Waits until the snapshot has reached the
+        dataplane, or for STARTUP_CLEANUP_DELAY at most, and then triggers a
+        cleanup.
+        """
+        if self._wait_for_programming(self.config.STARTUP_CLEANUP_DELAY):
+            _log.info("Snapshot programmed, triggering cleanup.")
+        else:
+            _log.warning("Snapshot not programmed after %ss, triggering "
+                         "cleanup anyway.", self.config.STARTUP_CLEANUP_DELAY)
+        self.trigger_cleanup(async=True)
+
+    def _wait_for_programming(self, timeout):
+        """
+        Blocks until the updates that we've passed to the managers have
+        reached the dataplane.
+
+        :returns: True if they did so within the timeout.
+        """
+        # Endpoints reference profiles, which reference ipsets.  A manager
+        # only waits for the objects that it has been asked for so far so
+        # we wait for each layer in turn; by the time a layer is programmed,
+        # it has asked the next layer for all the objects that it needs.
+        stages = [self.endpoint_mgrs, self.rules_mgrs, self.ipsets_mgrs]
+        with gevent.Timeout(timeout, False):
+            for managers in stages:
+                events = []
+                for manager in managers:
+                    event = gevent.event.Event()
+                    manager.notify_when_programmed(event.set, async=True)
+                    events.append(event)
+                for event in events:
+                    event.wait()
+            return True
+        return False
+
     @actor_message()
     def trigger_cleanup(self):
         """
-        Called from a separate greenlet, asks the managers to clean up
-        unused ipsets and iptables.
+        Called from a separate greenlet once the snapshot has been
+        programmed, asks the managers to clean up unused ipsets and
+        iptables.
         """
         self._cleanup_scheduled = False
         _log.info("Triggering a cleanup of orphaned ipsets/chains")
@@ -107,8 +243,11 @@ class UpdateSplitter(Actor):
             or None if the rules have been deleted.
         """
         _log.info("Profile update: %s", profile_id)
-        for rules_mgr in self.rules_mgrs:
-            rules_mgr.on_rules_update(profile_id, rules, async=True)
+        for rules_mgr, ip_version in zip(self.rules_mgrs, IP_VERSIONS):
+            rules_mgr.on_rules_update(profile_id,
+                                      profile_for_ip_version(rules,
+                                                             ip_version),
+                                      async=True)
 
     @actor_message()
     def on_tags_update(self, profile_id, tags):
@@ -134,7 +273,109 @@ class UpdateSplitter(Actor):
         the endpoint was deleted.
         """
         _log.info("Endpoint update for %s.", endpoint_id)
-        for ipset_mgr in self.ipsets_mgrs:
-            ipset_mgr.on_endpoint_update(endpoint_id, endpoint, async=True)
-        for endpoint_mgr in self.endpoint_mgrs:
-            endpoint_mgr.on_endpoint_update(endpoint_id, endpoint, async=True)
+        for ipset_mgr, ip_version in zip(self.ipsets_mgrs, IP_VERSIONS):
+            view = self._ipset_view({endpoint_id: endpoint}, ip_version)
+            if view:
+                ipset_mgr.on_endpoint_update(endpoint_id, view[endpoint_id],
+                                             async=True)
+        if endpoint_id.host == self.config.HOSTNAME:
+            for endpoint_mgr in self.endpoint_mgrs:
+                endpoint_mgr.on_endpoint_update(endpoint_id, endpoint,
+                                                async=True)
+
+    def _ipset_view(self, endpoints_by_id, ip_version):
+        """
+        Filters a batch of endpoint updates down to the ones that affect
+        the given family's ipsets.
+
+        An endpoint that no longer has any addresses in the family is
+        passed on as a deletion, if the ipset manager knew about it, and
+        skipped otherwise.  Updates our record of what the ipset manager
+        knows so the result must be passed on to it.
+
+        :returns: dict mapping EndpointId to endpoint dict or None.
+        """
+        nets_key = NETS_KEY_BY_IP_VERSION[ip_version]
+        known_ids = self._ipset_ep_ids[ip_version]
+        view = {}
+        for endpoint_id, endpoint in endpoints_by_id.iteritems():
+            if endpoint and endpoint.get(nets_key):
+                view[endpoint_id] = endpoint
+                known_ids.add(endpoint_id)
+            elif endpoint_id in known_ids:
+                view[endpoint_id] = None
+                known_ids.discard(endpoint_id)
+        return view
+
+
+def rules_for_ip_version(rules_by_prof_id, ip_version):
+    """
+    :returns: a copy of the given dict mapping profile ID to rules, with
+        each profile's rules filtered by profile_for_ip_version().
+    """
+    return dict((profile_id, profile_for_ip_version(rules, ip_version))
+                for (profile_id, rules) in rules_by_prof_id.iteritems())
+
+
+def profile_for_ip_version(profile, ip_version):
+    """
+    Removes the rules that only apply to the other IP version from a
+    profile's rules dict.
+
+    :param dict|NoneType profile: Rules dict or None for a deletion.
+    :returns: The rules dict itself if it has no rules to remove, so that
+        the common case doesn't make a copy, otherwise a filtered copy.
+    """
+    if profile is None:
+        return None
+    filtered = None
+    for dirn in ("inbound_rules", "outbound_rules"):
+        rules = profile.get(dirn)
+        if not rules:
+            continue
+        if any(r.get("ip_version") not in (None, ip_version) for r in rules):
+            if filtered is None:
+                filtered = dict(profile)
+            filtered[dirn] = [r for r in rules
+                              if r.get("ip_version") in (None, ip_version)]
+    return profile if filtered is None else filtered
+
+
+def local_subset(hostname, rules_by_prof_id, tags_by_prof_id,
+                 endpoints_by_id):
+    """
+    Extracts the part of a snapshot that is needed to program the given
+    host's endpoints.
+
+    :returns: tuple of dicts containing:
+        - the rules of the profiles used by the local endpoints
+        - the tags of the profiles that have any of the tags that those
+          rules refer to
+        - the local endpoints
+        - the endpoints, local or remote, that use those profiles, which
+          are the members of the local endpoints' ipsets.
+    """
+    local_eps = {}
+    for endpoint_id, endpoint in endpoints_by_id.iteritems():
+        if endpoint_id.host == hostname:
+            local_eps[endpoint_id] = endpoint
+    local_rules = {}
+    used_tags = set()
+    for endpoint in local_eps.itervalues():
+        for profile_id in endpoint_profile_ids(endpoint):
+            if (profile_id in rules_by_prof_id and
+                    profile_id not in local_rules):
+                rules = rules_by_prof_id[profile_id]
+                local_rules[profile_id] = rules
+                used_tags.update(extract_tags_from_profile(rules))
+    local_tags = {}
+    for profile_id, tags in tags_by_prof_id.iteritems():
+        if used_tags.intersection(tags):
+            local_tags[profile_id] = tags
+    ipset_eps = {}
+    if local_tags:
+        for endpoint_id, endpoint in endpoints_by_id.iteritems():
+            if any(profile_id in local_tags
+                   for profile_id in endpoint_profile_ids(endpoint)):
+                ipset_eps[endpoint_id] = endpoint
+    return local_rules, local_tags, local_eps, ipset_eps
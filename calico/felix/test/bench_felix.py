@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.bench_felix
+~~~~~~~~~~~~~~~~~~~~~~
+
+Manual scale benchmark for the Felix actor pipeline.  Not a test case
+because it takes a while to run.  Usage:
+
+    python -m calico.felix.test.bench_felix [options]
+
+Builds the real actor graph with felix._main_greenlet(), with the etcd
+watcher replaced by a feeder that passes a generated snapshot to
+UpdateSplitter.apply_snapshot() and with in-memory fakes for
+futils.check_call, the iptables chain listing and the netlink socket, so
+it needs neither root nor etcd.  Run with --help for the options that set
+the size of the generated cluster.
+
+Reports, as JSON, the time that the actors take to go quiet after the
+snapshot is applied, the number of calls and the bytes of input of each
+command that Felix runs, the peak RSS of the process and the CPU time
+spent on each type of actor.  Actors that are multiplexed onto their
+manager's greenlet are counted as their manager.  With
+--simulate-dataplane, the commands are run against a StubDataplane and
+a digest of the resulting dataplane state is reported too, so that runs
+of different versions of Felix can be checked to leave the same state.
+"""
+# Felix monkey-patches on import, so import it first.
+import calico.felix.felix as felix
+
+import argparse
+import collections
+import json
+import logging
+import random
+import resource
+import struct
+import sys
+import time
+
+import gevent
+import gevent.event
+import gevent.queue
+import greenlet
+import mock
+
+from calico.datamodel_v1 import EndpointId
+from calico.felix import devices, futils
+from calico.felix.actor import Actor, actor_message
+from calico.felix.test.stub_dataplane import StubDataplane
+
+HOSTNAME = "bench-host"
+
+# The actors are deemed to be quiet once no greenlet other than the hub has
+# run for this long.
+QUIET_PERIOD = 1.0
+MAX_RUN_TIME = 600
+
+
+class SnapshotFeeder(Actor):
+    """
+    Stands in for the EtcdWatcher: hands the update splitter to the
+    benchmark instead of watching etcd.
+    """
+    def __init__(self, config):
+        super(SnapshotFeeder, self).__init__()
+        self.splitter = gevent.event.AsyncResult()
+
+    @actor_message()
+    def load_config(self):
+        pass
+
+    @actor_message()
+    def watch_etcd(self, update_splitter):
+        self.splitter.set(update_splitter)
+        # Like the real watcher, never returns.
+        gevent.event.Event().wait()
+
+
+class FakeNetlinkSocket(object):
+    """
+    In-memory stand-in for the InterfaceWatcher's netlink socket; returns
+    the messages queued with new_link().
+    """
+    AF_NETLINK = 16
+    SOCK_RAW = 3
+    NETLINK_ROUTE = 0
+
+    def __init__(self):
+        self.messages = gevent.queue.Queue()
+
+    def socket(self, family, sock_type, protocol):
+        return self
+
+    def bind(self, address):
+        pass
+
+    def recv(self, bufsize):
+        return self.messages.get()
+
+    def new_link(self, iface_name):
+        """Queues an RTM_NEWLINK message for the given interface."""
+        name = iface_name + "\0"
+        rta_len = 4 + len(name)
+        rta = (struct.pack("=HH", rta_len, devices.IFLA_IFNAME) + name +
+               "\0" * (-rta_len % 4))
+        msg_len = 32 + len(rta)
+        self.messages.put(
+            struct.pack("=LHHLL", msg_len, devices.RTM_NEWLINK, 0, 0, 0) +
+            struct.pack("=BBHiII", 0, 0, 0, 0, 0, 0) +
+            rta
+        )
+
+
+class CommandRecorder(object):
+    """
+    Stand-in for futils.check_call and subprocess.check_output that records
+    the calls and the size of their input instead of running them.
+    """
+    def __init__(self):
+        self.calls = collections.defaultdict(int)
+        self.bytes_in = collections.defaultdict(int)
+
+    def check_call(self, args, input_str=None):
+        if args[0].endswith("-restore"):
+            cmd = args[0]
+        else:
+            cmd = " ".join(args[:2])
+        self.calls[cmd] += 1
+        self.bytes_in[cmd] += len(input_str or "")
+        return futils.CommandOutput("", "")
+
+    def check_output(self, args):
+        return self.check_call(args).stdout
+
+    def stats(self):
+        return dict((cmd, {"calls": self.calls[cmd],
+                           "bytes": self.bytes_in[cmd]})
+                    for cmd in self.calls)
+
+
+class GreenletTracer(object):
+    """
+    Uses greenlet's trace hook to charge CPU time to the greenlet that
+    was running and to note when a greenlet other than the hub or the
+    benchmark itself last ran.
+    """
+    def __init__(self):
+        self.cpu_by_greenlet = collections.defaultdict(float)
+        self.last_activity = time.time()
+        self._last_cpu = time.clock()
+        self._ignored = set([gevent.get_hub(), greenlet.getcurrent()])
+
+    def __enter__(self):
+        self._last_cpu = time.clock()
+        greenlet.settrace(self._trace)
+        return self
+
+    def __exit__(self, *exc_info):
+        greenlet.settrace(None)
+
+    def _trace(self, event, args):
+        if event not in ("switch", "throw"):
+            return
+        origin, target = args
+        cpu = time.clock()
+        self.cpu_by_greenlet[origin] += cpu - self._last_cpu
+        self._last_cpu = cpu
+        if target not in self._ignored:
+            self.last_activity = time.time()
+
+    def cpu_by_actor_type(self):
+        cpu = collections.defaultdict(float)
+        for glet, secs in self.cpu_by_greenlet.iteritems():
+            actor = getattr(getattr(glet, "_run", None), "__self__", None)
+            if isinstance(actor, Actor):
+                name = actor.__class__.__name__
+            elif glet is gevent.get_hub():
+                name = "hub"
+            else:
+                name = "other"
+            cpu[name] += secs
+        return dict(cpu)
+
+
+def generate_cluster(num_endpoints, num_profiles, num_tags,
+                     rules_per_profile, local_fraction, num_hosts, seed=0):
+    """
+    Generates a snapshot of a cluster, in the form that the EtcdWatcher
+    passes to UpdateSplitter.apply_snapshot().
+
+    Each endpoint uses one of the profiles, each profile has one or two of
+    the tags and half of each profile's inbound rules refer to tags.
+    A fraction of the endpoints are on this host and the rest are spread
+    across the remote hosts.
+
+    :returns: tuple of rules_by_prof_id, tags_by_prof_id and
+        endpoints_by_id dicts.
+    """
+    rand = random.Random(seed)
+    tag_ids = ["tag-%d" % ii for ii in xrange(num_tags)]
+    rules_by_prof_id = {}
+    tags_by_prof_id = {}
+    for ii in xrange(num_profiles):
+        profile_id = "prof-%d" % ii
+        inbound = []
+        for jj in xrange(rules_per_profile):
+            if jj % 2 == 0:
+                inbound.append({"src_tag": rand.choice(tag_ids),
+                                "action": "allow"})
+            else:
+                inbound.append({"protocol": "tcp",
+                                "src_net": "10.%d.0.0/16" % (jj % 256),
+                                "dst_ports": [rand.randint(1, 65535)],
+                                "action": "allow"})
+        rules_by_prof_id[profile_id] = {
+            "id": profile_id,
+            "inbound_rules": inbound,
+            "outbound_rules": [{"action": "allow"}],
+        }
+        tags_by_prof_id[profile_id] = rand.sample(tag_ids,
+                                                  min(num_tags, 1 + ii % 2))
+
+    endpoints_by_id = {}
+    num_local = int(num_endpoints * local_fraction)
+    for ii in xrange(num_endpoints):
+        if ii < num_local:
+            hostname = HOSTNAME
+        else:
+            hostname = "host-%d" % (ii % num_hosts)
+        endpoint_id = EndpointId(hostname, "bench", "wl-%d" % ii,
+                                 "ep-%d" % ii)
+        endpoints_by_id[endpoint_id] = {
+            "state": "active",
+            "name": "tap%08x" % ii,
+            "mac": "aa:bb:cc:%02x:%02x:%02x" % ((ii >> 16) & 0xff,
+                                                (ii >> 8) & 0xff,
+                                                ii & 0xff),
+            "profile_id": "prof-%d" % (ii % num_profiles),
+            "ipv4_nets": ["10.%d.%d.%d/32" % ((ii >> 16) & 0xff,
+                                              (ii >> 8) & 0xff,
+                                              ii & 0xff)],
+            "ipv6_nets": ["2001:db8::%x:%x/128" % (ii >> 16, ii & 0xffff)],
+        }
+    return rules_by_prof_id, tags_by_prof_id, endpoints_by_id
+
+
+def make_config(child_actor_model):
+    config = mock.Mock()
+    config.HOSTNAME = HOSTNAME
+    config.IFACE_PREFIX = "tap"
+    config.METADATA_IP = None
+    config.METADATA_PORT = None
+    config.CHILD_ACTOR_MODEL = child_actor_model
+    config.UNUSED_GRACE_PERIOD = 0
+    config.STARTUP_CLEANUP_DELAY = 30
+    return config
+
+
+def run(args, dataplane=None):
+    """
+    Runs Felix against a generated cluster until its actors go quiet.
+
+    :param dataplane: Object whose check_call() and check_output() methods
+        stand in for futils.check_call() and subprocess.check_output(), and
+        whose stats() method reports on the calls.  Defaults to a
+        CommandRecorder.
+    :returns: dict of results.
+    """
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    snapshot = generate_cluster(args.endpoints, args.profiles, args.tags,
+                                args.rules, args.local_fraction, args.hosts)
+    rules_by_prof_id, tags_by_prof_id, endpoints_by_id = snapshot
+    local_ifaces = [ep["name"] for ep_id, ep in endpoints_by_id.iteritems()
+                    if ep_id.host == HOSTNAME]
+
+    if dataplane is None:
+        dataplane = CommandRecorder()
+    netlink = FakeNetlinkSocket()
+    feeder = SnapshotFeeder(None)
+    no_op = lambda *args: None
+    with mock.patch("calico.felix.felix.EtcdWatcher",
+                    return_value=feeder), \
+            mock.patch("calico.felix.futils.check_call",
+                       dataplane.check_call), \
+            mock.patch("calico.felix.fiptables.subprocess.check_output",
+                       dataplane.check_output), \
+            mock.patch("calico.felix.devices.socket", netlink), \
+            mock.patch("calico.felix.devices.configure_interface_ipv4",
+                       no_op), \
+            mock.patch("calico.felix.devices.configure_interface_ipv6",
+                       no_op):
+        main_greenlet = gevent.spawn(felix._main_greenlet,
+                                     make_config(args.child_actor_model))
+        splitter = feeder.splitter.get(timeout=10)
+        with GreenletTracer() as tracer:
+            start = time.time()
+            splitter.apply_snapshot(rules_by_prof_id, tags_by_prof_id,
+                                    endpoints_by_id, async=True)
+            for iface in local_ifaces:
+                netlink.new_link(iface)
+            while time.time() - tracer.last_activity < QUIET_PERIOD:
+                if main_greenlet.ready():
+                    main_greenlet.get()
+                if time.time() - start > MAX_RUN_TIME:
+                    raise AssertionError("Felix didn't go quiet after %ss" %
+                                         MAX_RUN_TIME)
+                gevent.sleep(QUIET_PERIOD / 10)
+
+    return {
+        "time_to_quiescence": tracer.last_activity - start,
+        "commands": dataplane.stats(),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "rss_before_kb": rss_before,
+        "cpu_by_actor": tracer.cpu_by_actor_type(),
+    }
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark Felix programming a generated cluster."
+    )
+    parser.add_argument("--endpoints", type=int, default=10000,
+                        help="Number of endpoints in the cluster.")
+    parser.add_argument("--profiles", type=int, default=500,
+                        help="Number of profiles.")
+    parser.add_argument("--tags", type=int, default=200,
+                        help="Number of tags.")
+    parser.add_argument("--rules", type=int, default=10,
+                        help="Number of inbound rules in each profile.")
+    parser.add_argument("--local-fraction", type=float, default=0.01,
+                        help="Fraction of the endpoints on this host.")
+    parser.add_argument("--hosts", type=int, default=100,
+                        help="Number of remote hosts.")
+    parser.add_argument("--child-actor-model", default="greenlet",
+                        choices=["greenlet", "multiplexed"],
+                        help="Felix's ChildActorModel setting.")
+    parser.add_argument("--simulate-dataplane", action="store_true",
+                        help="Run the commands against a StubDataplane "
+                             "rather than just recording them, and report "
+                             "a digest of the final dataplane state.")
+    parser.add_argument("--output", default="-",
+                        help="File to write the JSON results to.")
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    if args.simulate_dataplane:
+        dataplane = StubDataplane()
+        results = run(args, dataplane)
+        results["dataplane_digest"] = dataplane.state_digest()
+    else:
+        results = run(args)
+    results = {"parameters": vars(args), "results": results}
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output == "-":
+        print output
+    else:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
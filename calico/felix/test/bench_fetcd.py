@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.bench_fetcd
+~~~~~~~~~~~~~~~~~~~~~~
+
+Manual benchmark for the parsing of etcd snapshots.  Not a test case
+because it takes a while to run.  Usage:
+
+    python -m calico.felix.test.bench_fetcd [<number of keys>]
+
+Reports the throughput of classifying the keys of a synthetic snapshot
+(with the old per-type regexes and with parse_key()) and of fully parsing
+and validating it, both from cold and with warm parse caches.
+"""
+import json
+import sys
+import time
+
+import mock
+
+from calico.datamodel_v1 import (RULES_KEY_RE, TAGS_KEY_RE, ENDPOINT_KEY_RE,
+                                 READY_KEY, PROFILE_DIR, HOST_DIR,
+                                 get_profile_id_for_profile_dir, parse_key,
+                                 key_for_endpoint, key_for_profile_rules,
+                                 key_for_profile_tags, key_for_config,
+                                 EndpointId)
+from calico.felix.fetcd import EtcdWatcher, EtcdNode, UpdateBatch
+
+DEFAULT_NUM_KEYS = 200000
+# Number of endpoints per profile in the generated snapshot.
+ENDPOINTS_PER_PROFILE = 20
+
+
+def generate_nodes(num_keys):
+    """
+    Generates a list of EtcdNodes resembling a snapshot of a large
+    deployment: mainly endpoints, with a profile for every few endpoints.
+    """
+    rules = json.dumps({
+        "inbound_rules": [{"src_tag": "tag1", "action": "allow"},
+                          {"protocol": "tcp", "dst_ports": [80, 443]}],
+        "outbound_rules": [{"action": "allow"}],
+    })
+    tags = json.dumps(["tag1", "tag2"])
+    nodes = [EtcdNode("get", READY_KEY, "true", 1),
+             EtcdNode("get", key_for_config("InterfacePrefix"), "tap", 2)]
+    ii = 0
+    while len(nodes) < num_keys:
+        profile_id = "prof-%d" % (ii // ENDPOINTS_PER_PROFILE)
+        if ii % ENDPOINTS_PER_PROFILE == 0:
+            nodes.append(EtcdNode("get", key_for_profile_rules(profile_id),
+                                  rules, len(nodes)))
+            nodes.append(EtcdNode("get", key_for_profile_tags(profile_id),
+                                  tags, len(nodes)))
+        endpoint = json.dumps({
+            "state": "active",
+            "name": "tap%08x" % ii,
+            "mac": "aa:bb:cc:%02x:%02x:%02x" % ((ii >> 16) & 0xff,
+                                                (ii >> 8) & 0xff,
+                                                ii & 0xff),
+            "profile_id": profile_id,
+            "ipv4_nets": ["10.%d.%d.%d/32" % ((ii >> 16) & 0xff,
+                                              (ii >> 8) & 0xff,
+                                              ii & 0xff)],
+            "ipv6_nets": [],
+        })
+        key = key_for_endpoint("host-%d" % (ii % 100), "openstack",
+                               "wl-%d" % ii, "ep-%d" % ii)
+        nodes.append(EtcdNode("get", key, endpoint, len(nodes)))
+        ii += 1
+    return nodes[:num_keys]
+
+
+def classify_with_regexes(key):
+    """
+    Classifies a key in the way that fetcd used to: by trying each regex
+    in turn and extracting the IDs from the match, then falling back to
+    prefix matches.
+    """
+    profile_id = get_profile_id_for_profile_dir(key)
+    if profile_id:
+        return "profile", profile_id
+    m = RULES_KEY_RE.match(key)
+    if m:
+        return "rules", m.group("profile_id")
+    m = TAGS_KEY_RE.match(key)
+    if m:
+        return "tags", m.group("profile_id")
+    m = ENDPOINT_KEY_RE.match(key)
+    if m:
+        return "endpoint", EndpointId(m.group("hostname"),
+                                      m.group("orchestrator"),
+                                      m.group("workload_id"),
+                                      m.group("endpoint_id"))
+    if key == READY_KEY:
+        return "ready", None
+    if any(key.startswith(pfx) for pfx in (READY_KEY, PROFILE_DIR, HOST_DIR)):
+        return "resync_on_change", None
+    return "other", None
+
+
+def time_it(name, fn, num_keys):
+    start = time.time()
+    fn()
+    duration = time.time() - start
+    print "%-30s %8.3fs %10.0f keys/s" % (name, duration,
+                                           num_keys / duration)
+
+
+def main(argv):
+    num_keys = int(argv[1]) if len(argv) > 1 else DEFAULT_NUM_KEYS
+    print "Generating %s keys..." % num_keys
+    nodes = generate_nodes(num_keys)
+    keys = [n.key for n in nodes]
+
+    config = mock.Mock()
+    config.HOSTNAME = "host-1"
+    config.IFACE_PREFIX = "tap"
+    config.SNAPSHOT_CACHE_FILE = None
+    watcher = EtcdWatcher(config)
+
+    def regexes():
+        for key in keys:
+            classify_with_regexes(key)
+
+    def router():
+        for key in keys:
+            parse_key(key)
+
+    def full_parse():
+        batch = UpdateBatch()
+        for node in nodes:
+            key_type, key_id = parse_key(node.key)
+            watcher._add_to_batch(key_type, key_id, node, batch)
+
+    time_it("Classify (regexes)", regexes, num_keys)
+    time_it("Classify (parse_key)", router, num_keys)
+    time_it("Parse and validate", full_parse, num_keys)
+    # Second pass hits the parse caches, up to their size limit.
+    time_it("Parse and validate (warm)", full_parse, num_keys)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
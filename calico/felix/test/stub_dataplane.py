@@ -0,0 +1,606 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.stub_dataplane
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+In-memory simulation of the parts of the dataplane that Felix programs.
+
+StubDataplane.check_call() is a drop-in for futils.check_call() that
+implements enough of the semantics of the commands that Felix runs
+(ip(6)tables-restore --noflush, ip(6)tables-save, ipset restore/list/
+destroy, ip route, ip -6 neigh and arp) to check the end state that a
+sequence of calls leaves, without root or a real kernel.  It fails calls
+in the way that the real commands do where Felix relies on it, for
+example when a rule jumps to a missing chain or when deleting a chain that
+is still referenced.
+
+Each call's cost (input lines, bytes and time spent in the simulator) is
+recorded, and state() returns the end state in a form that can be compared
+between runs, for example to check that an optimization leaves the same
+dataplane behind.
+"""
+import collections
+import hashlib
+import json
+import logging
+import shlex
+import time
+
+from calico.felix.futils import CommandOutput, FailedSystemCall
+
+_log = logging.getLogger(__name__)
+
+BUILTIN_CHAINS = {
+    "filter": ["INPUT", "FORWARD", "OUTPUT"],
+    "nat": ["PREROUTING", "INPUT", "OUTPUT", "POSTROUTING"],
+    "mangle": ["PREROUTING", "INPUT", "FORWARD", "OUTPUT", "POSTROUTING"],
+    "raw": ["PREROUTING", "OUTPUT"],
+}
+
+# Targets that are provided by iptables extensions rather than by chains.
+EXTENSION_TARGETS = set([
+    "ACCEPT", "DROP", "RETURN", "REJECT", "LOG", "MARK", "CONNMARK", "DNAT",
+    "SNAT", "MASQUERADE", "REDIRECT", "QUEUE", "NFQUEUE", "NOTRACK", "CT",
+])
+
+IPTABLES_CMDS = {
+    "iptables": 4, "iptables-restore": 4, "iptables-save": 4,
+    "ip6tables": 6, "ip6tables-restore": 6, "ip6tables-save": 6,
+}
+
+# iptables normalizes short options to their long forms.
+LONG_OPTS = {
+    "-A": "--append", "-I": "--insert", "-D": "--delete", "-R": "--replace",
+    "-F": "--flush", "-N": "--new-chain", "-X": "--delete-chain",
+    "-P": "--policy", "-p": "--protocol", "-s": "--source",
+    "--src": "--source", "-d": "--destination", "--dst": "--destination",
+    "-j": "--jump", "-g": "--goto", "-m": "--match", "-i": "--in-interface",
+    "-o": "--out-interface",
+}
+
+
+class CommandFailed(Exception):
+    """
+    Raised by the simulation of a command to fail it with the given
+    stderr output.
+    """
+    pass
+
+
+class Chain(object):
+    def __init__(self, policy=None, rules=None):
+        # Only built-in chains have a policy.
+        self.policy = policy
+        # List of rules, each a tuple of normalized tokens.
+        self.rules = rules or []
+
+    def copy(self):
+        return Chain(self.policy, list(self.rules))
+
+
+class Table(object):
+    """
+    The chains of an iptables table, with counts of the references to
+    each chain and ipset from their rules.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.chains = dict((chain, Chain(policy="ACCEPT"))
+                           for chain in BUILTIN_CHAINS[name])
+        self.chain_refs = collections.Counter()
+        self.set_refs = collections.Counter()
+
+    def copy(self):
+        # The chains are copied on write by IptablesTransaction.
+        table = Table.__new__(Table)
+        table.name = self.name
+        table.chains = dict(self.chains)
+        table.chain_refs = self.chain_refs.copy()
+        table.set_refs = self.set_refs.copy()
+        return table
+
+
+def _rule_targets(rule):
+    """
+    :returns: tuple of the chain or target that the rule jumps to, or None,
+        and the list of ipsets that it matches on.
+    """
+    target = None
+    ipsets = []
+    for ii, token in enumerate(rule[:-1]):
+        if token in ("--jump", "--goto"):
+            target = rule[ii + 1]
+        elif token == "--match-set":
+            ipsets.append(rule[ii + 1])
+    return target, ipsets
+
+
+def _quote(token):
+    if not token or any(c in token for c in ' "\'\\'):
+        return '"%s"' % token.replace("\\", "\\\\").replace('"', '\\"')
+    return token
+
+
+class IptablesTransaction(object):
+    """
+    Changes to a table made by one table section of the input to
+    ip(6)tables-restore, applied on COMMIT.
+    """
+    def __init__(self, dataplane, ip_version, table, flush):
+        self.dataplane = dataplane
+        self.ip_version = ip_version
+        self.table = table.copy()
+        self._copied = set()
+        if flush:
+            # Without --noflush, the table starts empty.
+            for chain in list(self.table.chains):
+                self._flush(chain)
+                if chain not in BUILTIN_CHAINS[table.name]:
+                    del self.table.chains[chain]
+                    del self.table.chain_refs[chain]
+
+    def _chain(self, name, for_write=False):
+        if name not in self.table.chains:
+            raise CommandFailed("No chain/target/match by that name.")
+        if for_write and name not in self._copied:
+            self.table.chains[name] = self.table.chains[name].copy()
+            self._copied.add(name)
+        return self.table.chains[name]
+
+    def _add_refs(self, rule, delta):
+        target, ipsets = _rule_targets(rule)
+        if target in self.table.chains:
+            self.table.chain_refs[target] += delta
+        for ipset in ipsets:
+            self.table.set_refs[ipset] += delta
+
+    def _check_rule(self, rule):
+        target, ipsets = _rule_targets(rule)
+        if (target is not None and target not in EXTENSION_TARGETS and
+                target not in self.table.chains):
+            raise CommandFailed("Couldn't load target `%s'" % target)
+        for ipset in ipsets:
+            if ipset not in self.dataplane.ipsets:
+                raise CommandFailed("Set %s doesn't exist." % ipset)
+
+    def _flush(self, name):
+        chain = self._chain(name, for_write=True)
+        for rule in chain.rules:
+            self._add_refs(rule, -1)
+        del chain.rules[:]
+
+    def declare_chain(self, name, policy):
+        if name in BUILTIN_CHAINS[self.table.name]:
+            if policy != "-":
+                self._chain(name, for_write=True).policy = policy
+        elif name in self.table.chains:
+            # Even with --noflush, declaring an existing chain flushes it.
+            self._flush(name)
+        else:
+            self.table.chains[name] = Chain()
+            self._copied.add(name)
+
+    def apply(self, tokens):
+        tokens = [LONG_OPTS.get(t, t) for t in tokens]
+        cmd = tokens[0]
+        chain_name = tokens[1] if len(tokens) > 1 else None
+        rule = tuple(tokens[2:])
+        if cmd == "--append":
+            self._check_rule(rule)
+            self._chain(chain_name, for_write=True).rules.append(rule)
+            self._add_refs(rule, 1)
+        elif cmd == "--insert":
+            position = 1
+            if rule and rule[0].isdigit():
+                position, rule = int(rule[0]), rule[1:]
+            self._check_rule(rule)
+            chain = self._chain(chain_name, for_write=True)
+            if position > len(chain.rules) + 1:
+                raise CommandFailed("Index of insertion too big.")
+            chain.rules.insert(position - 1, rule)
+            self._add_refs(rule, 1)
+        elif cmd == "--replace":
+            position, rule = int(rule[0]), rule[1:]
+            self._check_rule(rule)
+            chain = self._chain(chain_name, for_write=True)
+            if position > len(chain.rules):
+                raise CommandFailed("Index of replacement too big.")
+            self._add_refs(chain.rules[position - 1], -1)
+            chain.rules[position - 1] = rule
+            self._add_refs(rule, 1)
+        elif cmd == "--delete":
+            chain = self._chain(chain_name)
+            if len(rule) == 1 and rule[0].isdigit():
+                index = int(rule[0]) - 1
+                if index >= len(chain.rules):
+                    raise CommandFailed("Index of deletion too big.")
+            elif rule in chain.rules:
+                index = chain.rules.index(rule)
+            else:
+                raise CommandFailed("Bad rule (does a matching rule exist "
+                                    "in that chain?).")
+            chain = self._chain(chain_name, for_write=True)
+            self._add_refs(chain.rules.pop(index), -1)
+        elif cmd == "--flush":
+            for name in ([chain_name] if chain_name else
+                         list(self.table.chains)):
+                self._flush(name)
+        elif cmd == "--new-chain":
+            if chain_name in self.table.chains:
+                raise CommandFailed("Chain already exists.")
+            self.table.chains[chain_name] = Chain()
+            self._copied.add(chain_name)
+        elif cmd == "--delete-chain":
+            if chain_name:
+                names = [chain_name]
+            else:
+                names = [c for c in self.table.chains
+                         if c not in BUILTIN_CHAINS[self.table.name]]
+            for name in names:
+                chain = self._chain(name)
+                if name in BUILTIN_CHAINS[self.table.name]:
+                    raise CommandFailed("Can't delete built-in chain.")
+                if self.table.chain_refs[name]:
+                    raise CommandFailed("Too many links.")
+                if chain.rules:
+                    raise CommandFailed("Directory not empty.")
+                del self.table.chains[name]
+                del self.table.chain_refs[name]
+        elif cmd == "--policy":
+            self._chain(chain_name, for_write=True).policy = rule[0]
+        else:
+            raise CommandFailed("Unknown command %s." % cmd)
+
+
+class StubDataplane(object):
+    def __init__(self):
+        self.tables = {4: {}, 6: {}}
+        # Map from ipset name to dict with its type, family and members.
+        self.ipsets = {}
+        # Routes and ARP entries, each keyed on (IP, interface).
+        self.routes = {4: set(), 6: set()}
+        self.ndp_proxies = set()
+        self.arp_entries = {}
+        # Cost of the calls, by command.
+        self.calls = collections.defaultdict(int)
+        self.lines_in = collections.defaultdict(int)
+        self.bytes_in = collections.defaultdict(int)
+        self.seconds = collections.defaultdict(float)
+        self.failures = collections.defaultdict(int)
+
+    def table(self, ip_version, name):
+        tables = self.tables[ip_version]
+        if name not in tables:
+            tables[name] = Table(name)
+        return tables[name]
+
+    def check_call(self, args, input_str=None):
+        """
+        Drop-in for futils.check_call() that runs the command against the
+        simulated dataplane.
+
+        :raises FailedSystemCall: if the command fails.
+        """
+        args = list(args)
+        if args[0] in ("ipset", "ip", "arp") and len(args) > 1:
+            cmd = " ".join(args[:2])
+        else:
+            cmd = args[0]
+        self.calls[cmd] += 1
+        if input_str:
+            self.lines_in[cmd] += input_str.count("\n")
+            self.bytes_in[cmd] += len(input_str)
+        start = time.time()
+        try:
+            stdout = self._run(args, input_str or "")
+        except CommandFailed as e:
+            self.failures[cmd] += 1
+            _log.debug("Simulated %s failed: %s", args, e)
+            raise FailedSystemCall("Failed system call", args, 1, "",
+                                   str(e), input=input_str)
+        finally:
+            self.seconds[cmd] += time.time() - start
+        return CommandOutput(stdout, "")
+
+    def check_output(self, args):
+        """Drop-in for subprocess.check_output()."""
+        return self.check_call(args).stdout
+
+    def _run(self, args, input_str):
+        cmd = args[0]
+        if cmd.endswith("tables-restore"):
+            return self._iptables_restore(IPTABLES_CMDS[cmd], args,
+                                          input_str)
+        elif cmd.endswith("tables-save"):
+            return self._iptables_save(IPTABLES_CMDS[cmd], args)
+        elif cmd in ("iptables", "ip6tables"):
+            return self._iptables(IPTABLES_CMDS[cmd], args)
+        elif cmd == "ipset":
+            if args[1:] == ["restore"]:
+                return self._ipset_restore(input_str)
+            elif args[1] == "list":
+                return self._ipset_list(args[2:])
+            self._ipset_line(args[1:])
+            return ""
+        elif cmd == "ip":
+            return self._ip(args[1:])
+        elif cmd == "arp":
+            return self._arp(args[1:])
+        raise CommandFailed("%s: command not found" % cmd)
+
+    # iptables.
+
+    def _iptables_restore(self, ip_version, args, input_str):
+        flush = "--noflush" not in args and "-n" not in args
+        txn = None
+        for line_no, line in enumerate(input_str.splitlines(), start=1):
+            line = line.strip()
+            try:
+                if not line or line.startswith("#"):
+                    continue
+                elif line.startswith("*"):
+                    txn = IptablesTransaction(
+                        self, ip_version, self.table(ip_version, line[1:]),
+                        flush
+                    )
+                elif txn is None:
+                    raise CommandFailed("no table specified")
+                elif line == "COMMIT":
+                    self.tables[ip_version][txn.table.name] = txn.table
+                    txn = None
+                elif line.startswith(":"):
+                    words = line[1:].split()
+                    txn.declare_chain(words[0],
+                                      words[1] if len(words) > 1 else "-")
+                else:
+                    txn.apply(shlex.split(line))
+            except CommandFailed as e:
+                raise CommandFailed("%s\n%s: line %s failed\n" %
+                                    (e, args[0], line_no))
+        if txn is not None:
+            raise CommandFailed("%s: COMMIT expected at line %s\n" %
+                                (args[0], line_no + 1))
+        return ""
+
+    def _iptables_save(self, ip_version, args):
+        lines = []
+        for name, table in sorted(self.tables[ip_version].iteritems()):
+            if "-t" in args and args[args.index("-t") + 1] != name:
+                continue
+            lines.append("*%s" % name)
+            for chain_name, chain in sorted(table.chains.iteritems()):
+                lines.append(":%s %s [0:0]" % (chain_name,
+                                               chain.policy or "-"))
+            for chain_name, chain in sorted(table.chains.iteritems()):
+                for rule in chain.rules:
+                    lines.append(" ".join(["-A", chain_name] +
+                                          [_quote(t) for t in rule]))
+            lines.append("COMMIT")
+        return "\n".join(lines) + "\n"
+
+    def _iptables(self, ip_version, args):
+        """Supports "iptables [--wait] --list [--table <table>]"."""
+        args = [a for a in args[1:] if a not in ("--wait", "-w")]
+        table_name = "filter"
+        for opt in ("--table", "-t"):
+            if opt in args:
+                table_name = args[args.index(opt) + 1]
+        if "--list" not in args and "-L" not in args:
+            raise CommandFailed("Only --list is supported, not %s" % args)
+        table = self.table(ip_version, table_name)
+        lines = []
+        for chain_name, chain in sorted(table.chains.iteritems()):
+            if chain.policy is not None:
+                lines.append("Chain %s (policy %s)" % (chain_name,
+                                                       chain.policy))
+            else:
+                lines.append("Chain %s (%s references)" %
+                             (chain_name, table.chain_refs[chain_name]))
+            lines.append("target     prot opt source               "
+                         "destination")
+            for rule in chain.rules:
+                lines.append(" ".join(_quote(t) for t in rule))
+            lines.append("")
+        return "\n".join(lines)
+
+    # ipset.
+
+    def _ipset_restore(self, input_str):
+        for line_no, line in enumerate(input_str.splitlines(), start=1):
+            line = line.strip()
+            if not line or line == "COMMIT":
+                continue
+            try:
+                # Unlike iptables-restore, the lines before a failure stay
+                # applied.
+                self._ipset_line(shlex.split(line))
+            except CommandFailed as e:
+                raise CommandFailed("ipset v6.11: Error in line %s: %s" %
+                                    (line_no, e))
+        return ""
+
+    def _ipset_line(self, words):
+        cmd, args = words[0], words[1:]
+        exist = "--exist" in args or "-exist" in args
+        args = [a for a in args if a not in ("--exist", "-exist")]
+        if cmd in ("create", "destroy", "add", "del", "swap", "rename"):
+            if not args:
+                raise CommandFailed("Missing set name.")
+            name = args[0]
+        if cmd == "create":
+            if name in self.ipsets:
+                if not exist:
+                    raise CommandFailed("Set cannot be created: set with "
+                                        "the same name already exists")
+                return
+            family = "inet"
+            if "family" in args:
+                family = args[args.index("family") + 1]
+            self.ipsets[name] = {"type": args[1], "family": family,
+                                 "members": set()}
+        elif cmd == "destroy":
+            names = [name] if args else list(self.ipsets)
+            for name in names:
+                self._ipset(name)
+                if self._ipset_in_use(name):
+                    raise CommandFailed("Set cannot be destroyed: it is in "
+                                        "use by a kernel component")
+                del self.ipsets[name]
+        elif cmd == "flush":
+            for name in args[:1] or list(self.ipsets):
+                self._ipset(name)["members"].clear()
+        elif cmd == "add":
+            members = self._ipset(name)["members"]
+            if args[1] in members and not exist:
+                raise CommandFailed("Element cannot be added to the set: "
+                                    "it's already added")
+            members.add(args[1])
+        elif cmd == "del":
+            members = self._ipset(name)["members"]
+            if args[1] not in members and not exist:
+                raise CommandFailed("Element cannot be deleted from the "
+                                    "set: it's not added")
+            members.discard(args[1])
+        elif cmd == "swap":
+            first, second = self._ipset(name), self._ipset(args[1])
+            if first["type"] != second["type"]:
+                raise CommandFailed("The sets cannot be swapped: their "
+                                    "type does not match")
+            self.ipsets[name], self.ipsets[args[1]] = second, first
+        elif cmd == "rename":
+            self._ipset(name)
+            if args[1] in self.ipsets:
+                raise CommandFailed("Set cannot be renamed: a set with the "
+                                    "new name already exists")
+            self.ipsets[args[1]] = self.ipsets.pop(name)
+        else:
+            raise CommandFailed("Unknown ipset command %s" % cmd)
+
+    def _ipset(self, name):
+        try:
+            return self.ipsets[name]
+        except KeyError:
+            raise CommandFailed("The set with the given name does not "
+                                "exist")
+
+    def _ipset_in_use(self, name):
+        return any(table.set_refs[name]
+                   for tables in self.tables.itervalues()
+                   for table in tables.itervalues())
+
+    def _ipset_list(self, names):
+        lines = []
+        for name in names or sorted(self.ipsets):
+            ipset = self._ipset(name)
+            lines.append("Name: %s" % name)
+            lines.append("Type: %s" % ipset["type"])
+            lines.append("Header: family %s" % ipset["family"])
+            lines.append("Members:")
+            lines.extend(sorted(ipset["members"]))
+            lines.append("")
+        return "\n".join(lines)
+
+    # ip and arp.
+
+    def _ip(self, args):
+        ip_version = 4
+        if args[0] == "-6":
+            ip_version, args = 6, args[1:]
+        obj, cmd, args = args[0], args[1], args[2:]
+        if obj == "route":
+            routes = self.routes[ip_version]
+            if cmd == "list":
+                iface = args[args.index("dev") + 1]
+                return "".join("%s scope link\n" % ip
+                               for ip, dev in sorted(routes) if dev == iface)
+            ip, iface = args[0], args[args.index("dev") + 1]
+            if cmd == "replace":
+                # Replaces any route to the IP via another interface.
+                for route in [r for r in routes if r[0] == ip]:
+                    routes.discard(route)
+                routes.add((ip, iface))
+                return ""
+            elif cmd == "del":
+                if (ip, iface) not in routes:
+                    raise CommandFailed("RTNETLINK answers: No such process")
+                routes.discard((ip, iface))
+                return ""
+        elif obj == "neigh" and cmd == "add" and args[0] == "proxy":
+            self.ndp_proxies.add((args[1], args[args.index("dev") + 1]))
+            return ""
+        raise CommandFailed("Unsupported ip command %s" % args)
+
+    def _arp(self, args):
+        iface = args[args.index("-i") + 1]
+        if args[0] == "-s":
+            self.arp_entries[(args[1], iface)] = args[2]
+        elif args[0] == "-d":
+            if (args[1], iface) not in self.arp_entries:
+                raise CommandFailed("No ARP entry for %s" % args[1])
+            del self.arp_entries[(args[1], iface)]
+        else:
+            raise CommandFailed("Unsupported arp command %s" % args)
+        return ""
+
+    # Results.
+
+    def state(self):
+        """
+        :returns: JSON-serializable dict of the current state of the
+            simulated dataplane.
+        """
+        iptables = {}
+        for ip_version, tables in self.tables.iteritems():
+            for name, table in tables.iteritems():
+                iptables["ipv%s %s" % (ip_version, name)] = dict(
+                    (chain_name, {"policy": chain.policy,
+                                  "rules": [" ".join(_quote(t) for t in r)
+                                            for r in chain.rules]})
+                    for chain_name, chain in table.chains.iteritems()
+                )
+        return {
+            "iptables": iptables,
+            "ipsets": dict((name, {"type": ipset["type"],
+                                   "family": ipset["family"],
+                                   "members": sorted(ipset["members"])})
+                           for name, ipset in self.ipsets.iteritems()),
+            "routes": dict(("ipv%s" % ip_version, sorted(routes))
+                           for ip_version, routes in
+                           self.routes.iteritems()),
+            "ndp_proxies": sorted(self.ndp_proxies),
+            "arp_entries": sorted(self.arp_entries.iteritems()),
+        }
+
+    def state_digest(self):
+        """
+        :returns: a hash of state(), for checking that two runs leave the
+            same dataplane behind.
+        """
+        return hashlib.sha1(json.dumps(self.state(),
+                                       sort_keys=True)).hexdigest()
+
+    def stats(self):
+        """
+        :returns: dict mapping each command to the number of calls, the
+            number of them that failed, their total lines and bytes of
+            input and the time spent simulating them.
+        """
+        return dict((cmd, {"calls": self.calls[cmd],
+                           "failures": self.failures[cmd],
+                           "lines": self.lines_in[cmd],
+                           "bytes": self.bytes_in[cmd],
+                           "seconds": self.seconds[cmd]})
+                    for cmd in self.calls)
@@ -220,6 +220,45 @@ class TestActor(BaseTestCase):
         actor.wait_and_check([])
 
 
+class TestMultiplexedActor(BaseTestCase):
+    def setUp(self):
+        super(TestMultiplexedActor, self).setUp()
+        self._host = ActorForTesting(qualifier="host")
+        self._guest = ActorForTesting(qualifier="guest")
+
+    def test_runs_in_host_loop(self):
+        """
+        Tests that a guest's messages are batched and run when its host's
+        loop runs.
+        """
+        self._guest.start_on(self._host)
+        self.assertTrue(self._guest.greenlet is self._host.greenlet)
+        f_a = self._guest.do_a(async=True)
+        f_b = self._guest.do_b(async=True)
+        self.assertEqual(self._guest.actions, [])
+        self._host._step()
+        self.assertEqual(self._guest.batches, [["sb", "a", "b", "fb"]])
+        self.assertEqual(f_a.get(), "a")
+        self.assertEqual(f_b.get(), "b")
+        # The host processed a single message for the guest.
+        self.assertEqual(self._host.batches, [["sb", "fb"]])
+
+    def test_queued_before_start(self):
+        f_a = self._guest.do_a(async=True)
+        self._guest.start_on(self._host)
+        self._host._step()
+        self.assertEqual(f_a.get(), "a")
+
+    def test_blocking_call(self):
+        self._host.start()
+        self._guest.start_on(self._host)
+        self.assertEqual(self._guest.do_a(async=False), "a")
+        self.assertRaises(ExpectedException, self._guest.do_exc,
+                          async=False)
+        self.assertEqual(self._guest.batches, [["sb", "a", "fb"],
+                                               ["sb", "exc", "fb"]])
+
+
 class TestExceptionTracking(BaseTestCase):
     def test_exception(self):
         ar = actor.TrackedAsyncResult("foo")
@@ -24,7 +24,7 @@ import logging
 import mock
 import socket
 import sys
-from calico.felix.config import Config, ConfigException
+from calico.felix.config import Config, ConfigException, RestartRequired
 
 if sys.version_info < (2, 7):
     import unittest2 as unittest
@@ -137,6 +137,21 @@ class TestConfig(unittest.TestCase):
                                          "Invalid log level.*%s" % field):
                 config.report_etcd_config({}, cfg_dict)
 
+    def test_child_actor_model(self):
+        config = Config("calico/felix/test/data/felix_missing.cfg")
+        cfg_dict = { "InterfacePrefix": "blah",
+                     "ChildActorModel": "Multiplexed" }
+        with mock.patch('calico.common.complete_logging'):
+            config.report_etcd_config({}, cfg_dict)
+        self.assertEqual(config.CHILD_ACTOR_MODEL, "multiplexed")
+
+        config = Config("calico/felix/test/data/felix_missing.cfg")
+        cfg_dict = { "InterfacePrefix": "blah",
+                     "ChildActorModel": "threads" }
+        with self.assertRaisesRegexp(ConfigException,
+                                     "Invalid child actor model"):
+            config.report_etcd_config({}, cfg_dict)
+
     def test_blank_metadata_addr(self):
         config = Config("calico/felix/test/data/felix_missing.cfg")
         cfg_dict = { "InterfacePrefix": "blah",
@@ -198,3 +213,58 @@ class TestConfig(unittest.TestCase):
         self.assertEqual(config.METADATA_PORT, 999)
         self.assertEqual(config.METADATA_IP, "1.2.3.4")
         self.assertEqual(config.STARTUP_CLEANUP_DELAY, 42)
+
+    def load_config(self, global_dict):
+        config = Config("calico/felix/test/data/felix_missing.cfg")
+        with mock.patch('calico.common.complete_logging'):
+            config.report_etcd_config({}, dict(global_dict))
+        return config
+
+    def test_update_etcd_config(self):
+        config = self.load_config({"InterfacePrefix": "tap",
+                                   "StartupCleanupDelay": "42",
+                                   "ResyncWindow": "10"})
+        with mock.patch('calico.common.complete_logging') as m_logging:
+            changed = config.update_etcd_config(
+                {"LogSeverityFile": "debug"},
+                {"InterfacePrefix": "tap", "ResyncWindow": "20"}
+            )
+        self.assertEqual(changed, set(["LogSeverityFile",
+                                       "StartupCleanupDelay",
+                                       "ResyncWindow"]))
+        # Removed parameters revert to their defaults.
+        self.assertEqual(config.STARTUP_CLEANUP_DELAY, 30)
+        self.assertEqual(config.RESYNC_WINDOW, 20)
+        self.assertEqual(config.LOGLEVFILE, logging.DEBUG)
+        self.assertEqual(config.parameters["LogSeverityFile"].active_source,
+                         "Host specific etcd configuration")
+        self.assertEqual(m_logging.call_count, 1)
+
+        with mock.patch('calico.common.complete_logging') as m_logging:
+            changed = config.update_etcd_config(
+                {"LogSeverityFile": "debug"},
+                {"InterfacePrefix": "tap", "ResyncWindow": "20"}
+            )
+        self.assertEqual(changed, set())
+        self.assertFalse(m_logging.called)
+
+    def test_update_etcd_config_restart(self):
+        config = self.load_config({"InterfacePrefix": "tap",
+                                   "ResyncWindow": "10"})
+        for global_dict in [{"InterfacePrefix": "cali", "ResyncWindow": "20"},
+                            {"InterfacePrefix": "tap",
+                             "LogSeveritySys": "none"}]:
+            with self.assertRaises(RestartRequired):
+                config.update_etcd_config({}, global_dict)
+            # Nothing is applied.
+            self.assertEqual(config.IFACE_PREFIX, "tap")
+            self.assertEqual(config.RESYNC_WINDOW, 10)
+            self.assertEqual(config.LOGLEVSYS, logging.ERROR)
+
+    def test_update_etcd_config_invalid(self):
+        config = self.load_config({"InterfacePrefix": "tap"})
+        with self.assertRaisesRegexp(ConfigException,
+                                     "Resync window must be non-negative"):
+            config.update_etcd_config({}, {"InterfacePrefix": "tap",
+                                           "ResyncWindow": "-1"})
+        self.assertEqual(config.RESYNC_WINDOW, 30)
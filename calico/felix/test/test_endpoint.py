@@ -34,6 +34,9 @@ from calico.felix.actor import actor_message, ResultOrExc, SplitBatchAndRetry
 from calico.felix.test.base import BaseTestCase
 from calico.felix import endpoint
 from calico.felix import config
+from calico.felix.frules import (profile_to_chain_name, chain_names,
+                                 ACCEPT_MARK, MULTI_PROFILE_MARK,
+                                 PROFILE_MARK_MASK)
 
 _log = logging.getLogger(__name__)
 
@@ -50,3 +53,71 @@ class TestEndpointManager(BaseTestCase):
         self.m_rules_mgr = Mock(autospec=RulesManager)
         self.ep_mgr = EndpointManager(self.m_config, self.m_ipt_upds,
                                       self.m_disp_chns, self.m_rules_mgr)
+
+
+class TestEndpointRules(BaseTestCase):
+    def test_single_profile(self):
+        updates, deps = endpoint._get_endpoint_rules(
+            "ep1", "abcd", 4, ["10.0.0.1"], "aa:bb:cc:dd:ee:ff", ["prof1"]
+        )
+        to_chain, from_chain = chain_names("abcd")
+        self.assertEqual(deps, {
+            to_chain: set([profile_to_chain_name("inbound", "prof1")]),
+            from_chain: set([profile_to_chain_name("outbound", "prof1")]),
+        })
+        # The profile chain is responsible for dropping the packet so we
+        # --goto it and don't touch the marks.
+        self.assertEqual(
+            updates[to_chain][-2],
+            "--append %s --goto %s" %
+            (to_chain, profile_to_chain_name("inbound", "prof1"))
+        )
+        self.assertEqual(
+            updates[from_chain][-2],
+            "--append %s --src 10.0.0.1/32 --match mac "
+            "--mac-source AA:BB:CC:DD:EE:FF --goto %s" %
+            (from_chain, profile_to_chain_name("outbound", "prof1"))
+        )
+        for chain in (to_chain, from_chain):
+            self.assertFalse([r for r in updates[chain] if "MARK" in r])
+
+    def test_multiple_profiles(self):
+        updates, deps = endpoint._get_endpoint_rules(
+            "ep1", "abcd", 4, ["10.0.0.1"], "aa:bb:cc:dd:ee:ff",
+            ["prof1", "prof2"]
+        )
+        to_chain, from_chain = chain_names("abcd")
+        self.assertEqual(deps, {
+            to_chain: set([profile_to_chain_name("inbound", "prof1"),
+                           profile_to_chain_name("inbound", "prof2")]),
+            from_chain: set([profile_to_chain_name("outbound", "prof1"),
+                             profile_to_chain_name("outbound", "prof2")]),
+        })
+        # Each profile chain is tried in order, returning as soon as one of
+        # them has marked the packet as accepted.
+        set_mark = ("--jump MARK --set-mark %s/%s" %
+                    (MULTI_PROFILE_MARK, PROFILE_MARK_MASK))
+        return_if_marked = ("--match mark --mark %s/%s --jump RETURN" %
+                            (ACCEPT_MARK, ACCEPT_MARK))
+        self.assertEqual(updates[to_chain][-6:-1], [
+            "--append %s %s" % (to_chain, set_mark),
+            "--append %s --jump %s" %
+            (to_chain, profile_to_chain_name("inbound", "prof1")),
+            "--append %s %s" % (to_chain, return_if_marked),
+            "--append %s --jump %s" %
+            (to_chain, profile_to_chain_name("inbound", "prof2")),
+            "--append %s %s" % (to_chain, return_if_marked),
+        ])
+        self.assertEqual(updates[from_chain][-6:-1], [
+            "--append %s %s" % (from_chain, set_mark),
+            "--append %s --src 10.0.0.1/32 --match mac "
+            "--mac-source AA:BB:CC:DD:EE:FF --jump %s" %
+            (from_chain, profile_to_chain_name("outbound", "prof1")),
+            "--append %s %s" % (from_chain, return_if_marked),
+            "--append %s --src 10.0.0.1/32 --match mac "
+            "--mac-source AA:BB:CC:DD:EE:FF --jump %s" %
+            (from_chain, profile_to_chain_name("outbound", "prof2")),
+            "--append %s %s" % (from_chain, return_if_marked),
+        ])
+        self.assertTrue("--jump DROP" in updates[to_chain][-1])
+        self.assertTrue("--jump DROP" in updates[from_chain][-1])
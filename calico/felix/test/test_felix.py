@@ -60,6 +60,8 @@ class TestBasic(BaseTestCase):
         m_config.HOSTNAME = "myhost"
         m_config.IFACE_PREFIX = "tap"
         m_config.METADATA_IP = None
+        m_config.CHILD_ACTOR_MODEL = "greenlet"
+        m_config.UNUSED_GRACE_PERIOD = 30
         self.assertRaises(TestException,
                           felix._main_greenlet, m_config)
         m_load.assert_called_once_with(async=False)
@@ -0,0 +1,793 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_fetcd
+~~~~~~~~~~~~~~~~~~~~~
+
+Tests for the etcd watcher.
+"""
+import json
+import logging
+import socket
+from StringIO import StringIO
+
+import gevent
+from gevent.event import AsyncResult, Event
+import mock
+from etcd import (EtcdEventIndexCleared, EtcdKeyNotFound,
+                  EtcdClusterIdChanged)
+from urllib3.exceptions import ReadTimeoutError
+
+from calico.datamodel_v1 import EndpointId, VERSION_DIR
+from calico.common import BoundedCache, ValidationFailed
+from calico.felix.fetcd import (EtcdWatcher, EtcdNode, iter_snapshot_nodes,
+                                parse_rules, parse_tags, parse_endpoint,
+                                MAX_BATCHES_IN_FLIGHT, Backoff,
+                                new_etcd_client, ResyncScheduler)
+from calico.felix.config import RestartRequired
+from calico.felix.snapcache import CachedSnapshot
+from calico.felix.test.base import BaseTestCase
+
+_log = logging.getLogger(__name__)
+
+
+ENDPOINT_KEY = ("/calico/v1/host/h1/workload/o1/w1/endpoint/e1")
+ENDPOINT_ID = EndpointId("h1", "o1", "w1", "e1")
+ENDPOINT = {
+    "state": "active",
+    "name": "tap1234",
+    "mac": "aa:bb:cc:dd:ee:ff",
+    "profile_id": "prof1",
+    "ipv4_nets": ["10.0.0.1/32"],
+    "ipv6_nets": [],
+}
+RULES_KEY = "/calico/v1/policy/profile/prof1/rules"
+RULES = {"inbound_rules": [], "outbound_rules": []}
+TAGS_KEY = "/calico/v1/policy/profile/prof1/tags"
+TAGS = ["tag1"]
+
+
+def snapshot_json(values_by_key):
+    """
+    Builds the JSON for the response to a recursive GET of VERSION_DIR,
+    nesting the keys in directories in the same way as etcd.
+
+    :param values_by_key: dict mapping key to value or to a tuple of value
+        and modifiedIndex.  By default, the modifiedIndex is derived from
+        the key's position in the snapshot.
+    """
+    root = {"key": VERSION_DIR, "dir": True, "nodes": [],
+            "modifiedIndex": 1}
+    for mod_idx, (key, value) in enumerate(sorted(values_by_key.items())):
+        parent = root
+        parts = key[len(VERSION_DIR) + 1:].split("/")
+        for ii in range(1, len(parts)):
+            dir_key = "/".join([VERSION_DIR] + parts[:ii])
+            for node in parent["nodes"]:
+                if node["key"] == dir_key:
+                    parent = node
+                    break
+            else:
+                node = {"key": dir_key, "dir": True, "nodes": [],
+                        "modifiedIndex": 1}
+                parent["nodes"].append(node)
+                parent = node
+        if isinstance(value, tuple):
+            value, mod_idx = value
+        else:
+            mod_idx += 10
+        parent["nodes"].append({"key": key, "value": value,
+                                "modifiedIndex": mod_idx})
+    return json.dumps({"action": "get", "node": root})
+
+
+def snapshot_response(values_by_key, etcd_index=100, cluster_id="cluster-1"):
+    response = mock.Mock()
+    response.status = 200
+    response.read = StringIO(snapshot_json(values_by_key)).read
+    response.getheader.side_effect = {
+        "x-etcd-index": str(etcd_index),
+        "x-etcd-cluster-id": cluster_id,
+    }.get
+    return response
+
+
+class TestIterSnapshotNodes(BaseTestCase):
+    def test_leaves_only(self):
+        nodes = list(iter_snapshot_nodes(StringIO(snapshot_json({
+            "/calico/v1/Ready": "true",
+            RULES_KEY: "{}",
+            TAGS_KEY: "[]",
+        }))))
+        self.assertEqual(nodes, [
+            EtcdNode("get", "/calico/v1/Ready", "true", 10),
+            EtcdNode("get", RULES_KEY, "{}", 11),
+            EtcdNode("get", TAGS_KEY, "[]", 12),
+        ])
+
+
+class TestConnectionHelpers(BaseTestCase):
+    @mock.patch("gevent.sleep", autospec=True)
+    @mock.patch("random.uniform", autospec=True)
+    def test_backoff(self, m_uniform, m_sleep):
+        m_uniform.side_effect = lambda low, high: low
+        backoff = Backoff(1, 5)
+        for _ in range(4):
+            backoff.sleep()
+        self.assertEqual(m_uniform.mock_calls, [mock.call(0.5, 1),
+                                                mock.call(1.0, 2),
+                                                mock.call(2.0, 4),
+                                                mock.call(2.5, 5)])
+        self.assertEqual(m_sleep.mock_calls, [mock.call(0.5),
+                                              mock.call(1.0),
+                                              mock.call(2.0),
+                                              mock.call(2.5)])
+        backoff.reset()
+        backoff.sleep()
+        m_uniform.assert_called_with(0.5, 1)
+
+    @mock.patch("gevent.sleep", autospec=True)
+    @mock.patch("calico.felix.fetcd.time")
+    def test_resync_scheduler(self, m_time, m_sleep):
+        m_time.time.return_value = 1000
+        scheduler = ResyncScheduler("h1", 30, 10)
+        # Offset is deterministic and within the window.
+        self.assertEqual(scheduler.offset,
+                         ResyncScheduler("h1", 30, 10).offset)
+        self.assertTrue(0 <= scheduler.offset < 30)
+        self.assertNotEqual(scheduler.offset,
+                            ResyncScheduler("h2", 30, 10).offset)
+        # Initial snapshot isn't delayed.
+        scheduler.wait(False)
+        self.assertFalse(m_sleep.called)
+        # Later resyncs wait for the offset...
+        m_time.time.return_value = 2000
+        scheduler.wait(False)
+        m_sleep.assert_called_once_with(scheduler.offset)
+        # ...but retries only wait for the minimum interval.
+        m_sleep.reset_mock()
+        m_time.time.return_value = 2004
+        scheduler.wait(True)
+        m_sleep.assert_called_once_with(6)
+
+    def test_resync_scheduler_no_window(self):
+        self.assertEqual(ResyncScheduler("h1", 0, 10).offset, 0)
+
+    def test_client_keepalive(self):
+        client = new_etcd_client("localhost", 4001, "cluster-1")
+        self.assertEqual(client.expected_cluster_id, "cluster-1")
+        options = client.http.connection_pool_kw["socket_options"]
+        self.assertTrue((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) in
+                        options)
+
+
+class TestParseCaches(BaseTestCase):
+    def setUp(self):
+        super(TestParseCaches, self).setUp()
+        self.cache = BoundedCache(10)
+
+    def test_rules_shared(self):
+        value = json.dumps({"inbound_rules": [{"action": "allow"}],
+                            "outbound_rules": []})
+        rules1 = parse_rules("prof1", EtcdNode("get", RULES_KEY, value, 1),
+                             self.cache)
+        rules2 = parse_rules("prof2", EtcdNode("get", RULES_KEY, value, 2),
+                             self.cache)
+        self.assertEqual(rules1["id"], "prof1")
+        self.assertEqual(rules2["id"], "prof2")
+        self.assertTrue(rules1["inbound_rules"] is rules2["inbound_rules"])
+
+    @mock.patch("calico.common.validate_rules", autospec=True)
+    def test_rules_validated_once(self, m_validate):
+        value = json.dumps(RULES)
+        for ii in range(3):
+            parse_rules("prof1", EtcdNode("get", RULES_KEY, value, ii),
+                        self.cache)
+        self.assertEqual(m_validate.call_count, 1)
+
+    def test_rules_delete(self):
+        self.assertEqual(
+            parse_rules("prof1", EtcdNode("delete", RULES_KEY, None, 1),
+                        self.cache),
+            None
+        )
+
+    @mock.patch("calico.common.validate_tags", autospec=True)
+    def test_invalid_tags_cached(self, m_validate):
+        m_validate.side_effect = ValidationFailed("bad tags")
+        value = json.dumps(TAGS)
+        for ii in range(2):
+            tags = parse_tags("prof1", EtcdNode("get", TAGS_KEY, value, ii),
+                              self.cache)
+            self.assertEqual(tags, None)
+        self.assertEqual(m_validate.call_count, 1)
+
+    def test_endpoint_cached(self):
+        config = mock.Mock()
+        config.IFACE_PREFIX = "tap"
+        value = json.dumps(ENDPOINT)
+        ep1 = parse_endpoint(config, ENDPOINT_ID,
+                             EtcdNode("get", ENDPOINT_KEY, value, 1),
+                             self.cache)
+        ep2 = parse_endpoint(config, ENDPOINT_ID,
+                             EtcdNode("set", ENDPOINT_KEY, value, 2),
+                             self.cache)
+        self.assertEqual(ep1, ENDPOINT)
+        self.assertTrue(ep1 is ep2)
+
+
+class TestEtcdWatcher(BaseTestCase):
+    def setUp(self):
+        super(TestEtcdWatcher, self).setUp()
+        self.config = mock.Mock()
+        self.config.HOSTNAME = "h1"
+        self.config.IFACE_PREFIX = "tap"
+        self.config.SNAPSHOT_CACHE_FILE = None
+        self.watcher = EtcdWatcher(self.config)
+        self.watcher.client = mock.Mock()
+        self.watcher.client.expected_cluster_id = None
+        self.watcher.client.base_uri = "http://localhost:4001"
+        self.watcher.client.key_endpoint = "/v2/keys"
+        self.splitter = mock.Mock()
+
+    def load(self, values_by_key, cluster_id="cluster-1"):
+        # Each load is preceded by a reconnect, which forgets the cluster ID.
+        self.watcher.client.expected_cluster_id = None
+        self.watcher.client.http.request.return_value = \
+            snapshot_response(values_by_key, cluster_id=cluster_id)
+        return self.watcher._load_snapshot(self.splitter)
+
+    def test_load_snapshot(self):
+        index = self.load({
+            "/calico/v1/Ready": "true",
+            "/calico/v1/config/InterfacePrefix": "tap",
+            RULES_KEY: json.dumps(RULES),
+            TAGS_KEY: json.dumps(TAGS),
+            ENDPOINT_KEY: json.dumps(ENDPOINT),
+        })
+        self.assertEqual(index, 100)
+        self.assertEqual(self.watcher.client.expected_cluster_id,
+                         "cluster-1")
+        self.splitter.apply_updates.assert_called_once_with(
+            {"prof1": dict(RULES, id="prof1")},
+            {"prof1": TAGS},
+            {ENDPOINT_ID: ENDPOINT},
+            async=False
+        )
+        self.splitter.on_datamodel_in_sync.assert_called_once_with(
+            async=False
+        )
+        self.assertEqual(self.watcher.mod_idx_by_key,
+                         {ENDPOINT_KEY: 12, RULES_KEY: 13, TAGS_KEY: 14})
+
+    def test_load_snapshot_chunked(self):
+        with mock.patch("calico.felix.fetcd.SNAPSHOT_CHUNK_SIZE", 2):
+            self.load({
+                "/calico/v1/Ready": "true",
+                RULES_KEY: json.dumps(RULES),
+                TAGS_KEY: json.dumps(TAGS),
+                ENDPOINT_KEY: json.dumps(ENDPOINT),
+            })
+        self.assertEqual(self.splitter.apply_updates.mock_calls, [
+            mock.call({"prof1": dict(RULES, id="prof1")}, {},
+                      {ENDPOINT_ID: ENDPOINT}, async=False),
+            mock.call({}, {"prof1": TAGS}, {}, async=False),
+        ])
+
+    def test_load_snapshot_deletions(self):
+        self.load({
+            "/calico/v1/Ready": "true",
+            RULES_KEY: (json.dumps(RULES), 20),
+            TAGS_KEY: (json.dumps(TAGS), 21),
+            ENDPOINT_KEY: (json.dumps(ENDPOINT), 22),
+        })
+        self.splitter.reset_mock()
+        self.load({
+            "/calico/v1/Ready": "true",
+            TAGS_KEY: (json.dumps(TAGS), 21),
+        })
+        # Tags are unchanged so only the deletions should be sent.
+        self.splitter.apply_updates.assert_called_once_with(
+            {"prof1": None},
+            {},
+            {ENDPOINT_ID: None},
+            async=False
+        )
+        self.assertEqual(self.watcher.mod_idx_by_key, {TAGS_KEY: 21})
+
+    def test_load_snapshot_only_changes(self):
+        self.load({
+            "/calico/v1/Ready": "true",
+            RULES_KEY: (json.dumps(RULES), 20),
+            TAGS_KEY: (json.dumps(TAGS), 21),
+        })
+        self.splitter.reset_mock()
+        self.load({
+            "/calico/v1/Ready": "true",
+            RULES_KEY: (json.dumps(RULES), 20),
+            TAGS_KEY: (json.dumps(["tag2"]), 30),
+            ENDPOINT_KEY: (json.dumps(ENDPOINT), 31),
+        })
+        self.splitter.apply_updates.assert_called_once_with(
+            {},
+            {"prof1": ["tag2"]},
+            {ENDPOINT_ID: ENDPOINT},
+            async=False
+        )
+        self.splitter.on_datamodel_in_sync.assert_called_once_with(
+            async=False
+        )
+        self.assertEqual(self.watcher.mod_idx_by_key,
+                         {RULES_KEY: 20, TAGS_KEY: 30, ENDPOINT_KEY: 31})
+
+    def test_load_snapshot_cluster_id_changed(self):
+        self.load({
+            "/calico/v1/Ready": "true",
+            RULES_KEY: (json.dumps(RULES), 20),
+            TAGS_KEY: (json.dumps(TAGS), 21),
+        })
+        self.splitter.reset_mock()
+        # Same modifiedIndexes but from a different cluster; everything
+        # should be re-sent.
+        self.load({
+            "/calico/v1/Ready": "true",
+            RULES_KEY: (json.dumps(RULES), 20),
+            TAGS_KEY: (json.dumps(TAGS), 21),
+        }, cluster_id="cluster-2")
+        self.splitter.apply_updates.assert_called_once_with(
+            {"prof1": dict(RULES, id="prof1")},
+            {"prof1": TAGS},
+            {},
+            async=False
+        )
+
+    def test_load_snapshot_not_ready(self):
+        index = self.load({
+            "/calico/v1/Ready": "false",
+            RULES_KEY: json.dumps(RULES),
+        })
+        self.assertEqual(index, None)
+        self.assertFalse(self.splitter.apply_updates.called)
+        self.assertFalse(self.splitter.on_datamodel_in_sync.called)
+
+    def test_load_snapshot_no_ready_flag(self):
+        index = self.load({
+            RULES_KEY: json.dumps(RULES),
+        })
+        self.assertEqual(index, None)
+        self.assertFalse(self.splitter.apply_updates.called)
+
+    def test_load_snapshot_truncated(self):
+        response = snapshot_response({
+            "/calico/v1/Ready": "true",
+            RULES_KEY: json.dumps(RULES),
+        })
+        response.read = StringIO(snapshot_json({
+            "/calico/v1/Ready": "true",
+            RULES_KEY: json.dumps(RULES),
+        })[:-20]).read
+        self.watcher.client.http.request.return_value = response
+        index = self.watcher._load_snapshot(self.splitter)
+        self.assertEqual(index, None)
+        self.assertTrue(response.close.called)
+        self.assertFalse(self.splitter.on_datamodel_in_sync.called)
+
+    def test_load_snapshot_failure_resends_unsent_keys(self):
+        values = {
+            "/calico/v1/Ready": "true",
+            RULES_KEY: json.dumps(RULES),
+            TAGS_KEY: json.dumps(TAGS),
+            ENDPOINT_KEY: json.dumps(ENDPOINT),
+        }
+        # Fail after all the keys have been parsed but before the tags have
+        # been sent.
+        response = snapshot_response(values)
+        response.read = StringIO(snapshot_json(values)[:-1]).read
+        self.watcher.client.http.request.return_value = response
+        with mock.patch("calico.felix.fetcd.SNAPSHOT_CHUNK_SIZE", 2):
+            index = self.watcher._load_snapshot(self.splitter)
+        self.assertEqual(index, None)
+        self.splitter.apply_updates.assert_called_once_with(
+            {"prof1": dict(RULES, id="prof1")}, {}, {ENDPOINT_ID: ENDPOINT},
+            async=False
+        )
+        self.assertEqual(self.watcher.mod_idx_by_key,
+                         {ENDPOINT_KEY: 11, RULES_KEY: 12})
+        # The retry should send the tags, which we never passed on.
+        self.splitter.reset_mock()
+        self.assertEqual(self.load(values), 100)
+        self.splitter.apply_updates.assert_called_once_with(
+            {}, {"prof1": TAGS}, {}, async=False
+        )
+        self.assertEqual(self.watcher.mod_idx_by_key,
+                         {ENDPOINT_KEY: 11, RULES_KEY: 12, TAGS_KEY: 13})
+
+    def test_load_snapshot_no_ready_flag_records_nothing(self):
+        self.load({
+            RULES_KEY: json.dumps(RULES),
+        })
+        self.assertEqual(self.watcher.mod_idx_by_key, {})
+
+    @mock.patch("calico.felix.fetcd.ResyncScheduler", autospec=True)
+    def test_config_reloaded_after_each_snapshot(self, m_scheduler):
+        w = self.watcher
+        with mock.patch.multiple(w, _create_pollers=mock.DEFAULT,
+                                 _apply_cached_snapshot=mock.DEFAULT,
+                                 _wait_for_updates_applied=mock.DEFAULT,
+                                 wait_for_ready=mock.DEFAULT,
+                                 _load_snapshot=mock.DEFAULT,
+                                 _reload_config=mock.DEFAULT,
+                                 _poll_until_resync_needed=mock.DEFAULT):
+            # As if load_config() succeeded.
+            w.config_dicts = ({}, {})
+            w._apply_cached_snapshot.return_value = None
+            w._load_snapshot.side_effect = [10, 20]
+            w._poll_until_resync_needed.side_effect = [None, SystemExit()]
+            result = w.watch_etcd(self.splitter, async=True)
+            w._step()
+            self.assertRaises(SystemExit, result.get)
+            self.assertEqual(w._reload_config.mock_calls,
+                             [mock.call(10), mock.call(20)])
+
+    def test_apply_cached_snapshot(self):
+        self.config.SNAPSHOT_CACHE_FILE = "/tmp/cache"
+        self.watcher.cached_snapshot = CachedSnapshot(
+            "cluster-1", 1234, None, [
+                (RULES_KEY, 20, json.dumps(RULES)),
+                (TAGS_KEY, 21, json.dumps("not a list")),
+                (ENDPOINT_KEY, 22, json.dumps(ENDPOINT)),
+            ]
+        )
+        index = self.watcher._apply_cached_snapshot(self.splitter)
+        self.assertEqual(index, 1234)
+        self.assertEqual(self.watcher.cached_snapshot, None)
+        self.assertEqual(self.watcher.known_cluster_id, "cluster-1")
+        # Invalid tags are filtered out.
+        self.splitter.apply_snapshot.assert_called_once_with(
+            {"prof1": dict(RULES, id="prof1")},
+            {},
+            {ENDPOINT_ID: ENDPOINT},
+            async=False
+        )
+        self.assertEqual(self.watcher.mod_idx_by_key,
+                         {RULES_KEY: 20, TAGS_KEY: 21, ENDPOINT_KEY: 22})
+
+    def test_no_cached_snapshot(self):
+        self.assertEqual(self.watcher._apply_cached_snapshot(self.splitter),
+                         None)
+        self.assertFalse(self.splitter.apply_snapshot.called)
+
+    @mock.patch("calico.felix.fetcd.time")
+    @mock.patch("calico.felix.snapcache.save", autospec=True)
+    def test_save_cache(self, m_save, m_time):
+        self.config.SNAPSHOT_CACHE_FILE = "/tmp/cache"
+        self.config.SNAPSHOT_CACHE_INTERVAL = 60
+        m_time.time.return_value = 1000
+        self.watcher.config_dicts = ({}, {"InterfacePrefix": "tap"})
+        self.load({
+            "/calico/v1/Ready": "true",
+            TAGS_KEY: (json.dumps(TAGS), 21),
+        })
+        self.watcher._maybe_save_cache(100)
+        # The save happens in the background.
+        self.assertFalse(m_save.called)
+        self.watcher._cache_saver.join()
+        m_save.assert_called_once_with("/tmp/cache", CachedSnapshot(
+            "cluster-1", 100, ({}, {"InterfacePrefix": "tap"}),
+            [(TAGS_KEY, 21, json.dumps(TAGS))]
+        ))
+        # Shouldn't save again until the interval has passed.
+        m_time.time.return_value = 1059
+        self.watcher._maybe_save_cache(101)
+        self.watcher._cache_saver.join()
+        self.assertEqual(m_save.call_count, 1)
+        m_time.time.return_value = 1060
+        self.watcher._maybe_save_cache(102)
+        self.watcher._cache_saver.join()
+        self.assertEqual(m_save.call_count, 2)
+
+    @mock.patch("calico.felix.fetcd.time")
+    @mock.patch("calico.felix.snapcache.save", autospec=True)
+    def test_save_cache_in_progress(self, m_save, m_time):
+        self.config.SNAPSHOT_CACHE_FILE = "/tmp/cache"
+        self.config.SNAPSHOT_CACHE_INTERVAL = 60
+        m_time.time.return_value = 1000
+        save_done = Event()
+        m_save.side_effect = lambda path, snapshot: save_done.wait()
+        self.watcher._maybe_save_cache(100)
+        gevent.sleep(0)
+        self.assertEqual(m_save.call_count, 1)
+        # A save that's due while the previous one is in progress is
+        # skipped...
+        m_time.time.return_value = 2000
+        self.watcher._maybe_save_cache(101)
+        gevent.sleep(0)
+        self.assertEqual(m_save.call_count, 1)
+        # ...unless it's forced, in which case it waits for the previous
+        # save and then for its own.
+        gevent.spawn_later(0.01, save_done.set)
+        self.watcher._maybe_save_cache(102, force=True)
+        self.assertEqual(m_save.call_count, 2)
+        self.assertTrue(self.watcher._cache_saver.ready())
+
+    @mock.patch("calico.felix.snapcache.save", autospec=True)
+    def test_save_cache_disabled(self, m_save):
+        self.watcher._maybe_save_cache(100)
+        self.assertFalse(m_save.called)
+
+
+class TestSubtreePolling(BaseTestCase):
+    def setUp(self):
+        super(TestSubtreePolling, self).setUp()
+        self.config = mock.Mock()
+        self.config.HOSTNAME = "h1"
+        self.config.IFACE_PREFIX = "tap"
+        self.config.ETCD_ADDR = "localhost:4001"
+        self.config.SNAPSHOT_CACHE_FILE = None
+        self.watcher = EtcdWatcher(self.config)
+        self.watcher.client = mock.Mock()
+        self.watcher.client.expected_cluster_id = "cluster-1"
+        self.watcher._create_pollers()
+        self.pollers = dict((p.name, p) for p in self.watcher.pollers)
+        for poller in self.watcher.pollers:
+            poller.client = mock.Mock()
+            poller.start_polling(10, "cluster-1")
+        self.splitter = mock.Mock()
+        # Current etcd index, as read before each poll.
+        self.etcd_index = 10
+
+    def set_poll_results(self, poller, results):
+        """
+        Makes the poller's polls return (or raise) each of the given
+        results in turn.  Reads of the current etcd index return
+        self.etcd_index.
+        """
+        results = iter(results)
+
+        def read(key, **kwargs):
+            if not kwargs.get("wait"):
+                return mock.Mock(etcd_index=self.etcd_index)
+            result = next(results)
+            if callable(result) and not isinstance(result, mock.Mock):
+                result = result(kwargs["waitIndex"])
+            if isinstance(result, Exception):
+                raise result
+            return result
+        poller.client.read.side_effect = read
+
+    def wait_indexes(self, poller):
+        return [c[2]["waitIndex"] for c in poller.client.read.mock_calls
+                if c[2].get("wait")]
+
+    def event(self, key, value, mod_idx, action="set"):
+        response = mock.Mock()
+        response.key = key
+        response.value = value
+        response.action = action
+        response.modifiedIndex = mod_idx
+        return response
+
+    def test_pollers(self):
+        self.assertEqual(
+            sorted((p.prefix, p.recursive, p.exclude_prefix)
+                   for p in self.watcher.pollers),
+            [("/calico/v1/Ready", False, None),
+             ("/calico/v1/config", True, None),
+             ("/calico/v1/host", True, "/calico/v1/host/h1"),
+             ("/calico/v1/host/h1", True, None),
+             ("/calico/v1/policy/profile", True, None)]
+        )
+
+    def test_remote_poller_ignores_local_host(self):
+        poller = self.pollers["remote hosts"]
+        local_key = "/calico/v1/host/h1/workload/o1/w1/endpoint/e1"
+        remote_key = "/calico/v1/host/h10/workload/o1/w1/endpoint/e1"
+        for key in [local_key, remote_key]:
+            self.assertTrue(self.watcher._handle_poll_response(
+                poller, self.event(key, json.dumps(ENDPOINT), 11),
+                self.splitter
+            ))
+        self.splitter.apply_updates.assert_called_once_with(
+            {}, {}, {EndpointId("h10", "o1", "w1", "e1"): ENDPOINT},
+            async=True
+        )
+        self.assertEqual(self.watcher.mod_idx_by_key, {remote_key: 11})
+
+    def test_parent_deletion_triggers_resync(self):
+        self.assertFalse(self.watcher._handle_poll_response(
+            self.pollers["profiles"],
+            self.event("/calico/v1/policy", None, 11, action="delete"),
+            self.splitter
+        ))
+        self.assertFalse(self.watcher._handle_poll_response(
+            self.pollers["local host"],
+            self.event("/calico/v1/host", None, 11, action="delete"),
+            self.splitter
+        ))
+
+    def config_event(self):
+        self.watcher.client.read.side_effect = [
+            mock.Mock(children=[mock.Mock(key="/calico/v1/config/"
+                                              "ResyncWindow",
+                                          value="60")]),
+            EtcdKeyNotFound(),
+        ]
+        return self.event("/calico/v1/config/ResyncWindow", "60", 11)
+
+    def test_config_change_reloaded(self):
+        self.watcher.resync_scheduler = ResyncScheduler("h1", 30, 10)
+        self.config.update_etcd_config.return_value = set(["ResyncWindow"])
+        self.config.RESYNC_WINDOW = 60
+        self.assertTrue(self.watcher._handle_poll_response(
+            self.pollers["config"], self.config_event(), self.splitter
+        ))
+        self.config.update_etcd_config.assert_called_once_with(
+            {}, {"ResyncWindow": "60"}
+        )
+        self.assertEqual(self.watcher.config_dicts,
+                         ({}, {"ResyncWindow": "60"}))
+        self.assertEqual(self.watcher.resync_scheduler.offset,
+                         ResyncScheduler("h1", 60, 10).offset)
+
+    @mock.patch("calico.felix.snapcache.save", autospec=True)
+    def test_config_change_needs_restart(self, m_save):
+        self.config.SNAPSHOT_CACHE_FILE = "/tmp/cache"
+        self.config.SNAPSHOT_CACHE_INTERVAL = 60
+        # Just saved the cache.
+        self.watcher.last_cache_save_time = float("inf")
+        self.config.update_etcd_config.side_effect = \
+            RestartRequired(["InterfacePrefix"])
+        self.assertRaises(RestartRequired,
+                          self.watcher._handle_poll_response,
+                          self.pollers["config"], self.config_event(),
+                          self.splitter)
+        # The cache is saved, however recently we last saved it.
+        self.assertEqual(m_save.call_count, 1)
+        self.assertEqual(m_save.call_args[0][1].config,
+                         ({}, {"ResyncWindow": "60"}))
+
+    def test_poll_subtree(self):
+        poller = self.pollers["profiles"]
+        self.set_poll_results(poller, [
+            self.event(TAGS_KEY, json.dumps(TAGS), 15),
+            EtcdEventIndexCleared("Cleared"),
+        ])
+        resync_needed = Event()
+        self.watcher._poll_subtree(poller, self.splitter, resync_needed)
+        self.assertTrue(resync_needed.is_set())
+        self.assertEqual(poller.next_index, 16)
+        self.assertEqual(poller.client.read.mock_calls[-1],
+                         mock.call("/calico/v1/policy/profile", wait=True,
+                                   waitIndex=16, recursive=True,
+                                   timeout=mock.ANY, check_cluster_uuid=True))
+        self.splitter.apply_updates.assert_called_once_with(
+            {}, {"prof1": TAGS}, {}, async=True
+        )
+
+    def test_quiet_poller_advances(self):
+        poller = self.pollers["config"]
+        timeout = ReadTimeoutError(None, None, "Timed out")
+        self.etcd_index = 500
+        self.set_poll_results(poller, [timeout, timeout,
+                                       EtcdEventIndexCleared("Cleared")])
+        self.watcher._poll_subtree(poller, self.splitter, Event())
+        # The first poll timing out tells us that nothing happened in the
+        # subtree up to the index that we read before it.
+        self.assertEqual(self.wait_indexes(poller), [10, 501, 501])
+
+    def test_quiet_poller_keeps_up(self):
+        """
+        A quiet poller keeps up with the cluster's event history while many
+        more events than etcd remembers happen elsewhere.
+        """
+        poller = self.pollers["profiles"]
+        self.etcd_index = 500
+
+        def timed_out_poll(wait_index):
+            # etcd only remembers the last 1000 events.
+            if wait_index <= self.etcd_index - 1000:
+                return EtcdEventIndexCleared("Cleared")
+            # 600 events happen in other subtrees during each poll.
+            self.etcd_index += 600
+            return ReadTimeoutError(None, None, "Timed out")
+
+        self.set_poll_results(poller, [
+            self.event(TAGS_KEY, json.dumps(TAGS), 11)
+        ] + [timed_out_poll] * 5 + [EtcdClusterIdChanged("Stop")])
+        resync_needed = Event()
+        self.watcher._poll_subtree(poller, self.splitter, resync_needed)
+        self.assertTrue(resync_needed.is_set())
+        self.assertEqual(self.wait_indexes(poller),
+                         [10, 12, 501, 1101, 1701, 2301, 2901])
+
+    def test_resync_stops_all_pollers(self):
+        for poller in self.watcher.pollers:
+            self.set_poll_results(poller,
+                                  [lambda idx: gevent.sleep(10)])
+        self.set_poll_results(self.pollers["ready"], [
+            self.event("/calico/v1/Ready", "false", 11)
+        ])
+        with mock.patch.object(self.watcher, "_poll_subtree",
+                               wraps=self.watcher._poll_subtree) as m_poll:
+            self.watcher._poll_until_resync_needed(self.splitter, 20)
+        self.assertEqual(m_poll.call_count, 5)
+        for poller in self.watcher.pollers:
+            self.assertEqual(poller.client.expected_cluster_id, "cluster-1")
+        self.assertEqual(self.pollers["ready"].next_index, 21)
+        self.assertEqual(self.pollers["config"].next_index, 20)
+
+
+class TestPipelinedUpdates(BaseTestCase):
+    def setUp(self):
+        super(TestPipelinedUpdates, self).setUp()
+        self.config = mock.Mock()
+        self.config.SNAPSHOT_CACHE_FILE = None
+        self.watcher = EtcdWatcher(self.config)
+        self.watcher.greenlet = mock.Mock()
+        self.splitter = mock.Mock()
+        self.results = []
+        self.splitter.apply_updates.side_effect = self.on_apply_updates
+
+    def on_apply_updates(self, *args, **kwargs):
+        result = AsyncResult()
+        self.results.append(result)
+        return result
+
+    def send_tags(self, profile_id, tags):
+        self.watcher._pending_batch.tags_by_prof_id[profile_id] = tags
+        self.watcher._send_pending_updates(self.splitter)
+
+    def test_pipelined(self):
+        for ii in range(MAX_BATCHES_IN_FLIGHT):
+            self.send_tags("prof%s" % ii, ["tag"])
+        # None of the batches has completed but we don't block.
+        self.assertEqual(self.splitter.apply_updates.call_count,
+                         MAX_BATCHES_IN_FLIGHT)
+        self.assertFalse(self.watcher._updates_applied.is_set())
+        # Further updates get accumulated and coalesced.
+        self.send_tags("prof0", ["tag1"])
+        self.send_tags("prof0", ["tag2"])
+        self.send_tags("prof1", None)
+        self.assertEqual(self.splitter.apply_updates.call_count,
+                         MAX_BATCHES_IN_FLIGHT)
+        # When the first batch completes, the accumulated updates are sent.
+        self.results[0].set(None)
+        gevent.sleep()
+        self.assertEqual(self.splitter.apply_updates.call_count,
+                         MAX_BATCHES_IN_FLIGHT + 1)
+        self.splitter.apply_updates.assert_called_with(
+            {}, {"prof0": ["tag2"], "prof1": None}, {}, async=True
+        )
+        for result in self.results[1:]:
+            result.set(None)
+        gevent.sleep()
+        self.assertTrue(self.watcher._updates_applied.is_set())
+        self.assertEqual(self.watcher._batches_in_flight, 0)
+
+    def test_wait_for_updates_applied(self):
+        self.send_tags("prof1", ["tag"])
+        waiter = gevent.spawn(self.watcher._wait_for_updates_applied)
+        gevent.sleep()
+        self.assertFalse(waiter.ready())
+        self.results[0].set(None)
+        waiter.join(timeout=1)
+        self.assertTrue(waiter.successful())
+
+    def test_failure_kills_watcher(self):
+        self.send_tags("prof1", ["tag"])
+        exc = Exception("Splitter failed")
+        self.results[0].set_exception(exc)
+        gevent.sleep()
+        self.watcher.greenlet.kill.assert_called_once_with(exc, block=False)
@@ -1,6 +1,7 @@
 # Copyright (c) Metaswitch Networks 2015. All rights reserved.
 
 import logging
+import gevent
 from calico.felix.actor import actor_message
 from calico.felix.refcount import ReferenceManager, RefCountedActor, \
     RefHelper, LIVE, STOPPING
@@ -13,9 +14,11 @@ _log = logging.getLogger(__name__)
 
 
 class TestReferenceManager(BaseTestCase):
+    multiplex_objects = False
+
     def setUp(self):
         super(TestReferenceManager, self).setUp()
-        self._rm = RefMgrForTesting()
+        self._rm = RefMgrForTesting(multiplex_objects=self.multiplex_objects)
         self._rm.start()
 
     def call_via_cb(self, fn, *args, **kwargs):
@@ -107,6 +110,105 @@ class TestReferenceManager(BaseTestCase):
             (3, 'on_referenced')
         ])
 
+    def test_notify_when_programmed(self):
+        def on_programmed():
+            self._rm.ref_actions.append(("client", "programmed"))
+        self._rm.get_and_incref("foo", async=True)
+        self._rm.get_and_incref("bar", async=True)
+        self._rm.decref("bar", async=True)
+        self._rm.notify_when_programmed(on_programmed, async=True)
+        # Drain the queue.
+        self.call_via_cb(self._rm.get_and_incref, "foo", async=True)
+        self.assertEqual(self._rm.ref_actions, [
+            ("rm", "activate 0"),
+            ("rm", "activate 1"),
+            (0, "on_referenced"),
+            (1, "on_referenced"),
+            (1, "on_unreferenced"),
+            # Only called back once foo is LIVE.  bar is no longer
+            # referenced so we don't wait for it.
+            ("client", "programmed"),
+            ("rm", "recv cleanup complete"),
+        ])
+
+    def test_notify_when_programmed_nothing_to_wait_for(self):
+        callback = mock.Mock()
+        self._rm.notify_when_programmed(callback, async=False)
+        callback.assert_called_once_with()
+
+
+class TestMultiplexedReferenceManager(TestReferenceManager):
+    """
+    Re-runs the ReferenceManager tests with the objects running on the
+    manager's greenlet.
+    """
+    multiplex_objects = True
+
+    def test_objects_share_greenlet(self):
+        _, obj = self.call_via_cb(self._rm.get_and_incref, "foo", async=True)
+        self.assertTrue(obj.greenlet is self._rm.greenlet)
+
+
+class TestGracePeriod(BaseTestCase):
+    def setUp(self):
+        super(TestGracePeriod, self).setUp()
+        self._rm = RefMgrForTesting(grace_period=0.05)
+        self._rm.start()
+
+    def get(self, obj_id):
+        result = AsyncResult()
+        self._rm.get_and_incref(obj_id, callback=lambda *a: result.set(a[1]),
+                                async=True)
+        return result.get(timeout=5)
+
+    def test_revive(self):
+        obj = self.get("foo")
+        self._rm.decref("foo", async=False)
+        # Still live, ready to be revived.
+        self.assertEqual(obj.ref_mgmt_state, LIVE)
+        self.assertTrue(self._rm._is_starting_or_live("foo"))
+        self.assertTrue(self.get("foo") is obj)
+        self.assertEqual(obj.ref_count, 1)
+        # Shouldn't be cleaned up after its grace period.
+        gevent.sleep(0.1)
+        self._rm.decref("foo", async=False)
+        self.assertEqual(self._rm.ref_actions, [
+            ("rm", "activate 0"),
+            (0, "on_referenced"),
+        ])
+
+    def test_expiry(self):
+        obj = self.get("foo")
+        self._rm.decref("foo", async=False)
+        gevent.sleep(0.1)
+        self.get("bar")  # Drains the queue.
+        self.assertEqual(obj.ref_mgmt_state, STOPPING)
+        self.assertFalse("foo" in self._rm.objects_by_id)
+        self.assertTrue((0, "on_unreferenced") in self._rm.ref_actions)
+        self.assertTrue(self.get("foo") is not obj)
+
+    def test_pool_limit(self):
+        self._rm.max_warm_objects = 1
+        foo = self.get("foo")
+        bar = self.get("bar")
+        self._rm.decref("foo", async=False)
+        self._rm.decref("bar", async=False)
+        # foo was evicted to make room for bar.
+        self.assertEqual(foo.ref_mgmt_state, STOPPING)
+        self.assertEqual(bar.ref_mgmt_state, LIVE)
+
+    def test_pool_limit_after_revive(self):
+        self._rm.max_warm_objects = 1
+        foo = self.get("foo")
+        bar = self.get("bar")
+        self._rm.decref("foo", async=False)
+        self.assertTrue(self.get("foo") is foo)
+        self._rm.decref("bar", async=False)
+        self._rm.decref("foo", async=False)
+        # bar is now the oldest warm object, so it's the one evicted.
+        self.assertEqual(bar.ref_mgmt_state, STOPPING)
+        self.assertEqual(foo.ref_mgmt_state, LIVE)
+
 
 class TestRefHelper(TestReferenceManager):
     def setUp(self):
@@ -126,6 +228,7 @@ class TestRefHelper(TestReferenceManager):
     def test_acquire_discard_1(self):
         # Acquire a reference to 'foo' - it won't be ready immediately
         self._rh.acquire_ref("foo")
+        self._rh.flush()
         self.assertFalse(self._rm._ready_called)
         self.assertFalse(self._rh.ready)
 
@@ -141,6 +244,7 @@ class TestRefHelper(TestReferenceManager):
 
         # Discard the reference
         self._rh.discard_ref("foo")
+        self._rh.flush()
         _, obj = self.call_via_cb(self._rm.get_and_incref, "baz", async=True)
         self.assertTrue(self._rh.ready)
 
@@ -158,8 +262,10 @@ class TestRefHelper(TestReferenceManager):
     def test_acquire_discard_2(self):
         # Acquire two references
         self._rh.acquire_ref("foo")
+        self._rh.flush()
         _, obj = self.call_via_cb(self._rm.get_and_incref, "bar", async=True)
         self._rh.acquire_ref("baz")
+        self._rh.flush()
         self.assertFalse(self._rh.ready)
         _, obj = self.call_via_cb(self._rm.get_and_incref, "bar2", async=True)
         acq_ids = list(key for key, value in self._rh.iteritems())
@@ -169,10 +275,45 @@ class TestRefHelper(TestReferenceManager):
         # Discard them all!
         self._rh.discard_all()
 
+    def test_batched_requests(self):
+        self._rh.acquire_ref("foo")
+        self._rh.acquire_ref("bar")
+        self._rh.acquire_ref("baz")
+        # Never requested so doesn't need to be decreffed.
+        self._rh.discard_ref("baz")
+        with mock.patch.object(self._rm, "get_and_incref_many",
+                               wraps=self._rm.get_and_incref_many) as m_get:
+            self._rh.flush()
+            self._rh.flush()  # No-op, nothing queued.
+        m_get.assert_called_once_with(set(["foo", "bar"]),
+                                      callback=mock.ANY, async=True)
+        self.call_via_cb(self._rm.get_and_incref, "sync", async=True)
+        self.assertTrue(self._rm._ready_called)
+        self.assertItemsEqual(dict(self._rh.iteritems()).keys(),
+                              ["foo", "bar"])
+
+        # Discarding and re-acquiring in the same batch keeps the object.
+        foo = self._rm.objects_by_id["foo"]
+        self._rh.discard_ref("foo")
+        self._rh.acquire_ref("foo")
+        self._rh.discard_ref("bar")
+        self._rh.flush()
+        self.call_via_cb(self._rm.get_and_incref, "sync", async=True)
+        self.assertTrue(self._rm.objects_by_id["foo"] is foo)
+        self.assertEqual(foo.ref_count, 1)
+        self.assertFalse("bar" in self._rm.objects_by_id)
+        self.assertItemsEqual(dict(self._rh.iteritems()).keys(), ["foo"])
+
+    def test_get_and_incref_many_empty(self):
+        callback = mock.Mock()
+        self._rm.get_and_incref_many([], callback, async=False)
+        callback.assert_called_once_with({})
+
 
 class RefMgrForTesting(ReferenceManager):
-    def __init__(self):
-        super(RefMgrForTesting, self).__init__()
+    def __init__(self, multiplex_objects=False, grace_period=0):
+        super(RefMgrForTesting, self).__init__(
+            multiplex_objects=multiplex_objects, grace_period=grace_period)
         self.idx = 0
         self.ref_actions = []
         self._ready_called = False
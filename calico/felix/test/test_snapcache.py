@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_snapcache
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests for the on-disk snapshot cache.
+"""
+import logging
+import marshal
+import os
+import shutil
+import tempfile
+
+from calico.felix import snapcache
+from calico.felix.snapcache import CachedSnapshot
+from calico.felix.test.base import BaseTestCase
+
+_log = logging.getLogger(__name__)
+
+
+class TestSnapCache(BaseTestCase):
+    def setUp(self):
+        super(TestSnapCache, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "subdir", "snapshot.cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        super(TestSnapCache, self).tearDown()
+
+    def test_round_trip(self):
+        snapshot = CachedSnapshot(
+            "cluster-1",
+            1234,
+            ({"InterfacePrefix": "tap"}, {"LogSeverityFile": "DEBUG"}),
+            [(u"/calico/v1/policy/profile/prof1/tags", 12, u'["a"]')]
+        )
+        snapcache.save(self.path, snapshot)
+        self.assertEqual(snapcache.load(self.path), snapshot)
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    def test_missing(self):
+        self.assertEqual(snapcache.load(self.path), None)
+
+    def test_corrupt(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, "wb") as f:
+            f.write("garbage")
+        self.assertEqual(snapcache.load(self.path), None)
+
+    def test_wrong_version(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, "wb") as f:
+            marshal.dump({"version": snapcache.FORMAT_VERSION + 1}, f)
+        self.assertEqual(snapcache.load(self.path), None)
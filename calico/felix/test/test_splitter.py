@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_splitter
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests of the actor that splits updates out to the managers.
+"""
+import gevent
+import mock
+
+from calico.datamodel_v1 import EndpointId
+from calico.felix.splitter import (UpdateSplitter, local_subset,
+                                   profile_for_ip_version)
+from calico.felix.test.base import BaseTestCase
+
+LOCAL_EP_ID = EndpointId("h1", "o", "w1", "e1")
+LOCAL_EP = {"profile_id": "web", "ipv4_nets": ["10.0.0.1/32"]}
+REMOTE_DB_ID = EndpointId("h2", "o", "w2", "e2")
+REMOTE_DB = {"profile_id": "db", "ipv4_nets": ["10.0.0.2/32"]}
+REMOTE_OTHER_ID = EndpointId("h2", "o", "w3", "e3")
+REMOTE_OTHER = {"profile_id": "other", "ipv4_nets": ["10.0.0.3/32"]}
+ENDPOINTS = {
+    LOCAL_EP_ID: LOCAL_EP,
+    REMOTE_DB_ID: REMOTE_DB,
+    REMOTE_OTHER_ID: REMOTE_OTHER,
+}
+WEB_RULES = {"inbound_rules": [{"src_tag": "db"}], "outbound_rules": []}
+RULES = {
+    "web": WEB_RULES,
+    "db": {"inbound_rules": [{"src_tag": "web"}], "outbound_rules": []},
+    "other": {"inbound_rules": [], "outbound_rules": []},
+}
+TAGS = {"web": ["web"], "db": ["db"], "other": ["other"]}
+
+
+class TestLocalSubset(BaseTestCase):
+    def test_local_subset(self):
+        local_rules, local_tags, local_eps, ipset_eps = local_subset(
+            "h1", RULES, TAGS, ENDPOINTS
+        )
+        self.assertEqual(local_rules, {"web": WEB_RULES})
+        self.assertEqual(local_tags, {"db": ["db"]})
+        self.assertEqual(local_eps, {LOCAL_EP_ID: LOCAL_EP})
+        self.assertEqual(ipset_eps, {REMOTE_DB_ID: REMOTE_DB})
+
+    def test_local_subset_multiple_profiles(self):
+        local_ep = {"profile_ids": ["other", "web"],
+                    "ipv4_nets": ["10.0.0.1/32"]}
+        endpoints = dict(ENDPOINTS)
+        endpoints[LOCAL_EP_ID] = local_ep
+        local_rules, local_tags, local_eps, ipset_eps = local_subset(
+            "h1", RULES, TAGS, endpoints
+        )
+        self.assertEqual(local_rules, {"web": WEB_RULES,
+                                       "other": RULES["other"]})
+        self.assertEqual(local_tags, {"db": ["db"]})
+        self.assertEqual(ipset_eps, {REMOTE_DB_ID: REMOTE_DB})
+
+    def test_no_local_endpoints(self):
+        self.assertEqual(local_subset("h3", RULES, TAGS, ENDPOINTS),
+                         ({}, {}, {}, {}))
+
+
+class TestUpdateSplitter(BaseTestCase):
+    def setUp(self):
+        super(TestUpdateSplitter, self).setUp()
+        self.config = mock.Mock()
+        self.config.HOSTNAME = "h1"
+        self.config.STARTUP_CLEANUP_DELAY = 30
+        self.mgr = mock.Mock()
+        # The managers' mock calls are all recorded, in order, on self.mgr.
+        for name in ["ipsets", "rules", "endpoints", "iptables"]:
+            getattr(self.mgr, name).notify_when_programmed.side_effect = \
+                lambda callback, async: callback()
+        self.splitter = UpdateSplitter(self.config,
+                                       [self.mgr.ipsets],
+                                       [self.mgr.rules],
+                                       [self.mgr.endpoints],
+                                       [self.mgr.iptables])
+        self.splitter.start()
+
+    def test_apply_snapshot_local_first(self):
+        self.splitter.apply_snapshot(RULES, TAGS, ENDPOINTS, async=False)
+        self.assertEqual(self.mgr.mock_calls[:8], [
+            # Local endpoints and their dependencies.
+            mock.call.rules.apply_updates({"web": WEB_RULES}, async=True),
+            mock.call.ipsets.apply_updates({"db": ["db"]},
+                                           {REMOTE_DB_ID: REMOTE_DB},
+                                           async=True),
+            mock.call.endpoints.apply_snapshot({LOCAL_EP_ID: LOCAL_EP},
+                                               async=True),
+            # Wait for them to be programmed.
+            mock.call.endpoints.notify_when_programmed(mock.ANY, async=True),
+            mock.call.rules.notify_when_programmed(mock.ANY, async=True),
+            mock.call.ipsets.notify_when_programmed(mock.ANY, async=True),
+            # Then the rest.
+            mock.call.rules.apply_snapshot(RULES, async=True),
+            mock.call.ipsets.apply_snapshot(TAGS, ENDPOINTS, async=True),
+        ])
+
+    def test_cleanup_when_programmed(self):
+        self.splitter.on_datamodel_in_sync(async=False)
+        # Let the cleanup greenlet and then the cleanup itself run.
+        gevent.sleep()
+        self.splitter.on_interface_update("tap1", async=False)
+        self.mgr.iptables.cleanup.assert_called_once_with(async=False)
+        self.mgr.ipsets.cleanup.assert_called_once_with(async=False)
+
+    def test_cleanup_timeout(self):
+        self.config.STARTUP_CLEANUP_DELAY = 0.01
+        self.mgr.ipsets.notify_when_programmed.side_effect = None
+        self.splitter.on_datamodel_in_sync(async=False)
+        gevent.sleep(0.02)
+        self.splitter.on_interface_update("tap1", async=False)
+        self.mgr.iptables.cleanup.assert_called_once_with(async=False)
+
+
+class TestPerFamilyViews(BaseTestCase):
+    def setUp(self):
+        super(TestPerFamilyViews, self).setUp()
+        self.config = mock.Mock()
+        self.config.HOSTNAME = "h1"
+        self.config.STARTUP_CLEANUP_DELAY = 30
+        self.v4 = mock.Mock()
+        self.v6 = mock.Mock()
+        self.splitter = UpdateSplitter(self.config,
+                                       [self.v4.ipsets, self.v6.ipsets],
+                                       [self.v4.rules, self.v6.rules],
+                                       [self.v4.endpoints, self.v6.endpoints],
+                                       [self.v4.iptables, self.v6.iptables])
+        self.splitter.start()
+
+    def test_profile_for_ip_version(self):
+        v4_rule = {"ip_version": 4, "src_tag": "a"}
+        v6_rule = {"ip_version": 6, "src_tag": "b"}
+        any_rule = {"protocol": "tcp"}
+        profile = {"inbound_rules": [v4_rule, any_rule, v6_rule],
+                   "outbound_rules": [any_rule]}
+        self.assertEqual(profile_for_ip_version(profile, 4),
+                         {"inbound_rules": [v4_rule, any_rule],
+                          "outbound_rules": [any_rule]})
+        self.assertEqual(profile_for_ip_version(profile, 6),
+                         {"inbound_rules": [any_rule, v6_rule],
+                          "outbound_rules": [any_rule]})
+        # No copy needed if there's nothing to filter.
+        self.assertTrue(profile_for_ip_version(WEB_RULES, 6) is WEB_RULES)
+        self.assertEqual(profile_for_ip_version(None, 4), None)
+
+    def test_rules_update_filtered(self):
+        profile = {"inbound_rules": [{"ip_version": 4}],
+                   "outbound_rules": []}
+        self.splitter.on_rules_update("prof", profile, async=False)
+        self.v4.rules.on_rules_update.assert_called_once_with(
+            "prof", profile, async=True)
+        self.v6.rules.on_rules_update.assert_called_once_with(
+            "prof", {"inbound_rules": [], "outbound_rules": []}, async=True)
+
+    def test_v4_only_endpoint_skips_v6(self):
+        self.splitter.on_endpoint_update(REMOTE_DB_ID, REMOTE_DB,
+                                         async=False)
+        self.v4.ipsets.on_endpoint_update.assert_called_once_with(
+            REMOTE_DB_ID, REMOTE_DB, async=True)
+        self.assertFalse(self.v6.ipsets.on_endpoint_update.called)
+        # Remote endpoints don't concern the endpoint managers.
+        self.assertFalse(self.v4.endpoints.on_endpoint_update.called)
+        self.assertFalse(self.v6.endpoints.on_endpoint_update.called)
+        # Deletion also skips v6, which never heard of the endpoint.
+        self.splitter.on_endpoint_update(REMOTE_DB_ID, None, async=False)
+        self.v4.ipsets.on_endpoint_update.assert_called_with(
+            REMOTE_DB_ID, None, async=True)
+        self.assertFalse(self.v6.ipsets.on_endpoint_update.called)
+
+    def test_endpoint_changes_family(self):
+        v6_ep = {"profile_id": "db", "ipv6_nets": ["dead::1/128"]}
+        self.splitter.apply_updates({}, {}, {REMOTE_DB_ID: REMOTE_DB},
+                                    async=False)
+        self.splitter.apply_updates({}, {}, {REMOTE_DB_ID: v6_ep},
+                                    async=False)
+        # The v4 ipsets see the endpoint lose its addresses.
+        self.assertEqual(self.v4.ipsets.apply_updates.call_args_list, [
+            mock.call({}, {REMOTE_DB_ID: REMOTE_DB}, async=True),
+            mock.call({}, {REMOTE_DB_ID: None}, async=True),
+        ])
+        self.assertEqual(self.v6.ipsets.apply_updates.call_args_list, [
+            mock.call({}, {REMOTE_DB_ID: v6_ep}, async=True),
+        ])
+        self.assertFalse(self.v4.endpoints.apply_updates.called)
+
+    def test_local_endpoint_reaches_both_families(self):
+        # The v6 endpoint manager still needs to program the interface of
+        # a v4-only endpoint, for example to block IPv6 spoofing.
+        self.splitter.on_endpoint_update(LOCAL_EP_ID, LOCAL_EP, async=False)
+        self.v4.endpoints.on_endpoint_update.assert_called_once_with(
+            LOCAL_EP_ID, LOCAL_EP, async=True)
+        self.v6.endpoints.on_endpoint_update.assert_called_once_with(
+            LOCAL_EP_ID, LOCAL_EP, async=True)
+        self.assertFalse(self.v6.ipsets.on_endpoint_update.called)
+
+    def test_snapshot_filtered(self):
+        for mgrs in (self.v4, self.v6):
+            for name in ["ipsets", "rules", "endpoints"]:
+                getattr(mgrs, name).notify_when_programmed.side_effect = \
+                    lambda callback, async: callback()
+        self.splitter.apply_snapshot(RULES, TAGS, ENDPOINTS, async=False)
+        self.v4.ipsets.apply_snapshot.assert_called_once_with(
+            TAGS, ENDPOINTS, async=True)
+        self.v6.ipsets.apply_snapshot.assert_called_once_with(
+            TAGS, {}, async=True)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_stub_dataplane
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests of the simulated dataplane.
+"""
+import logging
+
+import mock
+
+from calico.felix import fiptables
+from calico.felix.futils import FailedSystemCall
+from calico.felix.test.base import BaseTestCase
+from calico.felix.test.stub_dataplane import StubDataplane
+
+_log = logging.getLogger(__name__)
+
+RESTORE = ["iptables-restore", "--noflush", "--verbose"]
+
+
+class TestStubDataplane(BaseTestCase):
+    def setUp(self):
+        super(TestStubDataplane, self).setUp()
+        self.dataplane = StubDataplane()
+
+    def restore(self, *lines):
+        self.dataplane.check_call(RESTORE,
+                                  input_str="\n".join(lines) + "\n")
+
+    def chains(self, table="filter", ip_version=4):
+        return self.dataplane.state()["iptables"]["ipv%s %s" %
+                                                  (ip_version, table)]
+
+    def test_iptables_restore(self):
+        self.restore("*filter",
+                     ":felix-a -",
+                     ":felix-b -",
+                     "--append felix-a --jump felix-b",
+                     '--append felix-b -j DROP -m comment --comment "A b"',
+                     "--insert INPUT --jump felix-a",
+                     "COMMIT")
+        chains = self.chains()
+        self.assertEqual(chains["felix-a"]["rules"], ["--jump felix-b"])
+        self.assertEqual(chains["felix-b"]["rules"],
+                         ['--jump DROP --match comment --comment "A b"'])
+        self.assertEqual(chains["INPUT"],
+                         {"policy": "ACCEPT", "rules": ["--jump felix-a"]})
+        # Declaring an existing chain flushes it, even with --noflush.
+        self.restore("*filter", ":felix-b -", "COMMIT")
+        self.assertEqual(self.chains()["felix-b"]["rules"], [])
+        save = self.dataplane.check_call(["iptables-save"]).stdout
+        self.assertTrue("-A felix-a --jump felix-b\n" in save)
+
+    def test_iptables_restore_failure(self):
+        input_lines = ["*filter",
+                       ":felix-a -",
+                       "--append felix-a --jump felix-missing",
+                       "COMMIT"]
+        try:
+            self.restore(*input_lines)
+        except FailedSystemCall as e:
+            self.assertEqual(fiptables._parse_ipt_restore_error(input_lines,
+                                                                e.stderr),
+                             (False, "Line 3 failed: %s" % input_lines[2]))
+        else:
+            self.fail("Expected the jump to a missing chain to fail")
+        # The whole transaction failed.
+        self.assertFalse("felix-a" in self.chains())
+        stats = self.dataplane.stats()
+        self.assertEqual(stats["iptables-restore"]["failures"], 1)
+
+    def test_delete_referenced_chain(self):
+        self.restore("*filter",
+                     ":felix-a -",
+                     ":felix-b -",
+                     "--append felix-a --goto felix-b",
+                     "COMMIT")
+        self.assertRaises(FailedSystemCall, self.restore,
+                          "*filter", ":felix-b -", "--delete-chain felix-b",
+                          "COMMIT")
+        listing = self.dataplane.check_output(
+            ["iptables", "--wait", "--list", "--table", "filter"])
+        self.assertEqual(fiptables._extract_unreffed_chains(listing),
+                         set(["felix-a"]))
+        self.restore("*filter",
+                     ":felix-a -",
+                     ":felix-b -",
+                     "--delete-chain felix-a",
+                     "--delete-chain felix-b",
+                     "COMMIT")
+        self.assertEqual(sorted(self.chains()), ["FORWARD", "INPUT", "OUTPUT"])
+
+    def test_ipsets(self):
+        restore = lambda *lines: self.dataplane.check_call(
+            ["ipset", "restore"], input_str="\n".join(lines) + "\n")
+        restore("create felix-v4-a hash:ip family inet --exist",
+                "create felix-tmp-v4-a hash:ip family inet --exist",
+                "flush felix-tmp-v4-a",
+                "add felix-tmp-v4-a 10.0.0.1",
+                "swap felix-v4-a felix-tmp-v4-a",
+                "destroy felix-tmp-v4-a",
+                "COMMIT")
+        self.assertEqual(self.dataplane.state()["ipsets"],
+                         {"felix-v4-a": {"type": "hash:ip",
+                                         "family": "inet",
+                                         "members": ["10.0.0.1"]}})
+        self.assertRaises(FailedSystemCall, restore, "add felix-v4-b 10.0.0.1")
+        # An ipset that's used by a rule can't be destroyed.
+        self.restore("*filter",
+                     "--append INPUT --match set --match-set felix-v4-a src "
+                     "--jump DROP",
+                     "COMMIT")
+        self.assertRaises(FailedSystemCall, self.dataplane.check_call,
+                          ["ipset", "destroy", "felix-v4-a"])
+        listing = self.dataplane.check_call(["ipset", "list"]).stdout
+        self.assertTrue("Name: felix-v4-a\n" in listing)
+
+    def test_routes(self):
+        check_call = self.dataplane.check_call
+        check_call(["arp", "-s", "10.0.0.1", "aa:bb:cc:dd:ee:ff",
+                    "-i", "tap1"])
+        check_call(["ip", "route", "replace", "10.0.0.1", "dev", "tap1"])
+        check_call(["ip", "-6", "route", "replace", "2001::1", "dev", "tap1"])
+        self.assertEqual(
+            check_call(["ip", "route", "list", "dev", "tap1"]).stdout,
+            "10.0.0.1 scope link\n"
+        )
+        # Replacing the route moves it to the new interface.
+        check_call(["ip", "route", "replace", "10.0.0.1", "dev", "tap2"])
+        self.assertRaises(FailedSystemCall, check_call,
+                          ["ip", "route", "del", "10.0.0.1", "dev", "tap1"])
+        check_call(["ip", "route", "del", "10.0.0.1", "dev", "tap2"])
+        state = self.dataplane.state()
+        self.assertEqual(state["routes"], {"ipv4": [],
+                                           "ipv6": [("2001::1", "tap1")]})
+        self.assertEqual(state["arp_entries"],
+                         [(("10.0.0.1", "tap1"), "aa:bb:cc:dd:ee:ff")])
+
+    def test_iptables_updater(self):
+        """
+        Drives the real IptablesUpdater against the simulated dataplane.
+        """
+        updater = fiptables.IptablesUpdater("filter", ip_version=4)
+        with mock.patch("calico.felix.futils.check_call",
+                        self.dataplane.check_call):
+            updater.rewrite_chains({"felix-a": ["--append felix-a "
+                                                "--jump felix-b"]},
+                                   {"felix-a": set(["felix-b"])},
+                                   async=True)
+            updater._step()
+            chains = self.chains()
+            self.assertEqual(chains["felix-a"]["rules"], ["--jump felix-b"])
+            # The missing chain was stubbed out with a DROP rule.
+            self.assertEqual(len(chains["felix-b"]["rules"]), 1)
+            digest = self.dataplane.state_digest()
+
+            updater.delete_chains(["felix-a"], async=True)
+            updater._step()
+            self.assertEqual(sorted(self.chains()),
+                             ["FORWARD", "INPUT", "OUTPUT"])
+            self.assertNotEqual(self.dataplane.state_digest(), digest)
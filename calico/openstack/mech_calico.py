@@ -119,11 +119,36 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
     def delete_subnet_postcommit(self, context):
         LOG.info("DELETE_SUBNET_POSTCOMMIT: %s" % context)
 
-    def add_port_gateways(self, port, context):
+    def add_port_gateways(self, port, context, gateways_by_subnet=None):
+        """Set the gateway for each of the port's fixed IPs.
+
+        :param gateways_by_subnet: Optional dict mapping subnet ID to gateway
+            IP, as returned by _get_subnet_gateways.  Subnets that are
+            missing from it are queried individually.
+        """
         assert self.db
         for ip in port['fixed_ips']:
-            subnet = self.db.get_subnet(context, ip['subnet_id'])
-            ip['gateway'] = subnet['gateway_ip']
+            subnet_id = ip['subnet_id']
+            if gateways_by_subnet and subnet_id in gateways_by_subnet:
+                ip['gateway'] = gateways_by_subnet[subnet_id]
+            else:
+                subnet = self.db.get_subnet(context, subnet_id)
+                ip['gateway'] = subnet['gateway_ip']
+
+    def _get_subnet_gateways(self, ports, context):
+        """Return a dict mapping the ID of each subnet used by the given
+        ports to its gateway IP, using a single query.
+        """
+        subnet_ids = set(ip['subnet_id']
+                         for port in ports
+                         for ip in port['fixed_ips'])
+        if not subnet_ids:
+            return {}
+        subnets = self.db.get_subnets(context,
+                                      filters={'id': list(subnet_ids)},
+                                      fields=['id', 'gateway_ip'])
+        return dict((subnet['id'], subnet['gateway_ip'])
+                    for subnet in subnets)
 
     def add_port_interface_name(self, port):
         port['interface_name'] = 'tap' + port['id'][:11]
@@ -195,13 +220,17 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
             self.transport.endpoint_deleted(port)
 
     def send_sg_updates(self, sgids, db_context):
+        members_by_sg = self._get_members(sgids, db_context)
         for sgid in sgids:
             sg = self.db.get_security_group(db_context, sgid)
-            sg['members'] = self._get_members(sg, db_context)
+            sg['members'] = members_by_sg[sgid]
             self.transport.security_group_updated(sg)
 
-    def get_endpoints(self):
+    def get_endpoints(self, port_ids=None):
         """Return the current set of endpoints.
+
+        :param port_ids: Optional iterable of port IDs; if given, only the
+            endpoints with those IDs are returned.
         """
         # Set up access to the Neutron database, if we haven't already.
         self._get_db()
@@ -210,19 +239,27 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
         db_context = ctx.get_admin_context()
 
         # Get current endpoint ports.
-        ports = [port for port in self.db.get_ports(db_context)
+        filters = None
+        if port_ids is not None:
+            filters = {'id': list(port_ids)}
+        ports = [port for port in self.db.get_ports(db_context,
+                                                    filters=filters)
                  if self._port_is_endpoint_port(port)]
 
         # Add IP gateways and interface names.
+        gateways_by_subnet = self._get_subnet_gateways(ports, db_context)
         for port in ports:
-            self.add_port_gateways(port, db_context)
+            self.add_port_gateways(port, db_context, gateways_by_subnet)
             self.add_port_interface_name(port)
 
         # Return those (augmented) ports.
         return ports
 
-    def get_security_groups(self):
+    def get_security_groups(self, sgids=None):
         """Return the current set of security groups.
+
+        :param sgids: Optional iterable of security group IDs; if given,
+            only the security groups with those IDs are returned.
         """
         # Set up access to the Neutron database, if we haven't already.
         self._get_db()
@@ -231,28 +268,56 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
         db_context = ctx.get_admin_context()
 
         # Get current SGs.
-        sgs = self.db.get_security_groups(db_context)
+        if sgids is None:
+            sgs = self.db.get_security_groups(db_context)
+        else:
+            sgs = self.db.get_security_groups(db_context,
+                                              filters={'id': list(sgids)})
 
         # Add, to each SG, a dict whose keys are the endpoints configured to
         # use that SG, and whose values are the corresponding IP addresses.
+        members_by_sg = self._get_members([sg['id'] for sg in sgs],
+                                          db_context)
         for sg in sgs:
-            sg['members'] = self._get_members(sg, db_context)
+            sg['members'] = members_by_sg[sg['id']]
 
         # Return those (augmented) security groups.
         return sgs
 
-    def _get_members(self, sg, db_context):
-        filters = {'security_group_id': [sg['id']]}
+    def _get_members(self, sgids, db_context):
+        """Return a dict mapping each of the given security group IDs to a
+        dict whose keys are the endpoints configured to use that SG, and
+        whose values are the corresponding IP addresses.
+
+        Uses one query for the port/SG bindings and one for the bound ports,
+        however many SGs there are.
+        """
+        filters = {'security_group_id': list(sgids)}
         bindings = self.db._get_port_security_group_bindings(db_context,
                                                              filters)
-        endpoints = {}
+        ips_by_port = {}
+        port_ids = list(set(binding['port_id'] for binding in bindings))
+        if port_ids:
+            ports = self.db.get_ports(db_context,
+                                      filters={'id': port_ids},
+                                      fields=['id', 'fixed_ips'])
+            for port in ports:
+                ips_by_port[port['id']] = [ip['ip_address']
+                                           for ip in port['fixed_ips']]
+
+        members_by_sg = dict((sgid, {}) for sgid in sgids)
         for binding in bindings:
             port_id = binding['port_id']
-            port = self.db.get_port(db_context, port_id)
-            endpoints[port_id] = [ip['ip_address'] for ip in port['fixed_ips']]
+            if port_id in ips_by_port:
+                # (Otherwise the port was deleted after we read the
+                # bindings.)
+                members_by_sg[binding['security_group_id']][port_id] = \
+                    ips_by_port[port_id]
 
-        LOG.info("Endpoints for SG %s are %s" % (sg['id'], endpoints))
-        return endpoints
+        for sgid in sgids:
+            LOG.info("Endpoints for SG %s are %s" % (sgid,
+                                                     members_by_sg[sgid]))
+        return members_by_sg
 
     def felix_status(self, hostname, up, start_flag):
         # Get a DB context for this processing.
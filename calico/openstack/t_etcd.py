@@ -18,17 +18,22 @@
 # Etcd-based transport for the Calico/OpenStack Plugin.
 
 # Standard Python library imports.
+from collections import defaultdict, deque
 import etcd
 import eventlet
 import json
 import re
+import sys
+import time
+import urllib3.exceptions
 
 # OpenStack imports.
 from oslo.config import cfg
 
 # Calico imports.
-from calico.datamodel_v1 import (READY_KEY, CONFIG_DIR, TAGS_KEY_RE, HOST_DIR,
-                                 key_for_endpoint, PROFILE_DIR,
+from calico.datamodel_v1 import (READY_KEY, CONFIG_DIR, TAGS_KEY_RE,
+                                 RULES_KEY_RE, ENDPOINT_KEY_RE, HOST_DIR,
+                                 VERSION_DIR, key_for_endpoint, PROFILE_DIR,
                                  key_for_profile, key_for_profile_rules,
                                  key_for_profile_tags, key_for_config)
 from calico.openstack.transport import CalicoTransport
@@ -39,6 +44,19 @@ calico_opts = [
                help="The hostname or IP of the etcd node/proxy"),
     cfg.IntOpt('etcd_port', default=4001,
                help="The port to use for the etcd node/proxy"),
+    cfg.IntOpt('full_resync_interval', default=600,
+               help="Interval, in seconds, between full audits of the etcd "
+                    "data against the OpenStack database.  The periodic "
+                    "resyncs in between only recheck the etcd keys that "
+                    "have changed since the previous resync."),
+    cfg.IntOpt('etcd_writer_pool_size', default=10,
+               help="Maximum number of concurrent writes to etcd"),
+    cfg.BoolOpt('per_sg_profiles', default=False,
+                help="Write one profile per security group, and give each "
+                     "endpoint the list of its security groups' profiles, "
+                     "instead of one profile for each distinct combination "
+                     "of security groups.  Requires a Felix that supports "
+                     "the endpoint 'profile_ids' field."),
 ]
 cfg.CONF.register_opts(calico_opts, 'calico')
 
@@ -51,6 +69,79 @@ json_decoder = json.JSONDecoder()
 
 PERIODIC_RESYNC_INTERVAL_SECS = 30
 
+# Maximum number of etcd events that an incremental resync replays before
+# giving up and doing a full resync instead.  (etcd itself only keeps a
+# history of the last 1000 events.)
+MAX_INCREMENTAL_RESYNC_EVENTS = 1000
+
+# Timeout for each read of the etcd event history.  The reads only ever ask
+# for events that have already happened, so they should return immediately.
+EVENT_READ_TIMEOUT_SECS = 5
+
+
+class EtcdWriterPool(object):
+    """Bounded pool of green threads that write to etcd.
+
+    Writes and deletes with different ordering keys (by default, the etcd
+    key itself) are issued concurrently, up to the size of the pool.  Those
+    with the same ordering key are issued one at a time, in the order that
+    they were queued.
+
+    Each write or delete returns an eventlet Event, whose wait() method
+    returns the result of the etcd operation or raises its exception.
+    """
+
+    def __init__(self, client, size):
+        self.client = client
+        self.pool = eventlet.GreenPool(size)
+
+        # Queue of operations for each ordering key that has some
+        # outstanding.  Each queue has a green thread working through it.
+        self._queues = {}
+
+    def write(self, key, value, ordering_key=None):
+        return self.submit(ordering_key or key, self.client.write, key, value)
+
+    def delete(self, key, ordering_key=None, **kwargs):
+        return self.submit(ordering_key or key,
+                           self.client.delete, key, **kwargs)
+
+    def submit(self, ordering_key, fn, *args, **kwargs):
+        """Queues a call of fn, which should do a single etcd operation,
+        with the given ordering key."""
+        return self._queue(ordering_key, fn, args, kwargs)
+
+    def _queue(self, ordering_key, fn, args, kwargs):
+        done = eventlet.event.Event()
+        queue = self._queues.get(ordering_key)
+        if queue is None:
+            queue = self._queues[ordering_key] = deque()
+            queue.append((fn, args, kwargs, done))
+            # This blocks while the pool is full, so the operation must
+            # already be queued, ahead of any that join the queue meanwhile.
+            self.pool.spawn_n(self._work, ordering_key, queue)
+        else:
+            queue.append((fn, args, kwargs, done))
+        return done
+
+    def _work(self, ordering_key, queue):
+        while queue:
+            fn, args, kwargs, done = queue.popleft()
+            try:
+                result = fn(*args, **kwargs)
+            except:
+                done.send_exception(*sys.exc_info())
+            else:
+                done.send(result)
+        del self._queues[ordering_key]
+
+
+def wait_for_all(events):
+    """Waits for all the given EtcdWriterPool events, raising the first
+    exception, if any."""
+    for event in list(events):
+        event.wait()
+
 
 class CalicoTransportEtcd(CalicoTransport):
     """Calico transport implementation based on etcd."""
@@ -66,6 +157,8 @@ class CalicoTransportEtcd(CalicoTransport):
         # Prepare client for accessing etcd data.
         self.client = etcd.Client(host=cfg.CONF.calico.etcd_host,
                                   port=cfg.CONF.calico.etcd_port)
+        self.writer = EtcdWriterPool(self.client,
+                                     cfg.CONF.calico.etcd_writer_pool_size)
 
         # Spawn a green thread for periodically resynchronizing etcd against
         # the OpenStack database.
@@ -78,8 +171,16 @@ class CalicoTransportEtcd(CalicoTransport):
 
         # Also the set of profile IDs that we need for the current endpoints,
         # so that we can generate the profile data if an underlying security
-        # group changes.
+        # group changes.  profiles_by_sg indexes the same profile IDs by each
+        # of the security groups that they include.
         self.needed_profiles = set()
+        self.profiles_by_sg = defaultdict(set)
+
+        # Revision of each security group's rules, bumped whenever we see them
+        # change, and the rendered rules for each profile, along with the SG
+        # revisions that they were rendered from.
+        self._sg_revisions = defaultdict(int)
+        self._rendered_rules = {}
 
         # This event is used exactly once, at start of day, to delay all
         # endpoint creation events behind security group synchronization.
@@ -89,17 +190,27 @@ class CalicoTransportEtcd(CalicoTransport):
         self.start_of_day_lock = eventlet.event.Event()
         self._start_of_day_complete = False
 
+        # Decoded values of the endpoint, rules and tags keys that we believe
+        # are correct in etcd, keyed on etcd key.  Maintained as we write and
+        # delete keys, and rebuilt by each full resync.
+        self._written = {}
+
+        # etcd index that the _written cache is known to be up to date with,
+        # or None if the next resync must be a full one.
+        self._resync_index = None
+        self._last_full_resync = None
+
     def periodic_resync_thread(self):
         while True:
             try:
                 # Write non-default config that Felices need.
                 self.provide_felix_config()
 
-                # Resynchronize endpoint data.
-                self.resync_endpoints()
-
-                # Resynchronize security group data.
-                self.resync_security_groups()
+                # Resynchronize endpoint and security group data.
+                if self.full_resync_due():
+                    self.full_resync()
+                else:
+                    self.incremental_resync()
 
                 # If this is our first pass through start of day processing, we
                 # can now unblock anyone waiting.
@@ -114,6 +225,196 @@ class CalicoTransportEtcd(CalicoTransport):
             # Sleep until time for next resync.
             eventlet.sleep(PERIODIC_RESYNC_INTERVAL_SECS)
 
+    def full_resync_due(self):
+        if self._resync_index is None:
+            return True
+        elapsed = time.time() - self._last_full_resync
+        return elapsed >= cfg.CONF.calico.full_resync_interval
+
+    def full_resync(self):
+        """Audit all the etcd data against the OpenStack database."""
+        LOG.info("Doing full resync")
+        self._resync_index = None
+        self._last_full_resync = time.time()
+
+        # Note the etcd index before reading anything, so that the next
+        # incremental resync replays any changes made while we're reading.
+        etcd_index = self.current_etcd_index()
+        self._written = {}
+        self.resync_endpoints()
+        self.resync_security_groups()
+        self._resync_index = etcd_index
+
+    def incremental_resync(self):
+        """Recheck only the etcd keys that have changed since the last
+        resync.
+
+        Replays the etcd event history since the last resync and checks any
+        of our keys whose value no longer matches what we last wrote
+        against the OpenStack database.  (Other Neutron servers write the
+        same keys, so a different value isn't necessarily wrong.)  Keys
+        that we don't know about are left for the next full resync, as are
+        any changes in the OpenStack database that we weren't notified of.
+        """
+        # If anything goes wrong below, make the next resync a full one.
+        start_index, self._resync_index = self._resync_index, None
+        etcd_index = self.current_etcd_index()
+        changes = self.changes_since(start_index, etcd_index)
+        if changes is None:
+            LOG.info("Unable to resync incrementally")
+            self.full_resync()
+            return
+        LOG.debug("%s keys changed since etcd index %s",
+                  len(changes), start_index)
+        changed = dict((key, value) for key, value in changes.iteritems()
+                       if key in self._written and
+                       _decode_or_none(value) != self._written[key])
+        if changed:
+            wait_for_all(self.resync_keys(changed))
+        self._resync_index = etcd_index
+
+    def current_etcd_index(self):
+        # The root directory always exists, unlike the Ready flag.
+        return self.client.read('/').etcd_index
+
+    def changes_since(self, start_index, end_index):
+        """Reads the etcd event history after start_index, up to and
+        including end_index.
+
+        :returns: a dict mapping each key that we're interested in, and
+            that changed, to its final raw value (or None if it was
+            deleted).  None if the history is unavailable or too long.
+        """
+        changes = {}
+        next_index = start_index + 1
+        num_events = 0
+        while next_index <= end_index:
+            if num_events >= MAX_INCREMENTAL_RESYNC_EVENTS:
+                LOG.info("More than %s etcd events to replay",
+                         MAX_INCREMENTAL_RESYNC_EVENTS)
+                return None
+            try:
+                event = self.client.read(VERSION_DIR,
+                                         recursive=True,
+                                         wait=True,
+                                         waitIndex=next_index,
+                                         timeout=EVENT_READ_TIMEOUT_SECS)
+            except etcd.EtcdEventIndexCleared:
+                LOG.info("etcd event history since %s is no longer "
+                         "available", next_index)
+                return None
+            except (etcd.EtcdException,
+                    urllib3.exceptions.HTTPError) as e:
+                # For example, the read timed out because none of the
+                # remaining events are under VERSION_DIR.
+                LOG.info("Failed to read etcd event %s: %r", next_index, e)
+                return None
+            if event.modifiedIndex > end_index:
+                break
+            num_events += 1
+            next_index = event.modifiedIndex + 1
+            if event.action in ("delete", "expire", "compareAndDelete"):
+                value = None
+            else:
+                value = event.value
+            if event.dir:
+                # A whole directory was deleted; that affects all of our
+                # keys beneath it.
+                prefix = event.key + "/"
+                for key in self._written:
+                    if key.startswith(prefix):
+                        changes[key] = None
+            else:
+                changes[event.key] = value
+        return changes
+
+    def resync_keys(self, values_by_key):
+        """Checks the given keys, whose values have changed since we last
+        wrote them, against the OpenStack database, and restores any whose
+        value is wrong.
+
+        Keys that should no longer exist are forgotten, and left for the
+        next full resync to delete.  Only the ports and security groups
+        that the keys depend on are read from the database; whether a
+        profile is still needed is judged from the endpoints that we know
+        about.
+
+        :param values_by_key: dict mapping each key to its raw value in
+            etcd, or None if it was deleted.
+        :returns: a list of the events for the writes that we queued.
+        """
+        port_ids = set()
+        profile_ids = set()
+        for key in values_by_key:
+            m = TAGS_KEY_RE.match(key) or RULES_KEY_RE.match(key)
+            if m:
+                profile_ids.add(m.group("profile_id"))
+                continue
+            m = ENDPOINT_KEY_RE.match(key)
+            if m:
+                port_ids.add(m.group("endpoint_id"))
+
+        endpoints = {}
+        if port_ids:
+            for port in self.driver.get_endpoints(port_ids):
+                data = self.port_etcd_data(port)
+                endpoints[self.port_etcd_key(port)] = data
+        sgids = set(sgid
+                    for profile_id in profile_ids
+                    if profile_id in self.needed_profiles
+                    for sgid in self.profile_tags(profile_id))
+        if sgids:
+            # Render the profiles from the current security groups.
+            for sg in self.driver.get_security_groups(sgids):
+                self.store_sg(sg, self.sgs)
+
+        writes = []
+        for key, value in values_by_key.iteritems():
+            m = TAGS_KEY_RE.match(key) or RULES_KEY_RE.match(key)
+            if m:
+                profile_id = m.group("profile_id")
+                ordering_key = key_for_profile(profile_id)
+                if profile_id not in self.needed_profiles:
+                    data = None
+                elif key == key_for_profile_tags(profile_id):
+                    data = self.profile_tags(profile_id)
+                else:
+                    data = self.profile_rules(profile_id)
+            else:
+                ordering_key = None
+                data = endpoints.get(key)
+
+            if data is None:
+                LOG.info("etcd key %s is no longer needed", key)
+                self._written.pop(key, None)
+            elif _decode_or_none(value) == data:
+                LOG.debug("etcd key %s was correctly updated elsewhere", key)
+                self._written[key] = data
+            else:
+                LOG.info("etcd key %s has the wrong value, rewriting it", key)
+                writes.append(self.write_json(key, data, ordering_key))
+        return writes
+
+    def write_json(self, key, data, ordering_key=None):
+        """Queues a write of the given data to etcd, and remembers it as
+        the value of the key unless the write fails.
+
+        :returns: the write's event from the EtcdWriterPool.
+        """
+        self._written[key] = data
+        return self.writer.submit(ordering_key or key,
+                                  self._write_json, key, data)
+
+    def _write_json(self, key, data):
+        try:
+            return self.client.write(key, json.dumps(data))
+        except:
+            # We don't know what etcd holds now.  Forget our value, unless
+            # a later write or delete has already replaced it.
+            if self._written.get(key) is data:
+                del self._written[key]
+            raise
+
     def resync_endpoints(self):
         # Get all current endpoints from the OpenStack database and key them on
         # endpoint ID.
@@ -124,6 +425,11 @@ class CalicoTransportEtcd(CalicoTransport):
         # As we go through the current endpoints, we'll accumulate the set of
         # security profiles that they need.  Start with an empty set here.
         self.needed_profiles = set()
+        self.profiles_by_sg = defaultdict(set)
+
+        # Events for the etcd writes and deletes that we queue below.
+        writes = []
+        deletes = []
 
         # Read all etcd keys under /calico/v1/host.
         try:
@@ -149,8 +455,10 @@ class CalicoTransportEtcd(CalicoTransport):
                     data == self.port_etcd_data(ports[endpoint_id])):
                     LOG.debug("Existing etcd endpoint data is correct")
                     # OpenStack still has an endpoint that exactly matches this
-                    # etcd key/value.  Remember its security profile.
-                    self.needed_profiles.add(data['profile_id'])
+                    # etcd key/value.  Remember its security profiles.
+                    for profile_id in endpoint_profile_ids(data):
+                        self.add_needed_profile(profile_id)
+                    self._written[child.key] = data
 
                     # No change is needed to the etcd data, and we can delete
                     # the port from the ports dict so as not to unnecessarily
@@ -166,21 +474,27 @@ class CalicoTransportEtcd(CalicoTransport):
                     # cases the etcd key is no longer valid and should be
                     # deleted.  In the migration case, data will be written
                     # below to an etcd key that incorporates the new hostname.
-                    try:
-                        self.client.delete(child.key)
-                    except etcd.EtcdKeyNotFound:
-                        LOG.debug("Key %s, which we were deleting, "
-                                  "disappeared", child.key)
+                    deletes.append((child.key,
+                                    self.writer.delete(child.key)))
 
         # Now write etcd data for any endpoints remaining in the ports dict;
         # these are new endpoints - i.e. never previously represented in etcd
         # data - or endpoints that have migrated or whose data has changed.
         for port in ports.values():
             data = self.port_etcd_data(port)
-            self.client.write(self.port_etcd_key(port), json.dumps(data))
+            writes.append(self.write_json(self.port_etcd_key(port), data))
 
-            # Remember the security profile that this port needs.
-            self.needed_profiles.add(data['profile_id'])
+            # Remember the security profiles that this port needs.
+            for profile_id in endpoint_profile_ids(data):
+                self.add_needed_profile(profile_id)
+
+        # Wait for all the writes and deletes to complete.
+        for key, done in deletes:
+            try:
+                done.wait()
+            except etcd.EtcdKeyNotFound:
+                LOG.debug("Key %s, which we were deleting, disappeared", key)
+        wait_for_all(writes)
 
     def port_etcd_key(self, port):
         return key_for_endpoint(port['binding:host_id'],
@@ -192,8 +506,11 @@ class CalicoTransportEtcd(CalicoTransport):
         # Construct the simpler port data.
         data = {'state': 'active' if port['admin_state_up'] else 'inactive',
                 'name': port['interface_name'],
-                'mac': port['mac_address'],
-                'profile_id': self.port_profile_id(port)}
+                'mac': port['mac_address']}
+        if cfg.CONF.calico.per_sg_profiles:
+            data['profile_ids'] = list(port['security_groups'])
+        else:
+            data['profile_id'] = self.port_profile_id(port)
 
         # Collect IPv6 and IPv6 addresses.  On the way, also set the
         # corresponding gateway fields.  If there is more than one IPv4 or IPv6
@@ -218,68 +535,128 @@ class CalicoTransportEtcd(CalicoTransport):
     def port_profile_id(self, port):
         return '_'.join(port['security_groups'])
 
+    def add_needed_profile(self, profile_id):
+        if profile_id not in self.needed_profiles:
+            self.needed_profiles.add(profile_id)
+            for sgid in self.profile_tags(profile_id):
+                self.profiles_by_sg[sgid].add(profile_id)
+
+    def store_sg(self, sg, sgs):
+        """Store the given security group in the sgs dict, bumping its
+        revision if its rules differ from those that we already had."""
+        old_sg = self.sgs.get(sg['id'])
+        if (old_sg is None or
+                old_sg['security_group_rules'] != sg['security_group_rules']):
+            self._sg_revisions[sg['id']] += 1
+        sgs[sg['id']] = sg
+
     def resync_security_groups(self):
         # Get all current security groups from the OpenStack database and key
         # them on security group ID.
-        self.sgs = {}
+        sgs = {}
         for sg in self.driver.get_security_groups():
-            self.sgs[sg['id']] = sg
+            self.store_sg(sg, sgs)
+        self.sgs = sgs
 
         # As we look at the etcd data, accumulate a set of profile IDs that
         # already have correct data.
         correct_profiles = set()
 
-        # Read all etcd keys directly under /calico/v1/policy/profile.
+        # Events for the etcd writes and deletes that we queue below.
+        writes = []
+        deletes = []
+
+        # Read all etcd keys under /calico/v1/policy/profile.  The recursive
+        # read returns the rules and tags values too, so index those by key
+        # rather than reading them again for each profile.
         try:
             children = self.client.read(PROFILE_DIR, recursive=True).children
         except etcd.EtcdKeyNotFound:
             children = []
-        for child in children:
-            LOG.debug("etcd key: %s" % child.key)
-            m = TAGS_KEY_RE.match(child.key)
+        values_by_key = dict((child.key, child.value) for child in children)
+        for key in values_by_key:
+            LOG.debug("etcd key: %s" % key)
+            m = TAGS_KEY_RE.match(key)
             if m:
                 # If there are no policies, then read returns the top level
                 # node, so we need to check that this really is a profile ID.
                 profile_id = m.group("profile_id")
                 LOG.debug("Existing etcd profile data for %s" % profile_id)
-                try:
-                    if profile_id in self.needed_profiles:
-                        # This is a profile that we want.  Let's read its rules and
-                        # tags, and compare those against the current OpenStack data.
-                        rules_key = key_for_profile_rules(profile_id)
-                        rules = json_decoder.decode(
-                            self.client.read(rules_key).value)
-                        tags_key = key_for_profile_tags(profile_id)
-                        tags = json_decoder.decode(
-                            self.client.read(tags_key).value)
-
-                        if (rules == self.profile_rules(profile_id) and
-                            tags == self.profile_tags(profile_id)):
-                            # The existing etcd data for this profile is completely
-                            # correct.  Remember the profile_id so that we don't
-                            # unnecessarily write out its (unchanged) data again below.
-                            LOG.debug("Existing etcd profile data is correct")
-                            correct_profiles.add(profile_id)
-                    else:
-                        # We don't want this profile any more, so delete the key.
-                        LOG.debug("Existing etcd profile key is now invalid")
-                        profile_key = key_for_profile(profile_id)
-                        self.client.delete(profile_key, recursive=True)
-                except etcd.EtcdKeyNotFound:
-                    LOG.info("Etcd data appears to have been reset")
+                if profile_id in self.needed_profiles:
+                    # This is a profile that we want.  Compare its rules and
+                    # tags against the current OpenStack data.
+                    rules_key = key_for_profile_rules(profile_id)
+                    rules_value = values_by_key.get(rules_key)
+                    if rules_value is None:
+                        LOG.info("No rules for profile %s", profile_id)
+                        continue
+                    rules = json_decoder.decode(rules_value)
+                    tags = json_decoder.decode(values_by_key[key])
+
+                    if (rules == self.profile_rules(profile_id) and
+                        tags == self.profile_tags(profile_id)):
+                        # The existing etcd data for this profile is
+                        # completely correct.  Remember the profile_id so
+                        # that we don't unnecessarily write out its
+                        # (unchanged) data again below.
+                        LOG.debug("Existing etcd profile data is correct")
+                        correct_profiles.add(profile_id)
+                        self._written[rules_key] = rules
+                        self._written[key] = tags
+                else:
+                    # We don't want this profile any more, so delete the key.
+                    LOG.debug("Existing etcd profile key is now invalid")
+                    profile_key = key_for_profile(profile_id)
+                    deletes.append(self.writer.delete(profile_key,
+                                                      recursive=True))
 
         # Now write etcd data for each profile that we need and that we don't
         # already know to be correct.
         for profile_id in self.needed_profiles.difference(correct_profiles):
-            self.write_profile_to_etcd(profile_id)
+            writes.extend(self.write_profile_to_etcd(profile_id))
 
-    def write_profile_to_etcd(self, profile_id):
-        self.client.write(key_for_profile_rules(profile_id),
-                          json.dumps(self.profile_rules(profile_id)))
-        self.client.write(key_for_profile_tags(profile_id),
-                          json.dumps(self.profile_tags(profile_id)))
+        # Wait for all the writes and deletes to complete.
+        for done in deletes:
+            try:
+                done.wait()
+            except etcd.EtcdKeyNotFound:
+                LOG.info("Etcd data appears to have been reset")
+        wait_for_all(writes)
+
+        # Forget the rendered rules of any profiles that we no longer need.
+        for profile_id in self._rendered_rules.keys():
+            if profile_id not in self.needed_profiles:
+                del self._rendered_rules[profile_id]
+
+    def write_profile_to_etcd(self, profile_id, only_if_changed=False):
+        """Write the rules and tags for the given profile.
+
+        :param only_if_changed: If True, skip any key whose value is the
+            same as the one that we last wrote to it.
+        :returns: a list of the events for the writes that we queued.
+        """
+        writes = []
+        for key, data in ((key_for_profile_rules(profile_id),
+                           self.profile_rules(profile_id)),
+                          (key_for_profile_tags(profile_id),
+                           self.profile_tags(profile_id))):
+            if only_if_changed and self._written.get(key) == data:
+                LOG.debug("%s is unchanged", key)
+                continue
+            # Order the writes with any deletion of the whole profile.
+            writes.append(self.write_json(key, data,
+                                          key_for_profile(profile_id)))
+        return writes
 
     def profile_rules(self, profile_id):
+        # Only render the rules again if one of the profile's security
+        # groups has changed since we last did so.
+        revisions = tuple(self._sg_revisions[sgid]
+                          for sgid in self.profile_tags(profile_id))
+        rendered = self._rendered_rules.get(profile_id)
+        if rendered is not None and rendered[0] == revisions:
+            return rendered[1]
+
         inbound = []
         outbound = []
         for sgid in self.profile_tags(profile_id):
@@ -291,7 +668,9 @@ class CalicoTransportEtcd(CalicoTransport):
                 else:
                     outbound.append(etcd_rule)
 
-        return {'inbound_rules': inbound, 'outbound_rules': outbound}
+        rules = {'inbound_rules': inbound, 'outbound_rules': outbound}
+        self._rendered_rules[profile_id] = (revisions, rules)
+        return rules
 
     def profile_tags(self, profile_id):
         return profile_id.split('_')
@@ -309,14 +688,15 @@ class CalicoTransportEtcd(CalicoTransport):
 
         # Write etcd data for the new endpoint.
         data = self.port_etcd_data(port)
-        self.client.write(self.port_etcd_key(port), json.dumps(data))
-
-        # Get and remember the security profile that this port needs.
-        profile_id = data['profile_id']
-        self.needed_profiles.add(profile_id)
+        writes = [self.write_json(self.port_etcd_key(port), data)]
 
-        # Write etcd data for this profile.
-        self.write_profile_to_etcd(profile_id)
+        # Get and remember the security profiles that this port needs, and
+        # write their etcd data, concurrently with the endpoint.  Then wait
+        # for all the writes to complete.
+        for profile_id in endpoint_profile_ids(data):
+            self.add_needed_profile(profile_id)
+            writes.extend(self.write_profile_to_etcd(profile_id))
+        wait_for_all(writes)
 
     def endpoint_updated(self, port):
         # Do the same as for endpoint_created.
@@ -325,22 +705,25 @@ class CalicoTransportEtcd(CalicoTransport):
     def endpoint_deleted(self, port):
         # Delete the etcd key for this endpoint.
         key = self.port_etcd_key(port)
+        self._written.pop(key, None)
         try:
-            self.client.delete(key)
+            self.writer.delete(key).wait()
         except etcd.EtcdKeyNotFound:
             # Already gone, treat as success.
             LOG.debug("Key %s, which we were deleting, disappeared", key)
 
     def security_group_updated(self, sg):
         # Update the data that we're keeping for this security group.
-        self.sgs[sg['id']] = sg
+        self.store_sg(sg, self.sgs)
 
-        # Identify all the needed profiles that incorporate this security
-        # group, and rewrite their data.
-        for profile_id in self.needed_profiles:
-            if sg['id'] in self.profile_tags(profile_id):
-                # Write etcd data for this profile.
-                self.write_profile_to_etcd(profile_id)
+        # Rewrite the data of all the needed profiles that incorporate this
+        # security group, where it has changed.  (Copy the set, since it may
+        # change while we're writing.)
+        writes = []
+        for profile_id in list(self.profiles_by_sg.get(sg['id'], ())):
+            writes.extend(self.write_profile_to_etcd(profile_id,
+                                                     only_if_changed=True))
+        wait_for_all(writes)
 
     def provide_felix_config(self):
         """Specify the prefix of the TAP interfaces that Felix should
@@ -369,6 +752,28 @@ class CalicoTransportEtcd(CalicoTransport):
             LOG.info('%s -> true', READY_KEY)
             self.client.write(READY_KEY, 'true')
 
+
+def _decode_or_none(value):
+    """Decodes the given raw etcd value, returning None if the key was
+    deleted or its value isn't valid JSON."""
+    if value is None:
+        return None
+    try:
+        return json_decoder.decode(value)
+    except ValueError:
+        return None
+
+
+def endpoint_profile_ids(data):
+    """
+    Returns the IDs of the profiles in the given endpoint data, which has
+    either a single 'profile_id' or a list of 'profile_ids'.
+    """
+    if 'profile_ids' in data:
+        return data['profile_ids']
+    return [data['profile_id']]
+
+
 def _neutron_rule_to_etcd_rule(rule):
     """
     Translate a single Neutron rule dict to a single dict in our
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+openstack.test.bench_mech_calico
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Manual benchmark counting the Neutron DB queries that the mechanism driver
+makes to read all endpoints and security groups, as it does on each full
+resync.  Not a test case.  Usage:
+
+    python -m calico.openstack.test.bench_mech_calico [<number of ports>]
+
+Compares the old per-port/per-binding queries with the bulk queries, using
+a stub Neutron plugin.
+"""
+import sys
+from collections import defaultdict
+
+# Importing the test library replaces Neutron, etcd and oslo with mocks.
+import calico.openstack.test.lib  # noqa
+import calico.openstack.mech_calico as mech_calico
+
+DEFAULT_NUM_PORTS = 5000
+PORTS_PER_SUBNET = 250
+PORTS_PER_SG = 50
+
+
+class StubPlugin(object):
+    """Stub Neutron plugin that counts the queries made of it."""
+
+    def __init__(self, num_ports):
+        self.query_counts = defaultdict(int)
+        self.notifier = None
+        self.ports = []
+        self.subnets = {}
+        self.bindings = []
+        for ii in xrange(num_ports):
+            subnet_id = "subnet-%d" % (ii // PORTS_PER_SUBNET)
+            self.subnets[subnet_id] = {'id': subnet_id,
+                                       'gateway_ip': '10.0.0.1'}
+            port_id = "port-%d" % ii
+            sg_id = "sg-%d" % (ii // PORTS_PER_SG)
+            self.ports.append({
+                'binding:vif_type': 'tap',
+                'binding:host_id': 'host-%d' % (ii % 100),
+                'id': port_id,
+                'device_owner': 'compute:nova',
+                'fixed_ips': [{'subnet_id': subnet_id,
+                               'ip_address': '10.%d.%d.%d' % (
+                                   (ii >> 16) & 0xff,
+                                   (ii >> 8) & 0xff,
+                                   ii & 0xff)}],
+                'mac_address': '00:11:22:33:44:55',
+                'admin_state_up': True,
+                'security_groups': [sg_id],
+            })
+            self.bindings.append({'port_id': port_id,
+                                  'security_group_id': sg_id})
+        self.ports_by_id = dict((p['id'], p) for p in self.ports)
+        self.sgs = [{'id': sg_id, 'security_group_rules': []}
+                    for sg_id in set(b['security_group_id']
+                                     for b in self.bindings)]
+
+    def get_ports(self, context, filters=None, fields=None):
+        self.query_counts['get_ports'] += 1
+        if filters is None:
+            return [dict(p) for p in self.ports]
+        return [self.ports_by_id[id] for id in filters['id']]
+
+    def get_port(self, context, id):
+        self.query_counts['get_port'] += 1
+        return self.ports_by_id[id]
+
+    def get_subnet(self, context, id):
+        self.query_counts['get_subnet'] += 1
+        return self.subnets[id]
+
+    def get_subnets(self, context, filters=None, fields=None):
+        self.query_counts['get_subnets'] += 1
+        return [self.subnets[id] for id in filters['id']]
+
+    def get_security_groups(self, context):
+        self.query_counts['get_security_groups'] += 1
+        return [dict(sg) for sg in self.sgs]
+
+    def _get_port_security_group_bindings(self, context, filters):
+        self.query_counts['_get_port_security_group_bindings'] += 1
+        sg_ids = set(filters['security_group_id'])
+        return [b for b in self.bindings if b['security_group_id'] in sg_ids]
+
+
+def old_resync_queries(driver, db):
+    """The query pattern that the bulk queries replaced."""
+    ports = [port for port in db.get_ports(None)
+             if driver._port_is_endpoint_port(port)]
+    for port in ports:
+        for ip in port['fixed_ips']:
+            ip['gateway'] = db.get_subnet(None, ip['subnet_id'])['gateway_ip']
+    for sg in db.get_security_groups(None):
+        filters = {'security_group_id': [sg['id']]}
+        for binding in db._get_port_security_group_bindings(None, filters):
+            db.get_port(None, binding['port_id'])
+
+
+def new_resync_queries(driver, db):
+    driver.get_endpoints()
+    driver.get_security_groups()
+
+
+def count_queries(name, fn, num_ports):
+    driver = mech_calico.CalicoMechanismDriver()
+    db = StubPlugin(num_ports)
+    driver.db = db
+    fn(driver, db)
+    total = sum(db.query_counts.values())
+    print "%-8s %8d queries  %s" % (name, total,
+                                    ", ".join("%s: %d" % kv for kv in
+                                              sorted(db.query_counts.items())))
+
+
+def main(argv):
+    num_ports = int(argv[1]) if len(argv) > 1 else DEFAULT_NUM_PORTS
+    print "Neutron DB queries to read %s ports:" % num_ports
+    count_queries("before", old_resync_queries, num_ports)
+    count_queries("after", new_resync_queries, num_ports)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -95,6 +95,10 @@ class Lib(object):
     # current ports.
     osdb_ports = []
 
+    # Ports, not necessarily in osdb_ports, that are members of the security
+    # group that we last notified an update for.
+    sg_member_ports = []
+
     def setUp(self):
         # Announce the current test case.
         print "\nTEST CASE: %s" % self.id()
@@ -116,10 +120,11 @@ class Lib(object):
         self.db_context = mech_calico.ctx.get_admin_context()
 
         # Arrange what the DB's get_ports will return.
-        self.db.get_ports.side_effect = lambda *args: self.osdb_ports
+        self.db.get_ports.side_effect = self.get_ports
 
-        # Arrange DB's get_subnet call.
+        # Arrange DB's get_subnet and get_subnets calls.
         self.db.get_subnet.side_effect = self.get_subnet
+        self.db.get_subnets.side_effect = self.get_subnets
 
         # Arrange what the DB's get_security_groups query will return (the
         # default SG).
@@ -317,12 +322,26 @@ class Lib(object):
             mech_calico.constants.PORT_STATUS_ACTIVE)
         self.db.update_port_status.reset_mock()
 
+    def get_ports(self, context, filters=None, fields=None):
+        if filters is None:
+            return self.osdb_ports
+        return [port for port in self.osdb_ports + self.sg_member_ports
+                if port['id'] in filters['id']]
+
     def get_subnet(self, context, id):
         if ':' in id:
             return {'gateway_ip': '2001:db8:a41:2::1'}
         else:
             return {'gateway_ip': '10.65.0.1'}
 
+    def get_subnets(self, context, filters=None, fields=None):
+        subnets = []
+        for id in filters['id']:
+            subnet = self.get_subnet(context, id)
+            subnet['id'] = id
+            subnets.append(subnet)
+        return subnets
+
     def notify_security_group_update(self, id, rules, port, type):
         """Notify a new or changed security group definition.
         """
@@ -334,11 +353,12 @@ class Lib(object):
         }
         if port is None:
             self.db._get_port_security_group_bindings.return_value = []
+            self.sg_member_ports = []
         else:
             self.db._get_port_security_group_bindings.return_value = [
-                {'port_id': port['id']}
+                {'port_id': port['id'], 'security_group_id': id}
             ]
-            self.db.get_port.return_value = port
+            self.sg_member_ports = [port]
 
         if type == 'rule':
             # Call security_groups_rule_updated with the new or changed ID.
@@ -22,6 +22,7 @@ import eventlet
 import json
 import mock
 import unittest
+from urllib3.exceptions import ReadTimeoutError
 from calico import common
 
 import calico.openstack.test.lib as lib
@@ -35,6 +36,12 @@ class EtcdKeyNotFound(BaseException):
 lib.m_etcd.EtcdKeyNotFound = EtcdKeyNotFound
 
 
+class EtcdException(Exception):
+    pass
+
+lib.m_etcd.EtcdException = EtcdException
+
+
 class TestPluginEtcd(lib.Lib, unittest.TestCase):
 
     def maybe_reset_etcd(self):
@@ -53,6 +60,7 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
         self.maybe_reset_etcd()
         print "etcd write: %s\n%s" % (key, value)
         self.etcd_data[key] = value
+        self.record_etcd_event("set", key, value)
         try:
             self.recent_writes[key] = json.loads(value)
         except ValueError:
@@ -68,9 +76,24 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
                 if k == key or k[:keylen] == key + '/':
                     del self.etcd_data[k]
             self.recent_deletes.add(key + '(recursive)')
+            self.record_etcd_event("delete", key, None, is_dir=True)
         else:
+            if key not in self.etcd_data:
+                raise lib.m_etcd.EtcdKeyNotFound()
             del self.etcd_data[key]
             self.recent_deletes.add(key)
+            self.record_etcd_event("delete", key, None)
+
+    def record_etcd_event(self, action, key, value, is_dir=False):
+        """Append to the etcd event history, advancing the etcd index."""
+        self.etcd_index += 1
+        event = mock.Mock()
+        event.action = action
+        event.key = key
+        event.value = value
+        event.dir = is_dir
+        event.modifiedIndex = self.etcd_index
+        self.etcd_events.append(event)
 
     def assertEtcdWrites(self, expected):
         if self.assert_etcd_writes_deletes:
@@ -82,14 +105,27 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
             self.assertEqual(self.recent_deletes, expected)
         self.recent_deletes = set()
 
-    def etcd_read(self, key, recursive=False):
+    def etcd_read(self, key, recursive=False, wait=False, waitIndex=None,
+                  timeout=None):
         """Read from the accumulated etcd database.
         """
         self.maybe_reset_etcd()
 
+        if wait:
+            # Return the first event at or after the given index.  We
+            # never expect a read to wait for an event that hasn't happened
+            # yet.
+            for event in self.etcd_events:
+                if (event.modifiedIndex >= waitIndex and
+                        event.key.startswith(key)):
+                    print "etcd event: %s %s" % (event.action, event.key)
+                    return event
+            self.fail("Unexpected wait for etcd index %s" % waitIndex)
+
         # Prepare a read result object.
         read_result = mock.Mock()
         read_result.key = key
+        read_result.etcd_index = self.etcd_index
 
         # Set the object's value - i.e. the value, if any, of exactly the
         # specified key.
@@ -97,7 +133,8 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
             read_result.value = self.etcd_data[key]
         else:
             read_result.value = None
-            if not recursive:
+            # etcd's root directory always exists.
+            if not recursive and key != '/':
                 raise lib.m_etcd.EtcdKeyNotFound()
 
         # Print and return the result object.
@@ -136,6 +173,13 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
 
         # Start with an empty etcd database.
         self.etcd_data = {}
+        self.etcd_index = 0
+        self.etcd_events = []
+
+        # Do a full resync on every pass unless a test says otherwise.
+        t_etcd.cfg.CONF.calico.full_resync_interval = 0
+        t_etcd.cfg.CONF.calico.etcd_writer_pool_size = 10
+        t_etcd.cfg.CONF.calico.per_sg_profiles = False
 
         # Start with an empty set of recent writes and deletes.
         self.recent_writes = {}
@@ -216,10 +260,17 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
         # Allow it to run again, this time auditing against the etcd data that
         # was written on the first iteration.
         print "\nResync with existing etcd data\n"
+        self.client.read.reset_mock()
         self.simulated_time_advance(t_etcd.PERIODIC_RESYNC_INTERVAL_SECS)
         self.assertEtcdWrites({})
         self.assertEtcdDeletes(set())
 
+        # The profiles' rules and tags come from the recursive read of the
+        # profile directory, not from individual reads.
+        keys_read = [c[0][0] for c in self.client.read.call_args_list]
+        self.assertEqual([k for k in keys_read
+                          if k.endswith(('/rules', '/tags'))], [])
+
         # Delete lib.port1
         context = mock.Mock()
         context._port = lib.port1
@@ -439,15 +490,14 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
             'rule'
         )
 
-        # Expect an etcd write because SG-1 is now in use.
+        # Expect an etcd write because SG-1 is now in use.  Its tags haven't
+        # changed, so only its rules are rewritten.
         expected_writes = {
             '/calico/v1/policy/profile/SG-1/rules':
                 {"outbound_rules": [],
                  "inbound_rules": [{"dst_ports": [5060],
                                     "src_tag": "SGID-default",
                                     "ip_version": 4}]},
-            '/calico/v1/policy/profile/SG-1/tags':
-                ["SG-1"]
         }
         self.assertEtcdWrites(expected_writes)
 
@@ -463,6 +513,214 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
             '/calico/v1/host/felix-host-1/workload/openstack/FACEBEEF-1234-5678/endpoint/FACEBEEF-1234-5678',
             '/calico/v1/policy/profile/SGID-default(recursive)']))
 
+    def test_incremental_resync(self):
+        """Resyncs between full audits only recheck changed etcd keys.
+        """
+        t_etcd.cfg.CONF.calico.full_resync_interval = (
+            4 * t_etcd.PERIODIC_RESYNC_INTERVAL_SECS)
+        self.osdb_ports = [lib.port1, lib.port2]
+        self.driver.initialize()
+        self.give_way()
+        self.simulated_time_advance(1)
+        num_queries = self.db.get_ports.call_count
+        self.recent_writes = {}
+
+        # Corrupt one endpoint and delete a profile's tags behind the
+        # plugin's back.
+        ep1_key = '/calico/v1/host/felix-host-1/workload/openstack/DEADBEEF-1234-5678/endpoint/DEADBEEF-1234-5678'
+        tags_key = '/calico/v1/policy/profile/SGID-default/tags'
+        ep1_data = json.loads(self.etcd_data[ep1_key])
+        self.check_etcd_write(ep1_key, '{"name": "bogus"}')
+        self.check_etcd_delete(tags_key)
+        self.recent_writes = {}
+        self.recent_deletes = set()
+
+        # The incremental resync checks them against the database and
+        # restores them.
+        self.simulated_time_advance(t_etcd.PERIODIC_RESYNC_INTERVAL_SECS)
+        self.assertEtcdWrites({ep1_key: ep1_data,
+                               tags_key: ["SGID-default"]})
+        self.assertEtcdDeletes(set())
+        # Only the affected port and security group were looked up.
+        port_filters = [c[1]['filters'] for c in
+                        self.db.get_ports.call_args_list[num_queries:]]
+        self.assertEqual(port_filters[0], {'id': ['DEADBEEF-1234-5678']})
+        self.assertFalse(None in port_filters)
+        self.assertEqual(
+            self.db.get_security_groups.call_args[1]['filters'],
+            {'id': ['SGID-default']})
+
+        # Our own writes don't trigger any further work.
+        num_queries = self.db.get_ports.call_count
+        self.simulated_time_advance(t_etcd.PERIODIC_RESYNC_INTERVAL_SECS)
+        self.assertEtcdWrites({})
+        self.assertEtcdDeletes(set())
+        self.assertEqual(self.db.get_ports.call_count, num_queries)
+
+        # Another Neutron server disables port1 and writes its endpoint.
+        # We don't revert the newer value.
+        port1 = lib.port1.copy()
+        port1['admin_state_up'] = False
+        self.osdb_ports = [port1, lib.port2]
+        self.check_etcd_write(ep1_key,
+                              json.dumps(dict(ep1_data, state='inactive')))
+        self.recent_writes = {}
+        self.simulated_time_advance(t_etcd.PERIODIC_RESYNC_INTERVAL_SECS)
+        self.assertEtcdWrites({})
+        self.assertEtcdDeletes(set())
+        self.assertEqual(self.driver.transport._written[ep1_key]['state'],
+                         'inactive')
+
+        # Remove port1 from the database without notifying the plugin.  The
+        # next full audit notices that it has gone.
+        self.osdb_ports = [lib.port2]
+        self.simulated_time_advance(t_etcd.PERIODIC_RESYNC_INTERVAL_SECS)
+        self.assertEtcdWrites({})
+        self.assertEtcdDeletes(set([ep1_key]))
+
+    def test_incremental_resync_read_fails(self):
+        """If the etcd event history can't be read, we fall back to a full
+        resync.
+        """
+        t_etcd.cfg.CONF.calico.full_resync_interval = (
+            4 * t_etcd.PERIODIC_RESYNC_INTERVAL_SECS)
+        self.osdb_ports = [lib.port1]
+        self.driver.initialize()
+        self.give_way()
+        self.simulated_time_advance(1)
+        num_queries = self.db.get_ports.call_count
+
+        # Something outside /calico/v1 advances the etcd index, so waiting
+        # for the next event times out.
+        self.record_etcd_event("set", "/other/key", "value")
+
+        def etcd_read(key, wait=False, **kwargs):
+            if wait:
+                raise ReadTimeoutError(None, None, "Read timed out.")
+            return self.etcd_read(key, wait=wait, **kwargs)
+        self.client.read.side_effect = etcd_read
+        self.simulated_time_advance(t_etcd.PERIODIC_RESYNC_INTERVAL_SECS)
+        self.assertTrue(self.db.get_ports.call_count > num_queries)
+        self.assertTrue(self.driver.transport._resync_index is not None)
+
+    def test_current_etcd_index_before_ready(self):
+        """We can read the etcd index before the Ready flag exists."""
+        self.driver.initialize()
+        self.etcd_index = 42
+        self.assertEqual(self.driver.transport.current_etcd_index(), 42)
+
+    def test_failed_write_not_remembered(self):
+        """We only remember the values of etcd writes that succeed."""
+        self.driver.initialize()
+        self.give_way()
+        transport = self.driver.transport
+        self.client.write.side_effect = lib.m_etcd.EtcdException("Failed")
+        done = transport.write_json('/calico/v1/key', {'a': 1})
+        self.assertRaises(lib.m_etcd.EtcdException, done.wait)
+        self.assertFalse('/calico/v1/key' in transport._written)
+
+    def test_sg_update_rewrites_changed_profiles(self):
+        """A security group update only rewrites the profiles that include
+        it, and only if their data has changed.
+        """
+        port4 = lib.port3.copy()
+        port4['id'] = 'PORT4-1234-5678'
+        port4['security_groups'] = ['SGID-default', 'SG-1']
+        self.osdb_ports = [lib.port1, port4]
+        self.db.get_security_groups.return_value.append(
+            {'id': 'SG-1', 'security_group_rules': []})
+        self.driver.initialize()
+        self.give_way()
+        self.simulated_time_advance(1)
+        self.recent_writes = {}
+        transport = self.driver.transport
+        self.assertEqual(dict(transport.profiles_by_sg),
+                         {'SGID-default': set(['SGID-default',
+                                               'SGID-default_SG-1']),
+                          'SG-1': set(['SGID-default_SG-1'])})
+
+        # An update that doesn't change SG-1's rules writes nothing.
+        self.notify_security_group_update('SG-1', [], None, 'rule')
+        self.assertEtcdWrites({})
+
+        # An update that does only rewrites the rules of the profile that
+        # includes SG-1.
+        rule = {'remote_group_id': None,
+                'remote_ip_prefix': '10.0.0.0/8',
+                'protocol': 'tcp',
+                'direction': 'ingress',
+                'ethertype': 'IPv4',
+                'port_range_min': 22,
+                'port_range_max': 22}
+        self.notify_security_group_update('SG-1', [rule], None, 'rule')
+        self.assertEqual(self.recent_writes.keys(),
+                         ['/calico/v1/policy/profile/SGID-default_SG-1/rules'])
+        self.assertEqual(
+            self.recent_writes.values()[0]['inbound_rules'][-1],
+            {'ip_version': 4, 'protocol': 'tcp', 'src_net': '10.0.0.0/8',
+             'dst_ports': [22]})
+
+    def test_per_sg_profiles(self):
+        """With per_sg_profiles, each endpoint lists one profile per
+        security group, instead of a profile for its combination of them.
+        """
+        t_etcd.cfg.CONF.calico.per_sg_profiles = True
+        port4 = lib.port3.copy()
+        port4['id'] = 'PORT4-1234-5678'
+        port4['security_groups'] = ['SGID-default', 'SG-1']
+        self.osdb_ports = [lib.port1, port4]
+        self.db.get_security_groups.return_value.append(
+            {'id': 'SG-1', 'security_group_rules': []})
+        self.driver.initialize()
+        self.give_way()
+        self.simulated_time_advance(1)
+
+        ep_key = ('/calico/v1/host/felix-host-2/workload/openstack/'
+                  'PORT4-1234-5678/endpoint/PORT4-1234-5678')
+        self.assertEqual(self.recent_writes[ep_key]['profile_ids'],
+                         ['SGID-default', 'SG-1'])
+        self.assertFalse('profile_id' in self.recent_writes[ep_key])
+        profile_keys = set(key for key in self.recent_writes
+                           if key.startswith('/calico/v1/policy/profile/'))
+        self.assertEqual(profile_keys, set([
+            '/calico/v1/policy/profile/SGID-default/rules',
+            '/calico/v1/policy/profile/SGID-default/tags',
+            '/calico/v1/policy/profile/SG-1/rules',
+            '/calico/v1/policy/profile/SG-1/tags',
+        ]))
+        self.assertEqual(
+            self.recent_writes['/calico/v1/policy/profile/SG-1/tags'],
+            ['SG-1'])
+
+    def test_bulk_neutron_queries(self):
+        """Reading all endpoints and security groups takes a fixed number
+        of Neutron DB queries, however many ports there are.
+        """
+        self.osdb_ports = [lib.port1, lib.port2, lib.port3]
+        self.db._get_port_security_group_bindings.return_value = [
+            {'port_id': port['id'], 'security_group_id': 'SGID-default'}
+            for port in self.osdb_ports
+        ]
+        self.driver._get_db()
+        self.db.reset_mock()
+
+        ports = self.driver.get_endpoints()
+        self.assertEqual([ip['gateway']
+                          for port in ports for ip in port['fixed_ips']],
+                         ['10.65.0.1', '10.65.0.1', '2001:db8:a41:2::1'])
+        sgs = self.driver.get_security_groups()
+        self.assertEqual(sgs[0]['members'],
+                         {'DEADBEEF-1234-5678': ['10.65.0.2'],
+                          'FACEBEEF-1234-5678': ['10.65.0.3'],
+                          'HELLO-1234-5678': ['2001:db8:a41:2::12']})
+
+        self.assertEqual(self.db.get_subnets.call_count, 1)
+        self.assertFalse(self.db.get_subnet.called)
+        self.assertEqual(
+            self.db._get_port_security_group_bindings.call_count, 1)
+        self.assertEqual(self.db.get_ports.call_count, 2)
+        self.assertFalse(self.db.get_port.called)
+
     def test_noop_entry_points(self):
         """Call the mechanism driver entry points that are currently
         implemented as no-ops (because Calico function does not need
@@ -559,6 +817,57 @@ class TestPluginEtcd(lib.Lib, unittest.TestCase):
         common.validate_rules(rules)
 
 
+class TestEtcdWriterPool(unittest.TestCase):
+
+    def setUp(self):
+        self.writes = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.client = mock.Mock()
+        self.client.write.side_effect = self.slow_write
+        self.pool = t_etcd.EtcdWriterPool(self.client, 2)
+
+    def slow_write(self, key, value):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        eventlet.sleep(0)
+        self.writes.append((key, value))
+        self.in_flight -= 1
+
+    def test_ordering_and_concurrency(self):
+        events = [self.pool.write(key, value)
+                  for key, value in [("a", 1), ("b", 1), ("a", 2),
+                                     ("c", 1), ("a", 3)]]
+        t_etcd.wait_for_all(events)
+        self.assertEqual([v for k, v in self.writes if k == "a"], [1, 2, 3])
+        self.assertEqual(len(self.writes), 5)
+        self.assertEqual(self.max_in_flight, 2)
+
+    def test_ordering_key(self):
+        events = [self.pool.write("a/rules", 1, ordering_key="a"),
+                  self.pool.write("a/tags", 1, ordering_key="a")]
+        t_etcd.wait_for_all(events)
+        self.assertEqual(self.writes, [("a/rules", 1), ("a/tags", 1)])
+        self.assertEqual(self.max_in_flight, 1)
+
+    def test_queue_while_pool_full(self):
+        pool = t_etcd.EtcdWriterPool(self.client, 1)
+        events = [pool.write("a", 1)]
+        writer = eventlet.spawn(lambda: events.append(pool.write("b", 1)))
+        # Let the writer block on the full pool.
+        eventlet.sleep(0)
+        events.append(pool.write("b", 2))
+        writer.wait()
+        t_etcd.wait_for_all(events)
+        self.assertEqual(self.writes, [("a", 1), ("b", 1), ("b", 2)])
+
+    def test_exception(self):
+        self.client.delete.side_effect = KeyError()
+        done = self.pool.delete("a", recursive=True)
+        self.assertRaises(KeyError, done.wait)
+        self.client.delete.assert_called_once_with("a", recursive=True)
+
+
 def _neutron_rule_from_dict(overrides):
     rule = {
         "ethertype": "IPv4",
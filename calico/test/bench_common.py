@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+test.bench_common
+~~~~~~~~~~~~~~~~~
+
+Manual micro-benchmark comparing CIDR validation with netaddr against
+calico.common's fast path.  Not a test case because it takes a while to
+run.  Usage:
+
+    python -m calico.test.bench_common [<number of CIDRs>]
+"""
+import sys
+import time
+
+import netaddr
+import netaddr.core
+
+from calico import common
+
+DEFAULT_NUM_CIDRS = 100000
+
+
+def netaddr_validate_cidr(cidr, version):
+    """The netaddr-based implementation that common.validate_cidr replaced."""
+    try:
+        netaddr.IPNetwork(cidr, version=version)
+        return True
+    except (netaddr.core.AddrFormatError, ValueError, TypeError):
+        return False
+
+
+def generate_cidrs(num_cidrs):
+    cidrs = []
+    for ii in xrange(num_cidrs):
+        if ii % 4 == 3:
+            cidrs.append(("2001:db8::%x:%x/128" % (ii >> 16, ii & 0xffff),
+                          6))
+        else:
+            cidrs.append(("10.%d.%d.%d/32" % ((ii >> 16) & 0xff,
+                                              (ii >> 8) & 0xff,
+                                              ii & 0xff), 4))
+    return cidrs
+
+
+def time_it(name, fn, cidrs):
+    start = time.time()
+    for cidr, version in cidrs:
+        assert fn(cidr, version)
+    duration = time.time() - start
+    print "%-25s %8.3fs %10.0f CIDRs/s" % (name, duration,
+                                            len(cidrs) / duration)
+
+
+def main(argv):
+    num_cidrs = int(argv[1]) if len(argv) > 1 else DEFAULT_NUM_CIDRS
+    cidrs = generate_cidrs(num_cidrs)
+    time_it("netaddr", netaddr_validate_cidr, cidrs)
+    # Bypass the cache to time the parser itself.
+    time_it("fast path (uncached)", common._validate_cidr, cidrs)
+    # A working set that fits in the cache, validated twice.
+    cached = cidrs[:common.IP_PARSE_CACHE_SIZE]
+    time_it("fast path (cold cache)", common.validate_cidr, cached)
+    time_it("fast path (warm cache)", common.validate_cidr, cached)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
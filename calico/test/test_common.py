@@ -111,3 +111,72 @@ class TestCommon(unittest.TestCase):
         self.assertTrue(common.validate_cidr("2001::a/64", None))
 
         self.assertFalse(common.validate_cidr(None, None))
+
+    def test_bounded_cache(self):
+        cache = common.BoundedCache(2)
+        cache["a"] = 1
+        cache["b"] = 2
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c", "dflt"), "dflt")
+        # Third entry rolls the first generation over.
+        cache["c"] = 3
+        self.assertEqual(len(cache), 3)
+        # Hit in the old generation gets promoted.
+        self.assertEqual(cache.get("a"), 1)
+        cache["d"] = 4
+        # "b" was in the discarded generation.
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_validate_cidr(self):
+        self.assertTrue(common.validate_cidr("10.0.0.1/24", 4))
+        self.assertTrue(common.validate_cidr("2001:0DB8::0001", None))
+        self.assertFalse(common.validate_cidr("2001::1/64", 4))
+        # Forms that only netaddr accepts.
+        self.assertTrue(common.validate_cidr("10.1/16", None))
+        self.assertTrue(common.validate_cidr("10.0.0.0/255.0.0.0", 4))
+        self.assertFalse(common.validate_cidr("10.0.0.1/33", 4))
+        self.assertFalse(common.validate_cidr("2001::1/129", 6))
+
+    def test_validate_ip_addr(self):
+        self.assertTrue(common.validate_ip_addr("10.0.0.1", 4))
+        self.assertTrue(common.validate_ip_addr("2001::1", None))
+        self.assertFalse(common.validate_ip_addr("2001::1", 4))
+        self.assertFalse(common.validate_ip_addr("10.0.0.1/32", 4))
+
+    @mock.patch("netaddr.IPNetwork", autospec=True)
+    def test_validate_cidr_fast_path(self, m_ipnetwork):
+        self.assertTrue(common.validate_cidr("10.0.0.2/32", 4))
+        self.assertTrue(common.validate_cidr("2001::2/64", 6))
+        self.assertFalse(m_ipnetwork.called)
+
+    @mock.patch("calico.common._validate_cidr", autospec=True)
+    def test_validate_cidr_cached(self, m_validate):
+        m_validate.return_value = False
+        self.assertFalse(common.validate_cidr("cached", 4))
+        self.assertFalse(common.validate_cidr("cached", 4))
+        self.assertEqual(m_validate.call_count, 1)
+
+    def test_validate_endpoint_profile_ids(self):
+        config = mock.Mock()
+        config.IFACE_PREFIX = "tap"
+        endpoint = {"state": "active", "name": "tap1234",
+                    "mac": "aa:bb:cc:dd:ee:ff", "ipv4_nets": [],
+                    "ipv6_nets": [], "profile_ids": ["sg1", "sg2"]}
+        common.validate_endpoint(config, endpoint)
+        self.assertEqual(common.endpoint_profile_ids(endpoint),
+                         ["sg1", "sg2"])
+        for bad_ids in ("sg1", ["sg1", 2], ["sg1", "sg1"]):
+            endpoint["profile_ids"] = bad_ids
+            self.assertRaises(common.ValidationFailed,
+                              common.validate_endpoint, config, endpoint)
+        del endpoint["profile_ids"]
+        self.assertRaises(common.ValidationFailed,
+                          common.validate_endpoint, config, endpoint)
+        endpoint["profile_id"] = "prof1"
+        common.validate_endpoint(config, endpoint)
+        self.assertEqual(common.endpoint_profile_ids(endpoint), ["prof1"])
+        self.assertEqual(common.endpoint_profile_ids(None), [])
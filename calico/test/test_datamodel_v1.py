@@ -86,3 +86,47 @@ class TestDatamodel(unittest.TestCase):
         self.assertEquals(
             get_profile_id_for_profile_dir("/calico/v1/policy/profile/prof1/rules"), None)
 
+
+    def test_parse_key_data(self):
+        self.assertEqual(
+            parse_key("/calico/v1/policy/profile/prof1/rules"),
+            (KEY_TYPE_RULES, "prof1"))
+        self.assertEqual(
+            parse_key("/calico/v1/policy/profile/prof1/tags"),
+            (KEY_TYPE_TAGS, "prof1"))
+        self.assertEqual(
+            parse_key("/calico/v1/host/h1/workload/os/wl1/endpoint/ep1"),
+            (KEY_TYPE_ENDPOINT, EndpointId("h1", "os", "wl1", "ep1")))
+
+    def test_parse_key_dirs(self):
+        self.assertEqual(parse_key("/calico/v1/policy/profile/prof1"),
+                         (KEY_TYPE_PROFILE, "prof1"))
+        self.assertEqual(parse_key("/calico/v1/policy/profile/prof1/"),
+                         (KEY_TYPE_PROFILE, "prof1"))
+        self.assertEqual(parse_key("/calico/v1/policy/profile"),
+                         (KEY_TYPE_PROFILE_OTHER, None))
+        self.assertEqual(parse_key("/calico/v1/policy/profile/prof1/foo"),
+                         (KEY_TYPE_PROFILE_OTHER, None))
+        self.assertEqual(parse_key("/calico/v1/host/h1"),
+                         (KEY_TYPE_HOST_OTHER, None))
+        self.assertEqual(parse_key("/calico/v1/host/h1/workload/os/wl1"),
+                         (KEY_TYPE_HOST_OTHER, None))
+
+    def test_parse_key_config(self):
+        self.assertEqual(parse_key("/calico/v1/Ready"),
+                         (KEY_TYPE_READY, None))
+        self.assertEqual(parse_key("/calico/v1/config/LogSeverityFile"),
+                         (KEY_TYPE_CONFIG, "LogSeverityFile"))
+        self.assertEqual(parse_key("/calico/v1/config"),
+                         (KEY_TYPE_CONFIG, None))
+        self.assertEqual(parse_key("/calico/v1/host/h1/config/Foo"),
+                         (KEY_TYPE_HOST_CONFIG, "h1"))
+        self.assertEqual(parse_key("/calico/v1/host/h1/config"),
+                         (KEY_TYPE_HOST_CONFIG, "h1"))
+
+    def test_parse_key_other(self):
+        for key in ["/calico", "/calico/v1", "/calico/v1/", "/calico/v2/Ready",
+                    "/calico/v1/Ready/foo", "/calico/v1/policy",
+                    "/calico/v1/policy/foo", "/calico/v1/config/a/b",
+                    "/calico/v1foo/Ready"]:
+            self.assertEqual(parse_key(key), (KEY_TYPE_OTHER, None), key)
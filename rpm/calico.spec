@@ -91,7 +91,7 @@ This package provides common files.
 %package felix
 Group:          Applications/Engineering
 Summary:        Project Calico virtual networking for cloud data centers
-Requires:       calico-common, ipset, net-tools, python-devel, python-netaddr, python-gevent
+Requires:       calico-common, ipset, net-tools, python-devel, python-netaddr, python-gevent, python-ijson
 
 %description felix
 This package provides the Felix component.